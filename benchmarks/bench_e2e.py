@@ -0,0 +1,232 @@
+"""End-to-end benchmark of `bot.main` against local fake telegram and github servers.
+
+The bot runs in a subprocess like in production, fake telegram hands it `--updates` updates from `--chats` chats,
+either all at once or `--rate` per second, and records the replies. Reports updates per second,
+percentiles of reply latency (from the moment an update is available in getUpdates to the moment its reply
+is sent), github searches per update and peak memory of the bot. Replies of a chat are matched to its updates
+in order, the bot keeps the order of updates of the same chat.
+
+    python -m benchmarks.bench_e2e --output before.json
+    python -m benchmarks.bench_e2e --github-latency 0.2 --telegram-error-rate 0.05 --output after.json
+    python -m benchmarks.bench_e2e --compare before.json after.json
+
+The bot sends at most 30 messages per second like telegram allows, so that's the ceiling of updates per second.
+"""
+import argparse
+import collections
+import itertools
+import json
+import os
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_servers import FakeGithub, FakeTelegram
+from github_trending_bot import bot
+
+TEXTS = ('/show', '/show 1', '/show 30', '/show 365', '/help', '/echo some text')
+STARTUP_TIMEOUT = 30  # seconds for the bot to make the first getUpdates call
+STOP_TIMEOUT = 15  # seconds for the bot to send queued messages and exit
+BOT_COMMAND = 'from github_trending_bot import bot; bot.main()'
+# higher is better for these results, lower is better for the others
+HIGHER_IS_BETTER = ('updates_per_second',)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--updates', type=int, default=300)
+    parser.add_argument('--chats', type=int, default=300)
+    parser.add_argument('--rate', type=float, default=0, help='updates per second, all at once when 0')
+    parser.add_argument('--workers', type=int, default=4, help='WORKERS of the bot')
+    parser.add_argument('--telegram-latency', type=float, default=0.01, help='seconds')
+    parser.add_argument('--telegram-error-rate', type=float, default=0)
+    parser.add_argument('--telegram-send-rate', type=float, default=30, help='messages per second before 429')
+    parser.add_argument('--github-latency', type=float, default=0.1, help='seconds')
+    parser.add_argument('--github-error-rate', type=float, default=0)
+    parser.add_argument('--github-rate-limit', type=int, default=30, help='searches per minute before 403')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for all replies')
+    parser.add_argument('--output', help='path of the json file with results')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two json files of results')
+    return parser.parse_args(argv)
+
+
+def make_updates(updates, chats):
+    texts = itertools.cycle(TEXTS)
+    return [
+        {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'chat': {'id': update_id % chats, 'type': 'private'},
+                'text': next(texts),
+            },
+        }
+        for update_id in range(1, updates + 1)
+    ]
+
+
+def run(args):
+    telegram = FakeTelegram(args.telegram_latency, args.telegram_error_rate, args.telegram_send_rate,
+                            seed=args.seed).start()
+    github = FakeGithub(args.github_latency, args.github_error_rate, args.github_rate_limit, seed=args.seed).start()
+    with tempfile.TemporaryDirectory() as directory:
+        log_path = os.path.join(directory, 'bot.log')
+        with open(log_path, 'wb') as log_file:
+            process = subprocess.Popen([sys.executable, '-c', BOT_COMMAND], env=dict(
+                os.environ,
+                GITHUB_TOKEN='some_github_token',
+                TELEGRAM_TOKEN='some_telegram_token',
+                GITHUB_API_BASE=github.url,
+                TELEGRAM_API_BASE=telegram.url,
+                STATE_URL=f'sqlite://{os.path.join(directory, "state.db")}',
+                PREWARM_DAYS='',
+                WORKERS=str(args.workers),
+            ), stderr=log_file)
+            try:
+                return _drive(args, process, telegram, github)
+            except Exception:
+                with open(log_path, encoding='utf-8', errors='replace') as log:
+                    sys.stderr.write(log.read()[-5000:])
+                raise
+            finally:
+                _stop(process)
+                telegram.stop()
+                github.stop()
+
+
+def _drive(args, process, telegram, github):
+    _wait_for(lambda: telegram.get_updates_calls > 0 or process.poll() is not None, STARTUP_TIMEOUT)
+    if process.poll() is not None:
+        raise RuntimeError(f'bot exited with {process.returncode}')
+    updates = make_updates(args.updates, args.chats)
+    available_at_by_chat = collections.defaultdict(list)
+    searches_before = github.searches
+    started_at = time.monotonic()
+    for i, update in enumerate(updates):
+        if args.rate:
+            time.sleep(max(started_at + i / args.rate - time.monotonic(), 0))
+        available_at_by_chat[update['message']['chat']['id']].append(time.monotonic())
+        telegram.add_updates([update])
+    if not telegram.wait_for_replies(len(updates), args.timeout):
+        raise RuntimeError(f'got {len(telegram.replies)} replies of {len(updates)} in {args.timeout} seconds')
+    latencies = []
+    replies_by_chat = collections.defaultdict(list)
+    for chat_id, _, sent_at in telegram.replies:
+        replies_by_chat[chat_id].append(sent_at)
+    for chat_id, available_at in available_at_by_chat.items():
+        latencies.extend(sent_at - at for at, sent_at in zip(available_at, replies_by_chat[chat_id]))
+    latencies.sort()
+    elapsed = max(sent_at for _, _, sent_at in telegram.replies) - started_at
+    error_replies = sum(1 for _, text, _ in telegram.replies if text == bot.ERROR_REPLY_TEXT)
+    rejected_replies = sum(
+        1 for _, text, _ in telegram.replies if text in (bot.RATE_LIMITED_REPLY_TEXT, bot.OVERLOADED_REPLY_TEXT))
+    return {
+        'updates': len(updates),
+        'elapsed': elapsed,
+        'updates_per_second': len(updates) / elapsed,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p95': percentile(latencies, 0.95),
+        'latency_p99': percentile(latencies, 0.99),
+        'github_searches_per_update': (github.searches - searches_before) / len(updates),
+        'github_rate_limited': github.rate_limited,
+        'telegram_flood_waits': telegram.flood_waits,
+        'error_replies': error_replies,
+        'rejected_replies': rejected_replies,
+        'peak_rss_bytes': _get_peak_rss(process.pid),
+    }
+
+
+def _wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError(f'timed out in {timeout} seconds')
+        time.sleep(0.05)
+
+
+def _get_peak_rss(pid):
+    """Returns peak resident memory of a running process in bytes, None when it's unknown."""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _stop(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    for name, value in results.items():
+        print(f'{name:<28} {_format(value)}')
+
+
+def compare(before_path, after_path):
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    print(f'{"":<28} {before["commit"] or before_path:>14} {after["commit"] or after_path:>14}')
+    for name, after_value in after['results'].items():
+        before_value = before['results'].get(name)
+        change = ''
+        if isinstance(before_value, (int, float)) and isinstance(after_value, (int, float)) and before_value:
+            ratio = after_value / before_value
+            worse = ratio < 1 if name in HIGHER_IS_BETTER else ratio > 1
+            change = f'{ratio:.2f}x' + (' worse' if worse and ratio != 1 else '')
+        print(f'{name:<28} {_format(before_value):>14} {_format(after_value):>14} {change}')
+
+
+def _format(value):
+    if isinstance(value, float):
+        return f'{value:,.3f}'
+    if isinstance(value, int):
+        return f'{value:,}'
+    return str(value)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    results = run(args)
+    print_results(results)
+    if args.output:
+        parameters = {name: value for name, value in vars(args).items() if name not in ('output', 'compare')}
+        with open(args.output, 'w') as output:
+            json.dump({
+                'commit': get_commit(),
+                'python': platform.python_version(),
+                'parameters': parameters,
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+            output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
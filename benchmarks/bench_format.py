@@ -0,0 +1,65 @@
+"""Micro-benchmark of rendering /show replies.
+
+Compares `format_html_message` with the implementation that re-escaped every repository on every call.
+
+    python -m benchmarks.bench_format
+"""
+import html
+import timeit
+
+from github_trending_bot import bot
+
+WINDOWS = (1, 3, 7, 14, 30)
+REPETITIONS = 5
+NUMBER = 2000
+
+
+def format_html_message_without_memoization(repositories):
+    message_parts = []
+    for repo in repositories:
+        part = f'<a href="{html.escape(repo.html_url)}">{html.escape(repo.name)}</a> - {html.escape(repo.description)}'
+        if repo.language is not None:
+            language_part = f'{html.escape(repo.language)} '
+        else:
+            language_part = ''
+        part += f' [{language_part}{repo.stargazers_count}{bot.STAR_SYMBOL}]'
+        message_parts.append(part)
+    return '\n\n'.join(message_parts)
+
+
+def make_lists_of_repositories():
+    """Returns one list per window, consecutive windows share most of their repositories like real ones do."""
+    repositories = [
+        bot.Repo(
+            name=f'<repo {i}>',
+            description=f'description of "repo {i}" & friends ' * 3,
+            html_url=f'https://github.com/owner/repo-{i}',
+            language='Python' if i % 3 else None,
+            stargazers_count=10000 - i,
+        )
+        for i in range(40)
+    ]
+    return [repositories[i * 2:i * 2 + bot.TRENDING_REPOSITORIES_LIMIT] for i in range(len(WINDOWS))]
+
+
+def bench(format_func, lists_of_repositories):
+    def format_all():
+        for repositories in lists_of_repositories:
+            format_func(repositories)
+
+    best = min(timeit.repeat(format_all, number=NUMBER, repeat=REPETITIONS))
+    return NUMBER * len(lists_of_repositories) / best
+
+
+def main():
+    lists_of_repositories = make_lists_of_repositories()
+    for repositories in lists_of_repositories:
+        assert bot.format_html_message(repositories) == format_html_message_without_memoization(repositories)
+    before = bench(format_html_message_without_memoization, lists_of_repositories)
+    after = bench(bot.format_html_message, lists_of_repositories)
+    print(f'before: {before:,.0f} messages/s')
+    print(f'after:  {after:,.0f} messages/s ({after / before:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Memory benchmark of the trending cache against the number of cached windows.
+
+Compares `Repo` with the plain class that kept a __dict__ per instance,
+every window caches its own list of TRENDING_REPOSITORIES_LIMIT repositories like results of github searches do.
+
+    python -m benchmarks.bench_memory
+"""
+import datetime as dt
+import gc
+import json
+import tracemalloc
+
+from github_trending_bot import bot
+
+WINDOWS = (1, 14, 100, 1000)
+
+
+class RepoBefore:
+    def __init__(self, name, description, html_url, language, stargazers_count, created_at=None):
+        self.name = name
+        self.description = description
+        self.html_url = html_url
+        self.language = language
+        self.stargazers_count = stargazers_count
+        self.created_at = created_at
+
+
+def make_repositories(repo_class, window):
+    return [
+        repo_class(
+            f'repo-{window}-{i}',
+            f'description of repo {i} created {window} days ago',
+            f'https://github.com/owner/repo-{window}-{i}',
+            'Python',
+            1000 - i,
+            dt.datetime(2017, 2, 18) - dt.timedelta(days=window),
+        )
+        for i in range(bot.TRENDING_REPOSITORIES_LIMIT)
+    ]
+
+
+def measure(repo_class, windows):
+    """Returns bytes that the cache takes beyond the strings of repositories, which are the same in both cases."""
+    strings = {
+        window: make_repositories(lambda *fields: fields, window)
+        for window in range(windows)
+    }
+    cache = bot.TrendingCache(maxsize=windows)
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    for window, fields in strings.items():
+        cache.get(window, lambda: [repo_class(*repo_fields) for repo_fields in fields])
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return after - before
+
+
+def main():
+    print(f'{"windows":>8} {"before":>12} {"after":>12}')
+    for windows in WINDOWS:
+        before = measure(RepoBefore, windows)
+        after = measure(bot.Repo, windows)
+        print(f'{windows:>8} {before:>11,}B {after:>11,}B ({before / after:.1f}x)')
+    repositories = make_repositories(bot.Repo, 0)
+    dumped = json.dumps(bot.dump_repositories(repositories)).encode('utf-8')
+    assert bot.load_repositories(json.loads(dumped)) == repositories
+    print(f'one window dumps to {len(dumped):,}B')
+
+
+if __name__ == '__main__':
+    main()
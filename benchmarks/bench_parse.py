@@ -0,0 +1,111 @@
+"""Micro-benchmark of parsing getUpdates responses of 100 updates.
+
+Compares `parse_updates_response` with the implementation that checked every message twice through exceptions,
+with orjson when it's installed and with the json module.
+
+    python -m benchmarks.bench_parse
+"""
+import json
+import timeit
+
+from github_trending_bot import bot
+
+UPDATES = 100
+REPETITIONS = 5
+NUMBER = 500
+
+
+def parse_updates_response_before(data):
+    response_data = json.loads(data.decode('utf-8'))
+    result = bot._get_or_raise(response_data, 'result', list, bot.TelegramApiError)
+    return [make_update_from_api_item_before(item) for item in result]
+
+
+def make_update_from_api_item_before(item):
+    update_id = bot._get_or_raise(item, 'update_id', int, bot.TelegramApiError)
+    try:
+        message = make_message_from_api_item_before(item)
+    except ValueError:
+        message = None
+    return bot.Update(update_id=update_id, message=message)
+
+
+def is_message_before(update_item):
+    try:
+        bot._get_or_raise(update_item, 'message', dict, ValueError)
+    except ValueError:
+        return False
+    else:
+        return True
+
+
+def make_message_from_api_item_before(item):
+    if not is_message_before(item):
+        return None
+    message_item = bot._get_or_raise(item, 'message', dict, ValueError)
+    chat_item = bot._get_or_raise(message_item, 'chat', dict, ValueError)
+    if 'text' not in message_item:
+        text = ''
+    else:
+        text = bot._get_or_raise(message_item, 'text', str, ValueError)
+    if 'date' not in message_item:
+        date = None
+    else:
+        date = bot._get_or_raise(message_item, 'date', int, ValueError)
+    return bot.Message(
+        chat_id=bot._get_or_raise(chat_item, 'id', int, ValueError),
+        message_id=bot._get_or_raise(message_item, 'message_id', int, ValueError),
+        text=text,
+        date=date,
+    )
+
+
+def make_payload():
+    """Returns a response like telegram's: full user and chat objects, every tenth update is not a message."""
+    result = []
+    for update_id in range(UPDATES):
+        user = {'id': 1000 + update_id, 'is_bot': False, 'first_name': 'Some', 'last_name': 'User',
+                'username': f'user{update_id}', 'language_code': 'en'}
+        if update_id % 10 == 9:
+            result.append({'update_id': update_id, 'my_chat_member': {'chat': {'id': update_id}, 'from': user}})
+            continue
+        result.append({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'from': user,
+                'chat': {'id': 1000 + update_id, 'first_name': 'Some', 'last_name': 'User',
+                         'username': f'user{update_id}', 'type': 'private'},
+                'date': 1487418903 + update_id,
+                'text': '/show 7',
+                'entities': [{'offset': 0, 'length': 5, 'type': 'bot_command'}],
+            },
+        })
+    return json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+
+def bench(parse, data):
+    best = min(timeit.repeat(lambda: parse(data), number=NUMBER, repeat=REPETITIONS))
+    return NUMBER / best
+
+
+def main():
+    data = make_payload()
+    assert bot.parse_updates_response(data) == parse_updates_response_before(data)
+    before = bench(parse_updates_response_before, data)
+    print(f'{len(data):,} bytes, {UPDATES} updates')
+    print(f'before:         {before:,.0f} responses/s')
+    orjson = bot.orjson
+    try:
+        bot.orjson = None
+        after = bench(bot.parse_updates_response, data)
+        print(f'after, json:    {after:,.0f} responses/s ({after / before:.1f}x)')
+    finally:
+        bot.orjson = orjson
+    if orjson is not None:
+        after = bench(bot.parse_updates_response, data)
+        print(f'after, orjson:  {after:,.0f} responses/s ({after / before:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
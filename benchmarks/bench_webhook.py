@@ -0,0 +1,99 @@
+"""Load test of the webhook mode.
+
+A fake telegram posts updates to the webhook as fast as the webhook answers them,
+/show commands go to a fake github. Reports requests per second and latency percentiles.
+
+    python -m benchmarks.bench_webhook
+"""
+import asyncio
+import itertools
+import json
+import time
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from github_trending_bot import aio
+from github_trending_bot import bot
+
+REQUESTS = 5000
+CONCURRENCY = 64  # requests in flight, telegram keeps up to 100 connections to a webhook
+CHATS = 1000
+TEXTS = ('/show', '/show 1', '/show 30', '/echo some text', '/help')
+
+
+async def fake_github_search(request):
+    items = [
+        {
+            'name': f'repo-{i}',
+            'description': f'description of repo {i}',
+            'html_url': f'https://github.com/owner/repo-{i}',
+            'language': 'Python',
+            'stargazers_count': 1000 - i,
+        }
+        for i in range(bot.TRENDING_REPOSITORIES_LIMIT)
+    ]
+    return web.json_response({'items': items})
+
+
+def make_update_bodies():
+    texts = itertools.cycle(TEXTS)
+    return [
+        json.dumps({
+            'update_id': update_id,
+            'message': {'chat': {'id': update_id % CHATS}, 'message_id': update_id, 'text': next(texts)},
+        })
+        for update_id in range(REQUESTS)
+    ]
+
+
+async def post_updates(session, url, bodies, latencies):
+    for body in bodies:
+        started_at = time.perf_counter()
+        async with session.post(url, data=body, headers={'Content-Type': 'application/json'}) as response:
+            assert response.status == 200
+            await response.read()
+        latencies.append(time.perf_counter() - started_at)
+
+
+async def bench():
+    github_app = web.Application()
+    github_app.router.add_get('/search/repositories', fake_github_search)
+    async with TestServer(github_app) as github_server:
+        config = bot.Config(('some_github_token',), 'some_telegram_token',
+                            github_api_base=str(github_server.make_url('')).rstrip('/'))
+        bot._setup_github_api_base(config)
+        commands_executor = aio._get_commands_executor(config)
+        async with TestServer(aio.make_webhook_app(commands_executor)) as webhook_server:
+            url = str(webhook_server.make_url(aio.WEBHOOK_PATH))
+            bodies = make_update_bodies()
+            latencies = []
+            started_at = time.perf_counter()
+            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=CONCURRENCY)) as telegram:
+                await asyncio.gather(*[
+                    post_updates(telegram, url, bodies[i::CONCURRENCY], latencies)
+                    for i in range(CONCURRENCY)
+                ])
+            elapsed = time.perf_counter() - started_at
+    return elapsed, sorted(latencies)
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def main():
+    loop = asyncio.new_event_loop()
+    try:
+        elapsed, latencies = loop.run_until_complete(bench())
+    finally:
+        loop.close()
+    print(f'requests:    {len(latencies)} with concurrency {CONCURRENCY}')
+    print(f'throughput:  {len(latencies) / elapsed:,.0f} requests/s')
+    print(f'latency p50: {percentile(latencies, 0.5) * 1000:.1f} ms')
+    print(f'latency p99: {percentile(latencies, 0.99) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""Local stand-ins for telegram bot api and github search api that the bot can be pointed to
+with TELEGRAM_API_BASE and GITHUB_API_BASE.
+
+Both servers add `latency` seconds to every response and fail `error_rate` of requests with 500.
+The fake telegram answers 429 to messages above `send_rate` per second, like the flood limit does,
+the fake github answers 403 to searches above `search_rate_limit` per `search_rate_limit_window` seconds.
+"""
+import http.server
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+import typing as tp
+import urllib.parse as urlparse
+import zlib
+
+REPOSITORIES_PER_SEARCH = 10
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer:
+    def __init__(self, latency: float = 0, error_rate: float = 0, seed: int = 0) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FakeServer':
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like the real apis
+
+            def do_GET(self):
+                fake._handle(self)
+
+            def do_POST(self):
+                fake._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handle(self, request: http.server.BaseHTTPRequestHandler) -> None:
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+        if failed:
+            status, headers, response = 500, {}, {'ok': False, 'description': 'Internal Server Error'}
+        else:
+            status, headers, response = self.respond(request.command, request.path, body)
+        data = json.dumps(response).encode('utf-8')
+        try:
+            request.send_response(status)
+            request.send_header('Content-Type', 'application/json')
+            request.send_header('Content-Length', str(len(data)))
+            for name, value in headers.items():
+                request.send_header(name, value)
+            request.end_headers()
+            request.wfile.write(data)
+        except ConnectionError:
+            # the bot has exited in the middle of a long polling request
+            request.close_connection = True
+
+    def respond(self, method: str, path: str, body: bytes) -> tp.Tuple[int, tp.Dict[str, str], tp.Any]:
+        raise NotImplementedError
+
+
+class FakeTelegram(FakeServer):
+    """Serves updates added with `add_updates` to getUpdates and records replies to them sent with sendMessage."""
+
+    def __init__(self, latency: float = 0, error_rate: float = 0, send_rate: float = 30,
+                 max_long_polling: float = 1, seed: int = 0) -> None:
+        super().__init__(latency, error_rate, seed)
+        self.send_rate = send_rate
+        self.max_long_polling = max_long_polling
+        self.get_updates_calls = 0
+        self.flood_waits = 0
+        self.replies = []  # (chat_id, text, time)
+        self._condition = threading.Condition(self._lock)
+        self._updates = []
+        self._sent_at = []  # times of recent sendMessage calls
+
+    def add_updates(self, updates: tp.List[tp.Dict]) -> None:
+        with self._condition:
+            self._updates.extend(updates)
+            self._condition.notify_all()
+
+    def wait_for_replies(self, count: int, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while len(self.replies) < count:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    return False
+                self._condition.wait(wait)
+        return True
+
+    def respond(self, method, path, body):
+        match = re.match(r'^/bot[^/]+/(\w+)$', path)
+        if method != 'POST' or match is None:
+            return 404, {}, {'ok': False, 'description': 'Not Found'}
+        params = json.loads(body.decode('utf-8')) if body else {}
+        if match.group(1) == 'getUpdates':
+            return 200, {}, {'ok': True, 'result': self._get_updates(params)}
+        if match.group(1) == 'sendMessage':
+            return self._send_message(params)
+        return 404, {}, {'ok': False, 'description': 'Not Found'}
+
+    def _get_updates(self, params):
+        offset = params.get('offset', 0)
+        limit = params.get('limit', 100)
+        deadline = time.monotonic() + min(params.get('timeout', 0), self.max_long_polling)
+        with self._condition:
+            self.get_updates_calls += 1
+            # updates below the offset are confirmed, telegram doesn't return them again
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    break
+                self._condition.wait(wait)
+            return self._updates[:limit]
+
+    def _send_message(self, params):
+        now = time.monotonic()
+        with self._condition:
+            self._sent_at = [sent_at for sent_at in self._sent_at if sent_at > now - 1]
+            if len(self._sent_at) >= self.send_rate:
+                self.flood_waits += 1
+                return 429, {}, {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 1}}
+            self._sent_at.append(now)
+            self.replies.append((params['chat_id'], params['text'], now))
+            self._condition.notify_all()
+        return 200, {}, {'ok': True, 'result': {'message_id': len(self.replies)}}
+
+
+class FakeGithub(FakeServer):
+    """Answers searches of repositories with REPOSITORIES_PER_SEARCH made up repositories."""
+
+    def __init__(self, latency: float = 0, error_rate: float = 0, search_rate_limit: int = 30,
+                 search_rate_limit_window: float = 60, seed: int = 0) -> None:
+        super().__init__(latency, error_rate, seed)
+        self.search_rate_limit = search_rate_limit
+        self.search_rate_limit_window = search_rate_limit_window
+        self.searches = 0
+        self.rate_limited = 0
+        self._remaining = search_rate_limit
+        self._reset_at = time.time() + search_rate_limit_window
+
+    def respond(self, method, path, body):
+        parsed_url = urlparse.urlparse(path)
+        if method != 'GET' or parsed_url.path != '/search/repositories':
+            return 404, {}, {'message': 'Not Found'}
+        query = urlparse.parse_qs(parsed_url.query).get('q', [''])[0]
+        with self._lock:
+            self.searches += 1
+            now = time.time()
+            if now >= self._reset_at:
+                self._remaining = self.search_rate_limit
+                self._reset_at = now + self.search_rate_limit_window
+            headers = {
+                'X-RateLimit-Limit': str(self.search_rate_limit),
+                'X-RateLimit-Remaining': str(max(self._remaining - 1, 0)),
+                'X-RateLimit-Reset': str(int(self._reset_at)),
+            }
+            if self._remaining <= 0:
+                self.rate_limited += 1
+                return 403, headers, {'message': 'API rate limit exceeded'}
+            self._remaining -= 1
+        return 200, headers, {'items': _make_repository_items(query)}
+
+
+def _make_repository_items(query: str) -> tp.List[tp.Dict]:
+    created_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    return [
+        {
+            'name': f'repo-{i}',
+            'description': f'description of repo {i} for {query}',
+            'html_url': f'https://github.com/owner/repo-{zlib.crc32(query.encode("utf-8")) % 1000}-{i}',
+            'language': 'Python',
+            'stargazers_count': 1000 - i,
+            'created_at': created_at,
+        }
+        for i in range(REPOSITORIES_PER_SEARCH)
+    ]
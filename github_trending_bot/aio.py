@@ -0,0 +1,471 @@
+"""Asyncio runtime of the bot.
+
+Requires aiohttp: `pip install github_trending_bot[async]`.
+"""
+import asyncio
+import collections
+import json
+import logging
+import os
+import sys
+import time
+import typing as tp
+from concurrent import futures
+
+import aiohttp
+from aiohttp import web
+
+from github_trending_bot import bot
+
+DEFAULT_MAX_PENDING_BATCHES = 16  # batches of updates being handled while the next one is polled
+PENDING_POLL_INTERVAL = 1  # seconds between polls that return only updates being handled
+DEFAULT_WEBHOOK_HOST = '0.0.0.0'
+DEFAULT_WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+_AIOHTTP_EXCEPTIONS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class AsyncTelegramApi:
+    def __init__(self, token: str, session: aiohttp.ClientSession,
+                 socket_timeout: int = bot.DEFAULT_TELEGRAM_API_SOCKET_TIMEOUT,
+                 api_base: str = bot.TELEGRAM_API_BASE) -> None:
+        self.token = token
+        self.session = session
+        self.socket_timeout = socket_timeout
+        self._timeout = aiohttp.ClientTimeout(total=socket_timeout)
+        self.api_base = api_base
+
+    async def send_message(self, chat_id: int, text: str, parse_mode: str = '', disable_web_page_preview: bool = False,
+                           disable_notification: bool = False) -> None:
+        """
+        :raises TelegramApiError:
+        """
+        if not text:
+            return
+        url = self._get_method_url('sendMessage')
+        params = bot._get_send_message_params(
+            chat_id, text, parse_mode, disable_web_page_preview, disable_notification)
+        logging.info('sending message to chat_id %s with params %r ...', chat_id, params)
+        with bot._convert_exceptions(_AIOHTTP_EXCEPTIONS, bot.TelegramApiError):
+            async with self.session.post(url, json=params, timeout=self._timeout) as response:
+                if response.status == 429:
+                    text = await response.text()
+                    raise bot.TelegramRetryAfter(bot._get_retry_after(_parse_json_or_none(text)))
+                response.raise_for_status()
+        logging.info('sent message to chat_id %s with params %r', chat_id, params)
+
+    async def get_updates(self, offset: int, limit: int, timeout: int) -> tp.List[bot.Update]:
+        """
+        :raises TelegramApiError:
+        """
+        url = self._get_method_url('getUpdates')
+        params = dict(
+            offset=offset,
+            timeout=timeout,
+            limit=limit,
+        )
+        logging.info('getting updates from telegram ...')
+        with bot._convert_exceptions(_AIOHTTP_EXCEPTIONS, bot.TelegramApiError):
+            async with self.session.post(url, json=params, timeout=self._timeout) as response:
+                response.raise_for_status()
+                data = await response.read()
+        logging.debug('got response %r', data)
+        updates = bot.parse_updates_response(data)
+        logging.info('got %d updates from telegram', len(updates))
+        return updates
+
+    async def set_webhook(self, url: str, secret_token: tp.Optional[str] = None) -> None:
+        """
+        :raises TelegramApiError:
+        """
+        params = {'url': url}
+        if secret_token is not None:
+            params['secret_token'] = secret_token
+        logging.info('setting webhook to %r ...', url)
+        with bot._convert_exceptions(_AIOHTTP_EXCEPTIONS, bot.TelegramApiError):
+            async with self.session.post(self._get_method_url('setWebhook'), json=params,
+                                         timeout=self._timeout) as response:
+                response.raise_for_status()
+        logging.info('set webhook to %r', url)
+
+    def _get_method_url(self, method_name: str) -> str:
+        return bot._get_telegram_method_url(self.api_base, self.token, method_name)
+
+
+def _parse_json_or_none(text: str):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+class AsyncGithubShowCommand(bot.GithubShowCommand):
+    """`bot.GithubShowCommand` that doesn't block the event loop.
+
+    Results come from the same `bot.trending_cache`, token pool and rate limiters as in the threaded modes,
+    so they scale with the number of tokens and are shared by all modes. Their github requests block,
+    so the command runs in the default executor.
+    There's no aiohttp github client on purpose: the cache, single-flight, rate limiters, conditional requests
+    and concurrent pages are thread-based, an async copy of them would split the quota and the cache
+    between the modes. Concurrent /show commands mostly wait for the same few searches, which are made once,
+    and the rate limit, not the threads, caps the number of distinct searches.
+    """
+
+    async def __call__(self, args):
+        """
+        :raises GithubApiError:
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, super().__call__, args)
+
+
+class AsyncSender:
+    """Sends messages within the telegram flood limits, the asynchronous counterpart of `bot.SendQueue`.
+
+    A message is sent in the calling coroutine once it fits into at most `global_rate` messages per second
+    and `chat_rate` messages per second to the same chat. A message that exceeds the flood limit anyway
+    is sent again after `retry_after` seconds that telegram asks for, a message that fails otherwise
+    is sent again `max_attempts` times at most.
+    """
+
+    def __init__(self, telegram_api: AsyncTelegramApi, global_rate: float = bot.TELEGRAM_GLOBAL_SEND_RATE,
+                 chat_rate: float = bot.TELEGRAM_CHAT_SEND_RATE, max_attempts: int = bot.SEND_MAX_ATTEMPTS,
+                 retry_interval: float = bot.SEND_RETRY_INTERVAL, max_chat_buckets: int = bot.SEND_QUEUE_MAXSIZE,
+                 timer: tp.Callable[[], float] = time.monotonic) -> None:
+        self.telegram_api = telegram_api
+        self.chat_rate = chat_rate
+        self.max_attempts = max_attempts
+        self.retry_interval = retry_interval
+        self.max_chat_buckets = max_chat_buckets
+        self.timer = timer
+        self.stats = bot.SendQueueStats()
+        self._global_bucket = bot.TokenBucket(global_rate, timer=timer)
+        self._chat_buckets = {}
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> None:
+        """Takes the same arguments as `AsyncTelegramApi.send_message`, failures are logged."""
+        if not text:
+            return
+        attempts = 0
+        while True:
+            await self._wait_for_turn(chat_id)
+            attempts += 1
+            try:
+                await self.telegram_api.send_message(chat_id=chat_id, text=text, **kwargs)
+            except bot.TelegramRetryAfter as exc:
+                logging.warning('could not send message to chat_id %s: %s', chat_id, exc)
+                self.stats.incr('flood_waits')
+                self._get_chat_bucket(chat_id).pause(exc.retry_after)
+            except bot.TelegramApiError:
+                if attempts >= self.max_attempts:
+                    logging.error('could not send message to chat_id %s, dropping it', chat_id, exc_info=True)
+                    self.stats.incr('failed')
+                    return
+                logging.warning('could not send message to chat_id %s, retrying ...', chat_id, exc_info=True)
+                self.stats.incr('retries')
+                self._get_chat_bucket(chat_id).pause(self.retry_interval)
+            else:
+                self.stats.incr('sent')
+                return
+
+    async def _wait_for_turn(self, chat_id: int) -> None:
+        chat_bucket = self._get_chat_bucket(chat_id)
+        while True:
+            delay = max(chat_bucket.get_delay(), self._global_bucket.get_delay())
+            if not delay:
+                chat_bucket.take()
+                self._global_bucket.take()
+                return
+            await asyncio.sleep(delay)
+
+    def _get_chat_bucket(self, chat_id: int) -> bot.TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_chat_buckets:
+                # chats that could send right now anyway don't need their buckets
+                self._chat_buckets = {
+                    other_chat_id: other_bucket
+                    for other_chat_id, other_bucket in self._chat_buckets.items()
+                    if not other_bucket.is_full()
+                }
+            bucket = self._chat_buckets[chat_id] = bot.TokenBucket(self.chat_rate, timer=self.timer)
+        return bucket
+
+
+class ChatSerializer:
+    """Runs coroutines concurrently, except that coroutines of the same chat run one after another."""
+
+    def __init__(self) -> None:
+        self._last_task_by_chat_id = {}
+
+    def submit(self, chat_id: tp.Optional[int], coro_func: tp.Callable[[], tp.Awaitable]) -> asyncio.Future:
+        previous_task = self._last_task_by_chat_id.get(chat_id)
+        task = asyncio.ensure_future(self._run_after(previous_task, coro_func))
+        self._last_task_by_chat_id[chat_id] = task
+        task.add_done_callback(lambda _: self._forget(chat_id, task))
+        return task
+
+    async def _run_after(self, previous_task: tp.Optional[asyncio.Future], coro_func):
+        if previous_task is not None:
+            await asyncio.wait([previous_task])
+        return await coro_func()
+
+    def _forget(self, chat_id, task):
+        if self._last_task_by_chat_id.get(chat_id) is task:
+            del self._last_task_by_chat_id[chat_id]
+
+
+async def async_main(offset_state=None, max_pending_batches: int = DEFAULT_MAX_PENDING_BATCHES):
+    """Asynchronous counterpart of `bot.main`.
+
+    The next batch of updates is polled while the previous ones are still being handled,
+    at most `max_pending_batches` batches are handled at the same time.
+    `offset_state` moves forward only past the batches that have been completely handled.
+    Telegram forgets the updates before the offset of a poll, so polls start at `offset_state`
+    and skip the updates that come again because they are still being handled.
+    """
+    bot._configure_logging()
+    config = bot._get_config_or_exit(os.environ)
+    _setup_default_executor(config)
+    offset_state = bot._setup_state_or_exit(config, offset_state)
+    bot._setup_github_api_base(config)
+    commands_executor = _get_commands_executor_and_start_prewarmer(config)
+    updates_stats = bot.UpdatesStats()
+    metrics_server = bot._start_metrics_server(config, updates_stats=updates_stats)
+    async with aiohttp.ClientSession() as session:
+        telegram_api = AsyncTelegramApi(config.telegram_token, session, api_base=config.telegram_api_base)
+        try:
+            await _run_polling_loop(offset_state, telegram_api, commands_executor, max_pending_batches,
+                                    updates_stats=updates_stats)
+        finally:
+            bot._flush_offset_state(offset_state)
+            if metrics_server is not None:
+                metrics_server.shutdown()
+
+
+async def _run_polling_loop(offset_state, telegram_api: AsyncTelegramApi, commands_executor: bot.CommandsExecutor,
+                            max_pending_batches: int, sender: tp.Optional[AsyncSender] = None,
+                            updates_stats: tp.Optional[bot.UpdatesStats] = None) -> None:
+    sender = AsyncSender(telegram_api) if sender is None else sender
+    updates_stats = bot.UpdatesStats() if updates_stats is None else updates_stats
+    chat_serializer = ChatSerializer()
+    updates_limit = bot.AdaptiveUpdatesLimit()
+    pending_batches = collections.deque()  # (task, next offset, number of updates)
+    next_offset = offset_state.offset
+    while True:
+        while pending_batches and (pending_batches[0][0].done() or len(pending_batches) >= max_pending_batches
+                                   or _count_pending_updates(pending_batches) >= bot.TELEGRAM_MAX_UPDATES_LIMIT):
+            batch_task, batch_next_offset, _ = pending_batches.popleft()
+            await batch_task
+            offset_state.offset = batch_next_offset
+        pending_updates = _count_pending_updates(pending_batches)
+        try:
+            updates = await telegram_api.get_updates(
+                offset=offset_state.offset,
+                limit=min(updates_limit.value + pending_updates, bot.TELEGRAM_MAX_UPDATES_LIMIT),
+                timeout=bot.DEFAULT_TELEGRAM_API_LONG_POLLING_TIMEOUT,
+            )
+        except bot.TelegramApiError:
+            bot.polls.inc('error')
+            logging.error('could not get updates from telegram, sleeping 10 seconds ...', exc_info=True)
+            await asyncio.sleep(10)
+            continue
+        bot.polls.inc('ok')
+        updates = [update for update in updates if update.update_id >= next_offset]
+        updates_stats.record_batch(updates, updates_limit.value)
+        updates_limit.update(len(updates))
+        if not updates:
+            if pending_batches:
+                # telegram answers at once while there are unconfirmed updates, so polls don't spin
+                await asyncio.wait([pending_batches[0][0]], timeout=PENDING_POLL_INTERVAL)
+            continue
+        next_offset = max(update.update_id for update in updates) + 1
+        batch_task = asyncio.gather(*[
+            chat_serializer.submit(
+                None if update.message is None else update.message.chat_id,
+                lambda update=update: _handle_update(update, sender, commands_executor),
+            )
+            for update in updates
+        ])
+        pending_batches.append((batch_task, next_offset, len(updates)))
+
+
+def _count_pending_updates(pending_batches: tp.Iterable[tp.Tuple[asyncio.Future, int, int]]) -> int:
+    return sum(size for _, _, size in pending_batches)
+
+
+async def _handle_update(update: bot.Update, sender: AsyncSender, commands_executor: bot.CommandsExecutor) -> None:
+    if update.message is None:
+        logging.info('update %r has no message', update.update_id)
+        return
+    with bot.update_duration.time():
+        message_text = await _get_reply_text(update, commands_executor)
+    await sender.send_message(
+        chat_id=update.message.chat_id,
+        text=message_text,
+        parse_mode='HTML',
+        disable_web_page_preview=True,
+        disable_notification=True,
+    )
+
+
+async def _get_reply_text(update: bot.Update, commands_executor: bot.CommandsExecutor) -> str:
+    parsed_message = bot._get_parsed_message(update)
+    try:
+        return await commands_executor.execute_async(parsed_message)
+    except bot.InvalidCommand as exc:
+        return str(exc)
+    except bot.Error:
+        logging.error(f'got an error when executing {parsed_message!r}', exc_info=True)
+        return bot.ERROR_REPLY_TEXT
+
+
+class WebhookConfig:
+    def __init__(self, host: str = DEFAULT_WEBHOOK_HOST, port: int = DEFAULT_WEBHOOK_PORT,
+                 url: tp.Optional[str] = None, secret_token: tp.Optional[str] = None) -> None:
+        self.host = host
+        self.port = port
+        self.url = url  # public url of the webhook that is registered in telegram, kept as is when None
+        self.secret_token = secret_token
+
+
+def get_webhook_config(environment: tp.Mapping[str, str]) -> WebhookConfig:
+    """
+    :raises InvalidConfig: When 'WEBHOOK_PORT' is not a positive integer.
+    """
+    return WebhookConfig(
+        host=environment.get('WEBHOOK_HOST', DEFAULT_WEBHOOK_HOST),
+        port=bot._get_positive_int_or_invalid_config(environment, 'WEBHOOK_PORT', DEFAULT_WEBHOOK_PORT),
+        url=environment.get('WEBHOOK_URL'),
+        secret_token=environment.get('WEBHOOK_SECRET_TOKEN'),
+    )
+
+
+class WebhookHandler:
+    """Handles updates that telegram posts to the webhook.
+
+    The reply goes back in the response as a sendMessage call, so it takes no extra request to telegram.
+    Updates of the same chat are handled one after another, like in the polling mode.
+    """
+
+    def __init__(self, commands_executor: bot.CommandsExecutor, secret_token: tp.Optional[str] = None) -> None:
+        self.commands_executor = commands_executor
+        self.secret_token = secret_token
+        self._chat_serializer = ChatSerializer()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret_token is not None and request.headers.get(WEBHOOK_SECRET_TOKEN_HEADER) != self.secret_token:
+            return web.Response(status=403)
+        try:
+            update = _make_update_from_webhook_body(await request.read())
+        except bot.TelegramApiError:
+            logging.error('got an invalid update', exc_info=True)
+            return web.Response(status=400)
+        if update.message is None:
+            logging.info('update %r has no message', update.update_id)
+            return web.Response()
+        with bot.update_duration.time():
+            message_text = await self._chat_serializer.submit(
+                update.message.chat_id,
+                lambda: _get_reply_text(update, self.commands_executor),
+            )
+        if not message_text:
+            return web.Response()
+        params = bot._get_send_message_params(
+            chat_id=update.message.chat_id,
+            text=message_text,
+            parse_mode='HTML',
+            disable_web_page_preview=True,
+            disable_notification=True,
+        )
+        params['method'] = 'sendMessage'
+        return web.json_response(params)
+
+
+def _make_update_from_webhook_body(data: bytes) -> bot.Update:
+    """
+    :raises TelegramApiError:
+    """
+    try:
+        item = bot.loads_json(data)
+    except ValueError as exc:
+        raise bot.TelegramApiError(f"can't convert {data[:1000]!r} to json") from exc
+    return bot._make_update_from_api_item(item)
+
+
+def make_webhook_app(commands_executor: bot.CommandsExecutor, secret_token: tp.Optional[str] = None,
+                     path: str = WEBHOOK_PATH) -> web.Application:
+    app = web.Application()
+    app.router.add_post(path, WebhookHandler(commands_executor, secret_token).handle)
+    return app
+
+
+async def async_webhook_main() -> None:
+    """Runs the bot as a webhook instead of polling telegram for updates."""
+    bot._configure_logging()
+    config = bot._get_config_or_exit(os.environ)
+    try:
+        webhook_config = get_webhook_config(os.environ)
+    except bot.InvalidConfig as exc:
+        logging.error('invalid config: %s', exc)
+        sys.exit(1)
+    _setup_default_executor(config)
+    bot._setup_trending_store_or_exit(config)
+    bot._setup_github_api_base(config)
+    commands_executor = _get_commands_executor_and_start_prewarmer(config)
+    metrics_server = bot._start_metrics_server(config)
+    async with aiohttp.ClientSession() as session:
+        if webhook_config.url is not None:
+            telegram_api = AsyncTelegramApi(config.telegram_token, session, api_base=config.telegram_api_base)
+            await telegram_api.set_webhook(webhook_config.url, webhook_config.secret_token)
+        runner = web.AppRunner(make_webhook_app(commands_executor, webhook_config.secret_token))
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, webhook_config.host, webhook_config.port).start()
+            logging.info('listening for updates on %s:%d', webhook_config.host, webhook_config.port)
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            if metrics_server is not None:
+                metrics_server.shutdown()
+
+
+def _get_commands_executor(config: bot.Config,
+                           popularity: tp.Optional[bot.PopularityTracker] = None) -> bot.CommandsExecutor:
+    # synchronous commands run in the default executor, see `_setup_default_executor`,
+    # but commands waiting for their turn don't take its threads, so more of them can wait than in threads
+    admission_control = bot.AdmissionControl(max_concurrent=bot._get_expensive_commands_concurrency(config.workers))
+    commands_executor = bot._get_commands_executor(config, admission_control=admission_control)
+    commands_executor.commands_by_name[bot.SHOW_COMMAND] = AsyncGithubShowCommand(
+        config.github_tokens, popularity=popularity)
+    return commands_executor
+
+
+def _setup_default_executor(config: bot.Config) -> None:
+    """Runs synchronous commands, e.g. `/show` with its github requests, on `config.workers` threads."""
+    asyncio.get_event_loop().set_default_executor(futures.ThreadPoolExecutor(max_workers=config.workers))
+
+
+def _get_commands_executor_and_start_prewarmer(config: bot.Config) -> bot.CommandsExecutor:
+    popularity = bot.PopularityTracker()
+    commands_executor = _get_commands_executor(config, popularity)
+    bot.TrendingPrewarmer(config.github_tokens, config.prewarm_ages_in_days, popularity).start()
+    return commands_executor
+
+
+def main():
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(async_main())
+    finally:
+        loop.close()
+
+
+def webhook_main():
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(async_webhook_main())
+    finally:
+        loop.close()
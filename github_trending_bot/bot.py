@@ -1,38 +1,150 @@
+import asyncio
+import collections
 import datetime as dt
+import functools
 import html
+import inspect
+import json
 import logging
+import math
 import os
 import sys
+import threading
 import time
 import typing as tp
 import urllib.parse as urlparse
+from concurrent import futures
 from contextlib import contextmanager
 
-from cachetools.func import ttl_cache
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from github_trending_bot import metrics
+from github_trending_bot import state
+
+try:
+    import orjson
+except ImportError:  # optional, `pip install github_trending_bot[fast]`
+    orjson = None
 
 HELP_COMMAND = '/help'
 START_COMMAND = '/start'
 SHOW_COMMAND = '/show'
 ECHO_COMMAND = '/echo'
 TIMESTAMP_COMMAND = '/timestamp'
+SUBSCRIBE_COMMAND = '/subscribe'
+UNSUBSCRIBE_COMMAND = '/unsubscribe'
 
 OFFSET_PATH = '/var/lib/github_trending_bot/last_update'
+OFFSET_FLUSH_INTERVAL = 10  # seconds
+OFFSET_FLUSH_EVERY = 20  # offset updates
+OFFSET_STATE_KEY = 'offset'
+TRENDING_STATE_KEY_PREFIX = 'trending:'
 
 GITHUB_API_BASE = 'https://api.github.com'
 DEFAULT_GITHUB_API_SOCKET_TIMEOUT = 5  # seconds
+GITHUB_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 GITHUB_CACHE_TTL = 600  # seconds
+GITHUB_CACHE_STALE_TTL = 3600  # seconds after GITHUB_CACHE_TTL when a stale result is still served
+GITHUB_CACHE_MAXSIZE = 128  # items
+GITHUB_SEARCH_RATE_LIMIT = 30  # requests per GITHUB_SEARCH_RATE_LIMIT_WINDOW
+GITHUB_SEARCH_RATE_LIMIT_WINDOW = 60  # seconds
+GITHUB_RATE_LIMIT_RESERVE = 5  # requests that deferrable requests leave to the others
+GITHUB_RATE_LIMIT_MAX_WAIT = 3  # seconds a request waits for the rate limit to reset
+GITHUB_SEARCH_PAGE_SIZE = 100  # items in a page, the maximum that github allows
+GITHUB_SEARCH_MAX_RESULTS = 1000  # github returns no more results of a search
+SEARCH_PAGES_CONCURRENCY = 4  # pages of a search requested at the same time
+CONDITIONAL_CACHE_MAXSIZE = 256  # searches whose validators and results are kept for conditional requests
 DEFAULT_AGE_IN_DAYS = 7
-
+MAX_AGE_IN_DAYS = 10000  # github is younger, and much greater ages overflow datetime
+TRENDING_REPOSITORIES_LIMIT = 10  # items in a reply
+DAY_BUCKETS_MAX_AGE_IN_DAYS = 14  # windows up to this age are merged from per-day results
+DAY_BUCKETS_WORKERS = 4  # threads fetching per-day results
+WINDOW_START_STEP = GITHUB_CACHE_TTL  # seconds the start of a merged window is rounded down to
+DEFAULT_PREWARM_AGES_IN_DAYS = (1, DEFAULT_AGE_IN_DAYS, 30, 365)
+PREWARM_TOP_REQUESTED = 5  # most requested ages in days that are prewarmed in addition to the configured ones
+PREWARM_HISTORY_SIZE = 1000  # recent requests used to find the most requested ages in days
+PREWARM_INTERVAL = GITHUB_CACHE_TTL * 0.8  # seconds, so that prewarmed results never expire
+CORPUS_MAX_AGE_IN_DAYS = 30  # repositories created in the last days that /show filters by language
+CORPUS_SIZE = GITHUB_SEARCH_MAX_RESULTS  # most starred repositories in the corpus
+CORPUS_CACHE_KEY = 'corpus'
+
+DEFAULT_POOL_CONNECTIONS = 2  # hosts with a pool of keep-alive connections
+DEFAULT_POOL_MAXSIZE = 10  # keep-alive connections per host
+DEFAULT_MAX_RETRIES = 2  # retries of failed connections and 502/503/504 responses
+
+TELEGRAM_API_BASE = 'https://api.telegram.org'
 DEFAULT_TELEGRAM_API_SOCKET_TIMEOUT = 70  # seconds
 DEFAULT_TELEGRAM_API_LONG_POLLING_TIMEOUT = 60  # seconds
 TELEGRAM_UPDATES_LIMIT = 5  # items in an array
+TELEGRAM_MAX_UPDATES_LIMIT = 100  # items in an array, telegram doesn't return more
+DEFAULT_WORKERS = 4  # threads handling updates
+TELEGRAM_GLOBAL_SEND_RATE = 30  # messages per second to all chats, telegram answers 429 to more
+TELEGRAM_CHAT_SEND_RATE = 1  # messages per second to the same chat
+SEND_QUEUE_MAXSIZE = 1000  # messages waiting to be sent, more messages wait for a free place
+SEND_QUEUE_WORKERS = 4  # threads sending messages
+SEND_MAX_ATTEMPTS = 3  # attempts to send a message that fails with other errors than 429
+SEND_RETRY_INTERVAL = 1  # seconds before sending a failed message to the same chat again
+SEND_QUEUE_CLOSE_TIMEOUT = 10  # seconds to send the queued messages on exit
+SUBSCRIPTIONS_STATE_KEY = 'subscriptions'
+DIGEST_STATE_KEY_PREFIX = 'digest:'
+DIGEST_SCHEDULES = collections.OrderedDict([('daily', 1), ('weekly', 7)])  # schedule -> default DAYS
+DIGEST_HOUR = 9  # UTC hour when digests are sent, weekly ones on mondays
+DIGEST_CHECK_INTERVAL = 60  # seconds between checks for due digests
+DIGEST_BATCH_SIZE = 100  # messages sent between saves of the progress of a digest
+DIGEST_SEND_RATE = 20  # messages per second, the rest of TELEGRAM_GLOBAL_SEND_RATE is left to replies
+DIGEST_BATCH_TIMEOUT = 600  # seconds a batch of a digest is sent in before a warning
+DIGEST_PROGRESS_TTL = 8 * 24 * 3600  # seconds, longer than the period of the longest schedule
 HELP_TEXT = '\n\n'.join([
-    f'{SHOW_COMMAND} [DAYS] - show trending repositories created in the last DAYS',
+    f'{SHOW_COMMAND} [DAYS] [LANGUAGE] - show trending repositories created in the last DAYS, '
+    f'LANGUAGE works for up to {CORPUS_MAX_AGE_IN_DAYS} days',
     f'{TIMESTAMP_COMMAND} [%Y-%m-%dT%H:%M:%S] - convert UTC date string to Unix timestamp',
 ])
+SUBSCRIPTIONS_HELP_TEXT = '\n\n'.join([
+    f'{SUBSCRIBE_COMMAND} daily|weekly [DAYS] - get trending repositories created in the last DAYS '
+    f'every day or every monday',
+    f'{UNSUBSCRIBE_COMMAND} - stop getting trending repositories',
+])  # added to HELP_TEXT where subscriptions are available
 
 STAR_SYMBOL = '\u2605'
+HTML_MESSAGE_CACHE_MAXSIZE = 256  # rendered messages
+REPO_HTML_CACHE_MAXSIZE = 4096  # rendered repositories
+ERROR_REPLY_TEXT = 'oops, something went wrong'
+DEFAULT_METRICS_HOST = '127.0.0.1'
+COMMAND_CHAT_RATE = 0.5  # commands per second of the same chat
+COMMAND_CHAT_BURST = 5  # commands of the same chat in a row before COMMAND_CHAT_RATE applies
+COMMAND_CHAT_BUCKETS_MAXSIZE = 10000  # chats whose rate is tracked, the least recent ones start over
+EXPENSIVE_COMMANDS_CONCURRENCY = 8  # expensive commands, e.g. /show, executed at the same time by default
+EXPENSIVE_COMMANDS_MAX_WAITING = 32  # expensive commands waiting for their turn in the asyncio modes
+EXPENSIVE_COMMANDS_WORKERS_SHARE = 0.5  # of WORKERS that execute expensive commands in the threaded modes
+EXPENSIVE_COMMANDS_MAX_WAIT = 10  # seconds an expensive command waits for its turn
+RATE_LIMITED_REPLY_TEXT = 'too many commands, try again in a few seconds'
+OVERLOADED_REPLY_TEXT = 'too busy right now, try again in a minute'
+
+# Metrics are no-ops until `metrics.registry` is enabled, see `_start_metrics_server`.
+command_duration = metrics.registry.histogram(
+    'command_duration_seconds', 'Time of executing commands.', ['command'])
+command_errors = metrics.registry.counter(
+    'command_errors_total', 'Commands that failed, by the class of the error.', ['command', 'error'])
+commands_rejected = metrics.registry.counter(
+    'commands_rejected_total', 'Commands rejected by admission control, by the reason.', ['reason'])
+expensive_commands_running = metrics.registry.gauge(
+    'expensive_commands_running', 'Expensive commands being executed.')
+expensive_commands_waiting = metrics.registry.gauge(
+    'expensive_commands_waiting', 'Expensive commands waiting for their turn.')
+update_duration = metrics.registry.histogram(
+    'update_duration_seconds', 'Time from taking an update to queueing its reply.')
+polls = metrics.registry.counter('polls_total', 'Calls of getUpdates by the result.', ['result'])
+github_request_duration = metrics.registry.histogram(
+    'github_request_duration_seconds', 'Time of requests to github search api.')
+github_responses = metrics.registry.counter(
+    'github_responses_total', 'Responses of github search api by the status code.', ['status'])
+telegram_request_duration = metrics.registry.histogram(
+    'telegram_request_duration_seconds', 'Time of requests to telegram bot api, getUpdates includes long polling.',
+    ['method'])
+telegram_responses = metrics.registry.counter(
+    'telegram_responses_total', 'Responses of telegram bot api by the status code.', ['method', 'status'])
 
 
 class Error(Exception):
@@ -51,10 +163,24 @@ class GithubApiError(ApiError):
     pass
 
 
+class GithubRateLimitExceeded(GithubApiError):
+    pass
+
+
+class GithubTokenRevoked(GithubApiError):
+    pass
+
+
 class TelegramApiError(ApiError):
     pass
 
 
+class TelegramRetryAfter(TelegramApiError):
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f'flood limit is exceeded, retry after {retry_after} seconds')
+        self.retry_after = retry_after
+
+
 class InvalidCommand(Error):
     pass
 
@@ -63,69 +189,513 @@ class ParseError(InvalidCommand):
     pass
 
 
-class Config:
-    def __init__(self, github_token: str, telegram_token: str):
-        self.github_token = github_token
-        self.telegram_token = telegram_token
+class CommandRejected(InvalidCommand):
+    """A command was not executed to keep the bot responsive, its text is the reply."""
+
+
+class StateError(Error):
+    pass
+
+
+GithubTokens = tp.Union[str, tp.Tuple[str, ...]]
+
+
+class Config(tp.NamedTuple):
+    github_tokens: tp.Tuple[str, ...]
+    telegram_token: str
+    workers: int = DEFAULT_WORKERS
+    prewarm_ages_in_days: tp.Tuple[int, ...] = DEFAULT_PREWARM_AGES_IN_DAYS
+    state_url: tp.Optional[str] = None  # see `state.open_state_backend`, offset file and in-memory cache when None
+    metrics_port: tp.Optional[int] = None  # port of the /metrics endpoint, metrics are disabled when None
+    github_api_base: str = GITHUB_API_BASE
+    telegram_api_base: str = TELEGRAM_API_BASE  # e.g. a local bot api server
+
+    @property
+    def github_token(self) -> str:
+        return self.github_tokens[0]
+
+
+# Models are named tuples: they have no per-instance __dict__, are immutable and hashable,
+# and compare and print by their fields.
+
+class Message(tp.NamedTuple):
+    chat_id: int
+    message_id: int
+    text: str
+    date: tp.Optional[int] = None  # unix timestamp
+
+
+class Update(tp.NamedTuple):
+    update_id: int
+    message: tp.Optional[Message]
+
+
+class Repo(tp.NamedTuple):
+    name: str
+    description: str
+    html_url: str
+    language: tp.Optional[str]
+    stargazers_count: int
+    created_at: tp.Optional[dt.datetime] = None  # naive UTC
+
+    def dump(self) -> tp.List:
+        """Returns a json-serializable list of fields, `Repo.load` converts it back."""
+        created_at = None if self.created_at is None else self.created_at.strftime(GITHUB_DATETIME_FORMAT)
+        return [self.name, self.description, self.html_url, self.language, self.stargazers_count, created_at]
+
+    @classmethod
+    def load(cls, dumped: tp.List) -> 'Repo':
+        """
+        :raises ValueError: When `dumped` was not returned by `Repo.dump`.
+        """
+        name, description, html_url, language, stargazers_count, created_at = dumped
+        if created_at is not None:
+            created_at = dt.datetime.strptime(created_at, GITHUB_DATETIME_FORMAT)
+        return cls(name, description, html_url, language, stargazers_count, created_at)
 
 
-class Message:
-    def __init__(self, chat_id: int, message_id: int, text: str):
-        self.chat_id = chat_id
-        self.message_id = message_id
-        self.text = text
+class ParsedMessage(tp.NamedTuple):
+    name: str
+    args: tp.Tuple[str, ...]
+    chat_id: tp.Optional[int] = None  # passed to commands that have `takes_chat_id`
 
 
-class Update:
-    def __init__(self, update_id: int, message: Message):
-        self.update_id = update_id
-        self.message = message
+class Subscription(tp.NamedTuple):
+    chat_id: int
+    schedule: str  # one of DIGEST_SCHEDULES
+    age_in_days: int
 
 
-class Repo:
-    def __init__(self, name: str, description: str, html_url: str, language: tp.Optional[str], stargazers_count: int):
-        self.name = name
-        self.description = description
-        self.html_url = html_url
-        self.language = language
-        self.stargazers_count = stargazers_count
+class Stats:
+    """Thread-safe set of numeric metrics, subclasses list their names in `fields`.
+
+    Fields that only ever grow are listed in `counters` too, so that they are exposed as counters.
+    """
+    fields = ()
+    counters = ()
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._values = dict.fromkeys(self.fields, 0)
+
+    def __getitem__(self, name: str):
+        return self._values[name]
+
+    def incr(self, name: str, value=1) -> None:
+        with self._lock:
+            self._values[name] += value
+
+    def set(self, name: str, value) -> None:
+        with self._lock:
+            self._values[name] = value
+
+    def set_max(self, name: str, value) -> None:
+        with self._lock:
+            self._values[name] = max(self._values[name], value)
+
+    def as_dict(self) -> tp.Dict[str, tp.Any]:
+        with self._lock:
+            return dict(self._values)
 
 
-class ParsedMessage:
-    def __init__(self, name, args):
-        self.name = name
-        self.args = args
+class SingleFlightStats(Stats):
+    fields = ('calls', 'coalesced')
+    counters = fields
 
-    def __repr__(self):
-        return f'ParsedMessage(name={self.name!r}, args={self.args!r})'
+
+class SingleFlight:
+    """Runs at most one call per key at the same time.
+
+    Callers that come while a call with the same key is in flight wait for it
+    and share its result or its error.
+    """
+
+    def __init__(self) -> None:
+        self.stats = SingleFlightStats()
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> future of the call in flight
+
+    def is_running(self, key: tp.Hashable) -> bool:
+        with self._lock:
+            return key in self._calls
+
+    def do(self, key: tp.Hashable, func: tp.Callable[[], tp.Any]):
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._calls[key] = futures.Future()
+        if not is_leader:
+            self.stats.incr('coalesced')
+            return future.result()
+        self.stats.incr('calls')
+        try:
+            result = func()
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
 
 
 class CommandsExecutor:
-    def __init__(self, commands_by_name: tp.Mapping) -> None:
+    """Runs commands by name.
+
+    A command is a callable that takes a list of arguments and returns a text of the reply.
+    It can be either a regular function or a coroutine function.
+    Commands with a true `takes_chat_id` attribute take the chat_id of the message too.
+    With `admission_control` messages of chats that send too many commands are rejected,
+    and so are commands with a true `expensive` attribute when too many of them are executed already.
+    An expensive command can tell by its args whether it's expensive after all with a `get_expensive_key` method,
+    see `GithubShowCommand.get_expensive_key`.
+    """
+
+    def __init__(self, commands_by_name: tp.Mapping,
+                 admission_control: tp.Optional['AdmissionControl'] = None) -> None:
         self.commands_by_name = commands_by_name
+        self.admission_control = admission_control
 
     def execute(self, parsed_message: ParsedMessage) -> str:
+        """
+        :raises CommandRejected:
+        """
+        self._admit_chat(parsed_message)
+        command = self._get_command(parsed_message)
+        # rejected commands are counted by `AdmissionControl`, only executed ones are recorded
+        with self._get_turn(command, parsed_message), _record_command_metrics(parsed_message.name):
+            result = command(*_get_command_args(command, parsed_message))
+            if inspect.isawaitable(result):
+                result = _run_until_complete(result)
+        return result
+
+    async def execute_async(self, parsed_message: ParsedMessage) -> str:
+        """
+        :raises CommandRejected:
+        """
+        self._admit_chat(parsed_message)
+        command = self._get_command(parsed_message)
+        turn_key = self._get_turn_key(command, parsed_message)
+        loop = asyncio.get_event_loop()
+        if turn_key is not _NO_TURN_KEY:
+            await self.admission_control.acquire_async(turn_key)
         try:
-            command = self.commands_by_name[parsed_message.name]
+            with _record_command_metrics(parsed_message.name):
+                if _is_coroutine_function(command):
+                    return await command(*_get_command_args(command, parsed_message))
+                # synchronous commands can block (e.g. on a github request), so they don't run in the event loop
+                result = await loop.run_in_executor(None, command, *_get_command_args(command, parsed_message))
+                if inspect.isawaitable(result):
+                    result = await result
+        finally:
+            if turn_key is not _NO_TURN_KEY:
+                self.admission_control.release(turn_key)
+        return result
+
+    def _admit_chat(self, parsed_message: ParsedMessage) -> None:
+        if self.admission_control is not None and parsed_message.chat_id is not None:
+            self.admission_control.admit_chat(parsed_message.chat_id)
+
+    def _get_turn(self, command: tp.Callable, parsed_message: ParsedMessage) -> tp.ContextManager:
+        turn_key = self._get_turn_key(command, parsed_message)
+        if turn_key is _NO_TURN_KEY:
+            return _NO_TURN
+        return self.admission_control.turn(turn_key)
+
+    def _get_turn_key(self, command: tp.Callable, parsed_message: ParsedMessage) -> tp.Optional[tp.Hashable]:
+        """Returns the key of the turn that `command` takes, see `AdmissionControl.acquire`."""
+        if self.admission_control is None or not getattr(command, 'expensive', False):
+            return _NO_TURN_KEY
+        get_expensive_key = getattr(command, 'get_expensive_key', None)
+        if get_expensive_key is None:
+            return None
+        expensive_key = get_expensive_key(parsed_message.args)
+        return _NO_TURN_KEY if expensive_key is None else expensive_key
+
+    def _get_command(self, parsed_message: ParsedMessage) -> tp.Callable:
+        try:
+            return self.commands_by_name[parsed_message.name]
         except KeyError:
+            # unknown names are not used as labels, so users can't make new time series
+            command_errors.inc('unknown', InvalidCommand.__name__)
             raise InvalidCommand(f'unknown command {parsed_message.name}, type `/help`')
-        else:
-            return command(parsed_message.args)
+
+
+_NO_TURN_KEY = object()  # of commands that take no turn
+
+
+class _NoTurn:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_TURN = _NoTurn()
+
+
+class AdmissionControl:
+    """Keeps one chat or a burst of expensive commands from slowing down the bot for everyone.
+
+    Every chat has a token bucket of `chat_burst` commands refilled at `chat_rate` per second,
+    a chat over its rate is told so once until one of its commands is admitted again, the other rejected commands
+    of the chat get no reply at all, so a flooding chat can't fill the send queue with canned replies.
+    At most `max_concurrent` expensive commands are executed at the same time, at most `max_waiting` more
+    wait up to `max_wait` seconds for their turn. Everything else is rejected with a short canned reply,
+    which is much cheaper than executing the command.
+    Expensive commands with the same key share one turn, e.g. commands waiting for the same github searches,
+    which are made once anyway.
+    """
+
+    def __init__(self, chat_rate: float = COMMAND_CHAT_RATE, chat_burst: float = COMMAND_CHAT_BURST,
+                 max_concurrent: int = EXPENSIVE_COMMANDS_CONCURRENCY,
+                 max_waiting: int = EXPENSIVE_COMMANDS_MAX_WAITING, max_wait: float = EXPENSIVE_COMMANDS_MAX_WAIT,
+                 chat_buckets_maxsize: int = COMMAND_CHAT_BUCKETS_MAXSIZE,
+                 timer: tp.Callable[[], float] = time.monotonic) -> None:
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.chat_buckets_maxsize = chat_buckets_maxsize
+        self.timer = timer
+        self._chat_buckets = collections.OrderedDict()
+        self._rate_limited_chat_ids = set()  # chats that have been told they are over their rate
+        self._chat_buckets_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._running = 0
+        self._waiting = 0
+        self._async_waiters = collections.deque()  # (loop, future) of coroutines waiting for their turn
+        self._shared_turns = {}  # key -> commands sharing the turn taken for the key
+
+    def admit_chat(self, chat_id: int) -> None:
+        """
+        :raises CommandRejected: With an empty text, when the chat has been told it's over its rate already.
+        """
+        with self._chat_buckets_lock:
+            bucket = self._chat_buckets.pop(chat_id, None)
+            if bucket is None:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst, self.timer)
+                if len(self._chat_buckets) >= self.chat_buckets_maxsize:
+                    forgotten_chat_id, _ = self._chat_buckets.popitem(last=False)
+                    self._rate_limited_chat_ids.discard(forgotten_chat_id)
+            self._chat_buckets[chat_id] = bucket
+            admitted = bucket.try_take()
+            if admitted:
+                self._rate_limited_chat_ids.discard(chat_id)
+                return
+            told = chat_id in self._rate_limited_chat_ids
+            self._rate_limited_chat_ids.add(chat_id)
+        commands_rejected.inc('chat_rate')
+        raise CommandRejected('' if told else RATE_LIMITED_REPLY_TEXT)
+
+    def acquire(self, key: tp.Optional[tp.Hashable] = None) -> None:
+        """Waits for the turn of an expensive command, which is given back with `release` of the same `key`.
+
+        A command joins the turn that was taken for its `key` already, a None key takes a turn of its own.
+
+        :raises CommandRejected:
+        """
+        with self._condition:
+            if not self._can_take_turn(key):
+                self._start_waiting()
+                try:
+                    has_turn = self._condition.wait_for(lambda: self._can_take_turn(key), self.max_wait)
+                finally:
+                    self._stop_waiting()
+                if not has_turn:
+                    commands_rejected.inc('timeout')
+                    raise CommandRejected(OVERLOADED_REPLY_TEXT)
+            self._take_turn(key)
+
+    async def acquire_async(self, key: tp.Optional[tp.Hashable] = None) -> None:
+        """Like `acquire`, but waits in the event loop, without taking a thread.
+
+        :raises CommandRejected:
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.max_wait
+        with self._condition:
+            if self._can_take_turn(key):
+                self._take_turn(key)
+                return
+            self._start_waiting()
+        waiter = None
+        has_turn = False
+        try:
+            while True:
+                with self._condition:
+                    if self._can_take_turn(key):
+                        self._take_turn(key)
+                        has_turn = True
+                        return
+                    is_woken = waiter is not None
+                    waiter = loop.create_future()
+                    if is_woken:
+                        # someone else took the turn after the wakeup, so the waiter keeps its place in line
+                        self._async_waiters.appendleft((loop, waiter))
+                    else:
+                        self._async_waiters.append((loop, waiter))
+                try:
+                    await asyncio.wait_for(waiter, max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    commands_rejected.inc('timeout')
+                    raise CommandRejected(OVERLOADED_REPLY_TEXT)
+        finally:
+            with self._condition:
+                self._stop_waiting()
+                if waiter is not None and not has_turn:
+                    try:
+                        self._async_waiters.remove((loop, waiter))
+                    except ValueError:
+                        # `release` woke up this waiter when it timed out or was cancelled, the next one can use it
+                        self._wake_async_waiter()
+
+    def release(self, key: tp.Optional[tp.Hashable] = None) -> None:
+        with self._condition:
+            if key is not None:
+                self._shared_turns[key] -= 1
+                if self._shared_turns[key]:
+                    return
+                del self._shared_turns[key]
+            self._running -= 1
+            expensive_commands_running.set(self._running)
+            self._condition.notify()
+            self._wake_async_waiter()
+
+    def _wake_async_waiter(self) -> None:
+        """Wakes up the coroutine that waits for a turn the longest, the condition should be held."""
+        while self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            if not waiter.done():
+                loop.call_soon_threadsafe(_set_future_result, waiter)
+                break
+
+    def _start_waiting(self) -> None:
+        if self._waiting >= self.max_waiting:
+            commands_rejected.inc('overloaded')
+            raise CommandRejected(OVERLOADED_REPLY_TEXT)
+        self._waiting += 1
+        expensive_commands_waiting.set(self._waiting)
+
+    def _stop_waiting(self) -> None:
+        self._waiting -= 1
+        expensive_commands_waiting.set(self._waiting)
+
+    def _can_take_turn(self, key: tp.Optional[tp.Hashable]) -> bool:
+        return self._running < self.max_concurrent or key in self._shared_turns
+
+    def _take_turn(self, key: tp.Optional[tp.Hashable]) -> None:
+        if key in self._shared_turns:
+            self._shared_turns[key] += 1
+            return
+        if key is not None:
+            self._shared_turns[key] = 1
+        self._running += 1
+        expensive_commands_running.set(self._running)
+
+    @contextmanager
+    def turn(self, key: tp.Optional[tp.Hashable] = None):
+        """
+        :raises CommandRejected:
+        """
+        self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release(key)
+
+
+def _set_future_result(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+def _get_command_args(command: tp.Callable, parsed_message: ParsedMessage) -> tp.Tuple:
+    if getattr(command, 'takes_chat_id', False):
+        return parsed_message.args, parsed_message.chat_id
+    return parsed_message.args,
+
+
+@contextmanager
+def _record_command_metrics(command_name: str):
+    with command_duration.time(command_name):
+        try:
+            yield
+        except Exception as exc:
+            command_errors.inc(command_name, type(exc).__name__)
+            raise
+
+
+def _is_coroutine_function(func) -> bool:
+    return inspect.iscoroutinefunction(func) or inspect.iscoroutinefunction(getattr(func, '__call__', None))
+
+
+def _run_until_complete(awaitable):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(awaitable)
+    finally:
+        loop.close()
 
 
 class GithubShowCommand:
-    def __init__(self, token, default_age_in_days=DEFAULT_AGE_IN_DAYS):
+    expensive = True  # makes github searches when results are not cached, see `get_expensive_key`
+
+    def __init__(self, token, default_age_in_days=DEFAULT_AGE_IN_DAYS, popularity: 'PopularityTracker' = None):
         self.token = token
         self.default_age_in_days = default_age_in_days
+        self.popularity = popularity
 
     def __call__(self, args):
         """
         :raises GithubApiError:
         """
-        age_in_days = self._get_age_in_days_or_invalid_args(args)
+        age_in_days, language = self._get_age_in_days_and_language_or_invalid_args(args)
+        if language is not None:
+            repositories = find_trending_repositories_by_language(self.token, age_in_days, language)
+            if not repositories:
+                # the corpus can't tell that there are none, only that none of them are among its top
+                return (f'none of the {CORPUS_SIZE} most starred repositories of the last {CORPUS_MAX_AGE_IN_DAYS} '
+                        f'days are {language} repositories created in the last {age_in_days} days')
+            return format_html_message(repositories)
+        if self.popularity is not None:
+            self.popularity.record(age_in_days)
         repositories = find_trending_repositories(self.token, age_in_days)
         return format_html_message(repositories)
 
+    def get_expensive_key(self, args) -> tp.Optional[tp.Hashable]:
+        """Returns keys of the results that the command would wait for github searches of,
+        None when they are cached or being searched already, or when `args` are invalid.
+        """
+        try:
+            age_in_days, language = self._get_age_in_days_and_language_or_invalid_args(args)
+        except InvalidCommand:
+            return None
+        return tuple(get_missing_trending_keys(self.token, age_in_days, language)) or None
+
+    def _get_age_in_days_and_language_or_invalid_args(self, args) -> tp.Tuple[int, tp.Optional[str]]:
+        """Parses `[DAYS] [LANGUAGE]`."""
+        if len(args) > 2:
+            raise InvalidCommand(f'this command accepts at most two arguments, got {len(args)}')
+        if len(args) == 1 and args[0] and not _is_int(args[0]):
+            age_in_days, language = self.default_age_in_days, args[0]
+        else:
+            age_in_days = self._get_age_in_days_or_invalid_args(args[:1])
+            language = args[1] if len(args) == 2 else None
+        if language is not None and not language.strip():
+            # e.g. `/show 7 ` with a trailing space
+            raise InvalidCommand('LANGUAGE should not be empty')
+        if not 0 < age_in_days <= MAX_AGE_IN_DAYS:
+            raise InvalidCommand(f'DAYS should be from 1 to {MAX_AGE_IN_DAYS}, got {age_in_days}')
+        if language is not None and not 0 < age_in_days <= CORPUS_MAX_AGE_IN_DAYS:
+            raise InvalidCommand(f'LANGUAGE works for 1 to {CORPUS_MAX_AGE_IN_DAYS} days, got {age_in_days}')
+        return age_in_days, language
+
     def _get_age_in_days_or_invalid_args(self, args):
         if not args:
             return self.default_age_in_days
@@ -137,6 +707,14 @@ class GithubShowCommand:
             raise InvalidCommand(f'{args[0]} should be an integer')
 
 
+def _is_int(text: str) -> bool:
+    try:
+        int(text)
+    except ValueError:
+        return False
+    return True
+
+
 class TimestampCommand:
     _USAGE_STRING = 'usage: /timestamp %Y-%m-%dT%H:%M:%S'
 
@@ -157,41 +735,519 @@ class TimestampCommand:
             raise InvalidCommand(f'too many arguments, {TimestampCommand._USAGE_STRING}')
 
 
-class GithubApi:
-    def __init__(self, token: str, socket_timeout=DEFAULT_GITHUB_API_SOCKET_TIMEOUT) -> None:
+class SubscribeCommand:
+    takes_chat_id = True
+    _USAGE_STRING = f'usage: {SUBSCRIBE_COMMAND} {"|".join(DIGEST_SCHEDULES)} [DAYS]'
+
+    def __init__(self, subscriptions: tp.Optional['SubscriptionStore']) -> None:
+        self.subscriptions = subscriptions
+
+    def __call__(self, args, chat_id):
+        """
+        :raises StateError:
+        """
+        subscription = self._get_subscription_or_invalid_args(args, chat_id)
+        _get_subscriptions_or_invalid_command(self.subscriptions).put(subscription)
+        return (f'subscribed to {subscription.schedule} trending repositories '
+                f'created in the last {subscription.age_in_days} days')
+
+    def _get_subscription_or_invalid_args(self, args, chat_id) -> Subscription:
+        if not 1 <= len(args) <= 2 or args[0] not in DIGEST_SCHEDULES:
+            raise InvalidCommand(SubscribeCommand._USAGE_STRING)
+        schedule = args[0]
+        if len(args) == 1:
+            return Subscription(chat_id, schedule, DIGEST_SCHEDULES[schedule])
+        try:
+            age_in_days = int(args[1])
+        except ValueError:
+            raise InvalidCommand(f'{args[1]} should be an integer')
+        if not 0 < age_in_days <= MAX_AGE_IN_DAYS:
+            raise InvalidCommand(f'DAYS should be from 1 to {MAX_AGE_IN_DAYS}, got {age_in_days}')
+        return Subscription(chat_id, schedule, age_in_days)
+
+
+class UnsubscribeCommand:
+    takes_chat_id = True
+
+    def __init__(self, subscriptions: tp.Optional['SubscriptionStore']) -> None:
+        self.subscriptions = subscriptions
+
+    def __call__(self, args, chat_id):
+        """
+        :raises StateError:
+        """
+        if args:
+            raise InvalidCommand(f'{UNSUBSCRIBE_COMMAND} accepts no arguments')
+        if _get_subscriptions_or_invalid_command(self.subscriptions).delete(chat_id):
+            return 'unsubscribed'
+        return 'you are not subscribed'
+
+
+def _get_subscriptions_or_invalid_command(subscriptions: tp.Optional['SubscriptionStore']) -> 'SubscriptionStore':
+    if subscriptions is None:
+        raise InvalidCommand('subscriptions are not available')
+    return subscriptions
+
+
+class RateLimitStats(Stats):
+    fields = ('limit', 'remaining', 'reset_at', 'waits', 'deferred', 'rejected')
+    counters = ('waits', 'deferred', 'rejected')
+
+
+class GithubRateLimiter:
+    """Spends the github search quota.
+
+    The quota is a bucket of `limit` requests refilled every `window` seconds.
+    Its state is synced from X-RateLimit-* headers of every response and is tracked locally between responses.
+    Deferrable requests (background refreshes) leave `reserve` requests to the others and never wait.
+    Other requests wait up to `max_wait` seconds for the bucket to refill.
+    """
+
+    def __init__(self, limit: int = GITHUB_SEARCH_RATE_LIMIT, window: float = GITHUB_SEARCH_RATE_LIMIT_WINDOW,
+                 reserve: int = GITHUB_RATE_LIMIT_RESERVE, max_wait: float = GITHUB_RATE_LIMIT_MAX_WAIT,
+                 timer: tp.Callable[[], float] = time.time, sleep: tp.Callable[[float], None] = time.sleep) -> None:
+        self.window = window
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.timer = timer
+        self.sleep = sleep
+        self.stats = RateLimitStats()
+        self._lock = threading.Lock()
+        self._limit = limit
+        self._remaining = limit
+        self._reset_at = timer() + window
+
+    @property
+    def remaining(self) -> int:
+        with self._lock:
+            self._refill()
+            return self._remaining
+
+    @property
+    def reset_at(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._reset_at
+
+    def acquire(self, deferrable: bool = False) -> None:
+        """
+        :raises GithubRateLimitExceeded: When the quota is spent.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                reserve = self.reserve if deferrable else 0
+                if self._remaining > reserve:
+                    self._remaining -= 1
+                    self._update_stats()
+                    return
+                wait = self._reset_at - self.timer()
+            if deferrable:
+                self.stats.incr('deferred')
+                raise GithubRateLimitExceeded(f'deferring a request, {self._remaining} requests left')
+            if wait > self.max_wait:
+                self.stats.incr('rejected')
+                raise GithubRateLimitExceeded(f'rate limit is exceeded for {wait:.0f} more seconds')
+            self.stats.incr('waits')
+            self.sleep(max(wait, 0))
+
+    def update(self, headers: tp.Mapping[str, str]) -> None:
+        try:
+            limit = int(headers['X-RateLimit-Limit'])
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset_at = int(headers['X-RateLimit-Reset'])
+        except (KeyError, ValueError):
+            return
+        with self._lock:
+            self._limit = limit
+            self._remaining = remaining
+            self._reset_at = reset_at
+            self._update_stats()
+
+    def _refill(self) -> None:
+        now = self.timer()
+        if now >= self._reset_at:
+            self._remaining = self._limit
+            self._reset_at = now + self.window
+            self._update_stats()
+
+    def _update_stats(self) -> None:
+        self.stats.set('limit', self._limit)
+        self.stats.set('remaining', self._remaining)
+        self.stats.set('reset_at', self._reset_at)
+
+
+_request_priority = threading.local()
+
+
+@contextmanager
+def deferrable_requests():
+    """Marks github requests made by the current thread as deferrable: they fail instead of waiting
+    for the rate limit, and leave some quota to requests of users.
+    """
+    previous = _are_requests_deferrable()
+    _request_priority.deferrable = True
+    try:
+        yield
+    finally:
+        _request_priority.deferrable = previous
+
+
+def _are_requests_deferrable() -> bool:
+    return getattr(_request_priority, 'deferrable', False)
+
+
+class GithubTokenStats(Stats):
+    fields = ('requests', 'errors', 'revoked')
+    counters = ('requests', 'errors')
+
+
+class GithubToken:
+    def __init__(self, token: str, rate_limiter: tp.Optional[GithubRateLimiter] = None, index: int = 0) -> None:
         self.token = token
+        self.rate_limiter = rate_limiter or GithubRateLimiter()
+        self.index = index  # of the token in GITHUB_TOKEN
+        self.stats = GithubTokenStats()
+
+    @property
+    def name(self) -> str:
+        """Token name that is safe to log.
+
+        Tokens of one kind share a prefix, e.g. 'ghp_', so the name is made of the index and the last characters.
+        """
+        return f'{self.index}:...{self.token[-4:]}'
+
+    @property
+    def revoked(self) -> bool:
+        return bool(self.stats['revoked'])
+
+
+class ConditionalStats(Stats):
+    """Conditional search requests, 304 responses don't count against the rate limit."""
+    fields = ('requests', 'not_modified', 'bytes_saved', 'parse_seconds_saved')
+    counters = fields
+
+
+class _ConditionalEntry(tp.NamedTuple):
+    etag: tp.Optional[str]
+    last_modified: tp.Optional[str]
+    repositories: tp.List[Repo]
+    size: int  # bytes of the response body
+    parse_seconds: float
+
+
+class ConditionalCache:
+    """LRU cache of validators (ETag and Last-Modified) and parsed results of searches.
+
+    A search is requested again with its validators, and its parsed results are reused
+    when github answers 304 Not Modified.
+    """
+
+    def __init__(self, maxsize: int = CONDITIONAL_CACHE_MAXSIZE) -> None:
+        self.maxsize = maxsize
+        self.stats = ConditionalStats()
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> _ConditionalEntry
+
+    def get_headers(self, key: tp.Hashable) -> tp.Dict[str, str]:
+        """Returns headers that make a request of `key` conditional, no headers when there are no validators."""
+        with self._lock:
+            entry = self._entries.get(key)
+        headers = {}
+        if entry is not None and entry.etag is not None:
+            headers['If-None-Match'] = entry.etag
+        if entry is not None and entry.last_modified is not None:
+            headers['If-Modified-Since'] = entry.last_modified
+        if headers:
+            self.stats.incr('requests')
+        return headers
+
+    def get_not_modified(self, key: tp.Hashable) -> tp.Optional[tp.List[Repo]]:
+        """Returns results of `key` after a 304 response, None when they were evicted in the meantime."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+        self.stats.incr('not_modified')
+        self.stats.incr('bytes_saved', entry.size)
+        self.stats.incr('parse_seconds_saved', entry.parse_seconds)
+        return list(entry.repositories)
+
+    def put(self, key: tp.Hashable, headers: tp.Mapping[str, str], repositories: tp.List[Repo], size: int,
+            parse_seconds: float) -> None:
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        with self._lock:
+            if etag is None and last_modified is None:
+                self._entries.pop(key, None)
+                return
+            self._entries[key] = _ConditionalEntry(etag, last_modified, list(repositories), size, parse_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class GithubApi:
+    """
+    When given several tokens, every request goes with the token that has the most of its rate limit left,
+    revoked tokens are skipped.
+    Searches are requested again with the validators of their last response, see `ConditionalCache`.
+    """
+
+    def __init__(self, token: GithubTokens, socket_timeout=DEFAULT_GITHUB_API_SOCKET_TIMEOUT,
+                 pool_connections: int = DEFAULT_POOL_CONNECTIONS, pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+                 max_retries: int = DEFAULT_MAX_RETRIES, api_base: str = GITHUB_API_BASE) -> None:
+        tokens = (token,) if isinstance(token, str) else token
+        self.tokens = [GithubToken(one_token, index=index) for index, one_token in enumerate(tokens)]
         self.socket_timeout = socket_timeout
+        self.api_base = api_base
+        self.session = _make_session(pool_connections, pool_maxsize, max_retries)
+        self._single_flight = SingleFlight()
+        self._conditional_cache = ConditionalCache()
+
+    @property
+    def single_flight_stats(self) -> 'SingleFlightStats':
+        return self._single_flight.stats
+
+    @property
+    def conditional_stats(self) -> ConditionalStats:
+        return self._conditional_cache.stats
+
+    def token_stats(self) -> tp.Dict[str, tp.Dict[str, tp.Any]]:
+        return {
+            github_token.name: dict(github_token.stats.as_dict(), **github_token.rate_limiter.stats.as_dict())
+            for github_token in self.tokens
+        }
+
+    def connection_stats(self) -> tp.Dict[str, int]:
+        return _get_connection_stats(self.session)
+
+    def close(self) -> None:
+        self.session.close()
 
     def find_trending_repositories(self, created_after: dt.datetime, limit: int) -> tp.List[Repo]:
         """
+        More than GITHUB_SEARCH_PAGE_SIZE repositories are fetched by pages, see `iter_trending_repositories`.
+
+        :raises GithubApiError:
+        """
+        if limit > GITHUB_SEARCH_PAGE_SIZE:
+            return list(self.iter_trending_repositories(created_after, limit))
+        return self._search_repositories_once(_get_trending_search_params(created_after, limit))
+
+    def iter_trending_repositories(self, created_after: dt.datetime, limit: int = GITHUB_SEARCH_MAX_RESULTS,
+                                   page_size: int = GITHUB_SEARCH_PAGE_SIZE,
+                                   concurrency: int = SEARCH_PAGES_CONCURRENCY) -> tp.Iterator[Repo]:
+        """Yields up to `limit` of the most starred repositories created after `created_after`.
+
+        After a full first page the next pages are requested `concurrency` at a time, but not more
+        than the rate limit has left. Pages are yielded in order as they arrive, so only the pages in flight
+        are held in memory. A repository that moves to the next page between requests is yielded once,
+        repositories are told apart by `html_url`.
+
+        :raises GithubApiError:
+        """
+        deferrable = _are_requests_deferrable()
+        pages = math.ceil(min(limit, GITHUB_SEARCH_MAX_RESULTS) / page_size)
+        seen_urls = set()
+        pending = collections.deque()
+        next_page = 1
+        in_flight = 1
+        try:
+            while True:
+                while next_page <= pages and len(pending) < in_flight:
+                    params = dict(_get_trending_search_params(created_after, page_size), page=str(next_page))
+                    pending.append(_search_pages_executor.submit(self._search_repositories_once, params, deferrable))
+                    next_page += 1
+                if not pending:
+                    return
+                page_repositories = pending.popleft().result()
+                for repo in page_repositories:
+                    if repo.html_url in seen_urls:
+                        continue
+                    seen_urls.add(repo.html_url)
+                    yield repo
+                    if len(seen_urls) == limit:
+                        return
+                if len(page_repositories) < page_size:
+                    return
+                in_flight = max(min(concurrency, self._get_rate_budget(deferrable)), 1)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def find_repositories_created_on(self, created_on: dt.date, limit: int) -> tp.List[Repo]:
+        """
+        :raises GithubApiError:
+        """
+        return self._search_repositories_once(_get_search_params(f'created:{created_on.isoformat()}', limit))
+
+    def find_repositories_created_between(self, created_after: dt.datetime, created_before: dt.datetime,
+                                          limit: int) -> tp.List[Repo]:
+        """Both bounds are included.
+
         :raises GithubApiError:
         """
-        headers = {
-            'Authorization': f'token {self.token}',
-            'Accept': 'application/vnd.github.v3+json',
-        }
         created_after_str = created_after.replace(microsecond=0).isoformat()
-        url = urlparse.urljoin(GITHUB_API_BASE, '/search/repositories')
-        params = {
-            'q': f'created:>{created_after_str}',
-            'sort': 'stars',
-            'order': 'desc',
-            'per_page': str(limit),
-        }
+        created_before_str = created_before.replace(microsecond=0).isoformat()
+        return self._search_repositories_once(
+            _get_search_params(f'created:{created_after_str}..{created_before_str}', limit))
+
+    def _search_repositories_once(self, params: tp.Mapping[str, str],
+                                  deferrable: tp.Optional[bool] = None) -> tp.List[Repo]:
+        """`deferrable` is taken from `deferrable_requests` of the current thread when it's None."""
+        if deferrable is None:
+            deferrable = _are_requests_deferrable()
+        # deferrable requests can fail on rate limit when others would wait, so they don't share results
+        return self._single_flight.do(
+            (deferrable, tuple(sorted(params.items()))),
+            functools.partial(self._search_repositories, params, deferrable),
+        )
+
+    def _search_repositories(self, params: tp.Mapping[str, str], deferrable: bool) -> tp.List[Repo]:
+        """
+        :raises GithubApiError:
+        """
+        for _ in self.tokens:
+            github_token = self._pick_token()
+            github_token.rate_limiter.acquire(deferrable)
+            github_token.stats.incr('requests')
+            try:
+                return self._search_repositories_with_token(github_token, params)
+            except GithubTokenRevoked:
+                logging.error('github token %s is revoked', github_token.name)
+                github_token.stats.set('revoked', 1)
+            except GithubApiError:
+                github_token.stats.incr('errors')
+                raise
+        raise GithubTokenRevoked('all github tokens are revoked')
+
+    def _get_rate_budget(self, deferrable: bool) -> int:
+        """Returns how many requests can be made now without waiting for the rate limit."""
+        return sum(
+            max(github_token.rate_limiter.remaining - (github_token.rate_limiter.reserve if deferrable else 0), 0)
+            for github_token in self.tokens
+            if not github_token.revoked
+        )
+
+    def _pick_token(self) -> GithubToken:
+        """
+        :raises GithubTokenRevoked: When all tokens are revoked.
+        """
+        github_tokens = [github_token for github_token in self.tokens if not github_token.revoked]
+        if not github_tokens:
+            raise GithubTokenRevoked('all github tokens are revoked')
+        return max(
+            github_tokens,
+            key=lambda github_token: (github_token.rate_limiter.remaining, -github_token.rate_limiter.reset_at),
+        )
+
+    def _search_repositories_with_token(self, github_token: GithubToken, params: tp.Mapping[str, str],
+                                        conditional: bool = True) -> tp.List[Repo]:
+        """
+        :raises GithubApiError:
+        """
+        # validators of one token don't match responses to another, github varies responses by Authorization
+        conditional_key = (github_token.token, tuple(sorted(params.items())))
+        headers = _get_github_headers(github_token.token)
+        if conditional:
+            headers.update(self._conditional_cache.get_headers(conditional_key))
+        url = urlparse.urljoin(self.api_base, '/search/repositories')
         logging.info('getting trending repositories from github: %r with params %r', url, params)
         with _convert_exceptions(requests.RequestException, GithubApiError):
-            response = requests.get(url, params=params, headers=headers, timeout=self.socket_timeout)
+            with github_request_duration.time():
+                response = self.session.get(url, params=params, headers=headers, timeout=self.socket_timeout)
+            github_responses.inc(str(response.status_code))
+            github_token.rate_limiter.update(response.headers)
+            if response.status_code == 401:
+                raise GithubTokenRevoked(response.text)
             response.raise_for_status()
+        if response.status_code == 304:
+            repositories = self._conditional_cache.get_not_modified(conditional_key)
+            if repositories is None:
+                # the results were evicted after the validators were sent, and a 304 doesn't count against
+                # the rate limit, so the search is requested again without them
+                logging.info('results of a 304 Not Modified search were evicted, requesting them again')
+                return self._search_repositories_with_token(github_token, params, conditional=False)
+            logging.info('%d repositories from github are not modified', len(repositories))
+            return repositories
+        started_at = time.perf_counter()
         try:
             response_data = response.json()
         except ValueError as exc:
             raise GithubApiError(f"can't convert {response.text!r} to json") from exc
         items = _get_or_raise(response_data, 'items', list, GithubApiError)
         logging.info('got %d repositories from github', len(items))
-        return [
+        repositories = [
             _make_repo_from_api_item(one_item)
             for one_item in items
             ]
+        self._conditional_cache.put(conditional_key, response.headers, repositories, len(response.content),
+                                    time.perf_counter() - started_at)
+        return repositories
+
+
+def _make_session(pool_connections: int, pool_maxsize: int, max_retries: int) -> requests.Session:
+    """Returns a session that keeps at most `pool_maxsize` keep-alive connections to each host.
+
+    Requests wait for a free connection when all `pool_maxsize` connections to the host are busy.
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=0.1,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=retry,
+        pool_block=True,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+CONNECTION_STATS_COUNTERS = ('requests', 'connections', 'reused')
+
+
+def _get_connection_stats(session: requests.Session) -> tp.Dict[str, int]:
+    """Returns how many requests went through the connection pools of `session` and how many of them reused
+    an already established connection.
+    """
+    stats = {'requests': 0, 'connections': 0}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+    stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+    return stats
+
+
+def _get_github_headers(token: str) -> tp.Dict[str, str]:
+    return {
+        'Authorization': f'token {token}',
+        'Accept': 'application/vnd.github.v3+json',
+    }
+
+
+def _get_trending_search_params(created_after: dt.datetime, limit: int) -> tp.Dict[str, str]:
+    created_after_str = created_after.replace(microsecond=0).isoformat()
+    return _get_search_params(f'created:>{created_after_str}', limit)
+
+
+def _get_search_params(query: str, limit: int) -> tp.Dict[str, str]:
+    return {
+        'q': query,
+        'sort': 'stars',
+        'order': 'desc',
+        'per_page': str(limit),
+    }
 
 
 def _make_repo_from_api_item(item) -> Repo:
@@ -204,9 +1260,35 @@ def _make_repo_from_api_item(item) -> Repo:
         html_url=_get_or_raise(item, 'html_url', str, GithubApiError),
         language=_get_or_raise(item, 'language', (str, type(None)), GithubApiError),
         stargazers_count=_get_or_raise(item, 'stargazers_count', int, GithubApiError),
+        created_at=_get_created_at(item),
     )
 
 
+def _get_created_at(item) -> tp.Optional[dt.datetime]:
+    """
+    :raises GithubApiError:
+    """
+    if 'created_at' not in item:
+        return None
+    created_at = _get_or_raise(item, 'created_at', str, GithubApiError)
+    try:
+        return dt.datetime.strptime(created_at, GITHUB_DATETIME_FORMAT)
+    except ValueError as exc:
+        raise GithubApiError(f"can't parse created_at {created_at!r}") from exc
+
+
+def dump_repositories(repositories: tp.List[Repo]) -> tp.List[tp.List]:
+    """Converts `repositories` to a json-serializable list, `load_repositories` converts it back."""
+    return [repo.dump() for repo in repositories]
+
+
+def load_repositories(dumped: tp.List[tp.List]) -> tp.List[Repo]:
+    """
+    :raises ValueError: When `dumped` was not returned by `dump_repositories`.
+    """
+    return [Repo.load(repo_dumped) for repo_dumped in dumped]
+
+
 def _get_or_raise(item, key, expected_type, exception_class):
     try:
         value = item[key]
@@ -218,95 +1300,1032 @@ def _get_or_raise(item, key, expected_type, exception_class):
         return value
 
 
-@ttl_cache(ttl=GITHUB_CACHE_TTL)
-def find_trending_repositories(github_token: str, age_in_days: int) -> tp.List[Repo]:
-    """
-    :raises GithubApiError:
-    """
-    created_after = dt.datetime.utcnow() - dt.timedelta(days=age_in_days)
-    github_api = GithubApi(github_token)
-    return github_api.find_trending_repositories(
-        created_after=created_after,
-        limit=10,
-    )
+github_api_base = GITHUB_API_BASE  # see `_setup_github_api_base`
 
 
-def _configure_logging():
-    logging.basicConfig(
-        format='%(levelname)s %(message)s %(filename)s:%(lineno)s',
-        level=logging.INFO,
-    )
+@functools.lru_cache(maxsize=None)
+def get_github_api(github_token: GithubTokens) -> GithubApi:
+    """Returns a `GithubApi` shared by all callers with the same token, so they share its connection pool."""
+    return GithubApi(github_token, api_base=github_api_base)
 
 
-def main(offset_state=None):
-    if offset_state is None:
-        offset_state = FileOffsetState(OFFSET_PATH)
-    _configure_logging()
-    config = _get_config_or_exit(os.environ)
-    telegram_api = TelegramApi(config.telegram_token)
-    commands_executor = _get_commands_executor(config)
-    while True:
-        try:
-            updates = telegram_api.get_updates(
-                offset=offset_state.offset,
-                limit=TELEGRAM_UPDATES_LIMIT,
-                timeout=DEFAULT_TELEGRAM_API_LONG_POLLING_TIMEOUT,
-            )
-        except TelegramApiError:
-            logging.error('could not get updates from telegram, sleeping 10 seconds ...', exc_info=True)
-            time.sleep(10)
-            continue
+def _setup_github_api_base(config: Config) -> None:
+    """Points `get_github_api` to `config.github_api_base`, it should be called before any github request."""
+    global github_api_base
+    github_api_base = config.github_api_base
+    get_github_api.cache_clear()
 
-        for update in updates:
-            if update.message is None:
-                logging.info('update %r has no message', update.update_id)
-                continue
-            parsed_message = _get_parsed_message(update)
+
+class CacheStats(Stats):
+    fields = ('hits', 'misses', 'stale_hits', 'fallback_hits', 'expired_hits', 'refreshes', 'refresh_errors',
+              'evictions', 'store_hits', 'store_errors')
+    counters = fields
+
+
+class TrendingCache:
+    """LRU cache that serves stale values while refreshing them.
+
+    A value younger than `ttl` is returned as is.
+    A value younger than `ttl + stale_ttl` is returned too, and a background refresh of its key starts,
+    at most one refresh per key runs at the same time.
+    On a miss the value is loaded in the calling thread, concurrent callers missing the same key
+    wait for that single load and share its result or its error. A miss with a `fallback_key` that has
+    a value younger than `ttl + stale_ttl` returns that value instead, and the key is loaded in the background.
+    When that load fails, an even older value of the key is returned if there is one.
+    Refreshes make deferrable github requests, see `deferrable_requests`.
+    With a `store` loads first look for a fresh value there, and loads and refreshes save values to it,
+    so values survive restarts and are shared by all processes using the same store.
+    Refreshes don't look there, the value they would find is usually the one that is being refreshed.
+    """
+
+    def __init__(self, maxsize: int = GITHUB_CACHE_MAXSIZE, ttl: float = GITHUB_CACHE_TTL,
+                 stale_ttl: float = GITHUB_CACHE_STALE_TTL, timer: tp.Callable[[], float] = time.monotonic,
+                 run_in_background: tp.Callable[[tp.Callable], None] = None,
+                 store: tp.Optional['TrendingStore'] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timer = timer
+        self.run_in_background = run_in_background or _run_in_daemon_thread
+        self.store = store
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> (value, loaded_at)
+        self._single_flight = SingleFlight()
+        self._refreshing = set()
+
+    def get(self, key: tp.Hashable, load: tp.Callable[[], tp.Any], fallback_key: tp.Optional[tp.Hashable] = None):
+        """
+        :raises Error: When `key` is missing and `load` raises it.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            age = None if entry is None else self.timer() - entry[1]
+            if age is not None and age < self.ttl:
+                self._entries.move_to_end(key)
+                self.stats.incr('hits')
+                return entry[0]
+            is_stale = age is not None and age < self.ttl + self.stale_ttl
+            served_key = key
+            if entry is None and fallback_key is not None:
+                fallback_entry = self._entries.get(fallback_key)
+                if fallback_entry is not None and self.timer() - fallback_entry[1] < self.ttl + self.stale_ttl:
+                    served_key, entry, is_stale = fallback_key, fallback_entry, True
+                    self.stats.incr('fallback_hits')
+            if is_stale:
+                self._entries.move_to_end(served_key)
+                self.stats.incr('stale_hits')
+                needs_refresh = key not in self._refreshing
+                self._refreshing.add(key)
+        if is_stale:
+            if needs_refresh:
+                # a missing key can be in the store already
+                self.run_in_background(functools.partial(self._refresh, key, load, use_store=age is None))
+            return entry[0]
+        try:
+            return self._load(key, load)
+        except Error:
+            if entry is None:
+                raise
+            logging.error('could not load %r, serving an expired value', key, exc_info=True)
+            self.stats.incr('expired_hits')
+            return entry[0]
+
+    def is_cached(self, key: tp.Hashable, fallback_key: tp.Optional[tp.Hashable] = None) -> bool:
+        """Returns True when `get` of `key` returns a cached value without waiting for a load."""
+        with self._lock:
+            return any(self._is_unexpired(one_key) for one_key in (key, fallback_key) if one_key is not None)
+
+    def is_available(self, key: tp.Hashable, fallback_key: tp.Optional[tp.Hashable] = None) -> bool:
+        """Returns True when `get` of `key` doesn't load it in the calling thread."""
+        return self.is_cached(key, fallback_key) or self._single_flight.is_running(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def refresh(self, key: tp.Hashable, load: tp.Callable[[], tp.Any]) -> None:
+        """Reloads the value of `key` in the calling thread, unless it's already being refreshed."""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        self._refresh(key, load)
+
+    def _load(self, key: tp.Hashable, load: tp.Callable[[], tp.Any]):
+        self.stats.incr('misses')
+        return self._single_flight.do(key, functools.partial(self._load_and_put, key, load))
+
+    def _load_and_put(self, key: tp.Hashable, load: tp.Callable[[], tp.Any], use_store: bool = True):
+        stored = self._get_from_store(key) if use_store else None
+        if stored is not None:
+            value, age = stored
+            self.stats.incr('store_hits')
+            self._put(key, value, age)
+            return value
+        value = load()
+        self._put(key, value)
+        self._put_to_store(key, value)
+        return value
+
+    def _refresh(self, key: tp.Hashable, load: tp.Callable[[], tp.Any], use_store: bool = False) -> None:
+        try:
+            with deferrable_requests():
+                self._load_and_put(key, load, use_store=use_store)
+        except Error:
+            logging.error('could not refresh %r, serving a stale value', key, exc_info=True)
+            self.stats.incr('refresh_errors')
+        else:
+            self.stats.incr('refreshes')
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _get_from_store(self, key: tp.Hashable) -> tp.Optional[tp.Tuple[tp.Any, float]]:
+        if self.store is None:
+            return None
+        try:
+            stored = self.store.get(key)
+        except state.StateBackendError:
+            logging.error('could not get %r from the store', key, exc_info=True)
+            self.stats.incr('store_errors')
+            return None
+        if stored is None or stored[1] >= self.ttl:
+            return None
+        return stored
+
+    def _put_to_store(self, key: tp.Hashable, value) -> None:
+        if self.store is None:
+            return
+        try:
+            self.store.put(key, value)
+        except state.StateBackendError:
+            logging.error('could not put %r to the store', key, exc_info=True)
+            self.stats.incr('store_errors')
+
+    def _is_unexpired(self, key: tp.Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and self.timer() - entry[1] < self.ttl + self.stale_ttl
+
+    def _put(self, key: tp.Hashable, value, age: float = 0) -> None:
+        with self._lock:
+            self._entries[key] = (value, self.timer() - age)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats.incr('evictions')
+
+
+class TrendingStore:
+    """Keeps lists of repositories cached by `TrendingCache` in a state backend.
+
+    Cache keys end with the age in days, the day or the start of the results, their github token is left out:
+    results don't depend on the token, and tokens shouldn't leak into the backend.
+    Values are stored for `ttl` seconds together with the wall-clock time they were loaded at,
+    so that their age is known to every process.
+    """
+
+    def __init__(self, backend: state.StateBackend, ttl: float = GITHUB_CACHE_TTL + GITHUB_CACHE_STALE_TTL,
+                 timer: tp.Callable[[], float] = time.time) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.timer = timer
+
+    def get(self, key: tp.Hashable) -> tp.Optional[tp.Tuple[tp.List[Repo], float]]:
+        """
+        Returns repositories and their age in seconds.
+
+        :raises StateBackendError:
+        """
+        data = self.backend.get(_get_trending_state_key(key))
+        if data is None:
+            return None
+        try:
+            stored = json.loads(data.decode('utf-8'))
+            repositories = load_repositories(stored['repositories'])
+            age = max(self.timer() - stored['loaded_at'], 0)
+        except (ValueError, KeyError, TypeError):
+            logging.error('stored value of %r is corrupted', key, exc_info=True)
+            return None
+        return repositories, age
+
+    def put(self, key: tp.Hashable, repositories: tp.List[Repo]) -> None:
+        """
+        :raises StateBackendError:
+        """
+        stored = {'loaded_at': self.timer(), 'repositories': dump_repositories(repositories)}
+        self.backend.set(_get_trending_state_key(key), json.dumps(stored).encode('utf-8'), ttl=self.ttl)
+
+
+def _get_trending_state_key(key: tp.Hashable) -> str:
+    return TRENDING_STATE_KEY_PREFIX + str(key[-1])
+
+
+def _run_in_daemon_thread(func: tp.Callable) -> None:
+    threading.Thread(target=func, daemon=True).start()
+
+
+trending_cache = TrendingCache()
+
+
+def find_trending_repositories(github_token: GithubTokens, age_in_days: int) -> tp.List[Repo]:
+    """
+    Windows of up to DAY_BUCKETS_MAX_AGE_IN_DAYS are merged from cached per-day results of their whole days,
+    so all of them share the same few github searches, and a search of the rest of their first day.
+    The start of such a window is rounded down to WINDOW_START_STEP, so that the last search is cached too,
+    and while the search of a new step is loaded, the search of the previous step is served instead.
+    Longer windows are rounded down to WINDOW_START_STEP too, so that their refreshes repeat the same search
+    within a step and github can answer them with 304 Not Modified, see `ConditionalCache`.
+
+    :raises GithubApiError:
+    """
+    now = dt.datetime.utcnow()
+    loads = _get_trending_cache_loads(github_token, age_in_days, now)
+    if not _is_bucketed(age_in_days):
+        (key, load), = loads
+        return _rank_trending_repositories(
+            trending_cache.get(key, load),
+            created_after=_get_window_start(now, age_in_days),
+            limit=TRENDING_REPOSITORIES_LIMIT,
+        )
+    fallback_keys = _get_fallback_keys(github_token, age_in_days, now)
+
+    def get_day_bucket(key_and_load):
+        key, load = key_and_load
+        return trending_cache.get(key, load, fallback_key=fallback_keys.get(key))
+
+    # cached day buckets are read right away, so they don't wait in line for the threads behind loads
+    is_cached = [trending_cache.is_cached(key, fallback_keys.get(key)) for key, _ in loads]
+    day_buckets = [get_day_bucket(key_and_load) for key_and_load, cached in zip(loads, is_cached) if cached]
+    day_buckets.extend(_day_buckets_executor.map(
+        get_day_bucket,
+        [key_and_load for key_and_load, cached in zip(loads, is_cached) if not cached],
+    ))
+    return _rank_trending_repositories(
+        [repo for repositories in day_buckets for repo in repositories],
+        created_after=_get_window_start(now, age_in_days),
+        limit=TRENDING_REPOSITORIES_LIMIT,
+    )
+
+
+def get_missing_trending_keys(github_token: GithubTokens, age_in_days: int,
+                              language: tp.Optional[str] = None) -> tp.List[tp.Hashable]:
+    """Returns keys in `trending_cache` that finding trending repositories would wait for github searches of."""
+    if language is not None:
+        keys = [(github_token, CORPUS_CACHE_KEY)]
+        fallback_keys = {}
+    else:
+        now = dt.datetime.utcnow()
+        keys = [key for key, _ in _get_trending_cache_loads(github_token, age_in_days, now)]
+        fallback_keys = _get_fallback_keys(github_token, age_in_days, now)
+    return [key for key in keys if not trending_cache.is_available(key, fallback_keys.get(key))]
+
+
+def refresh_trending_repositories(github_token: GithubTokens, ages_in_days: tp.Sequence[int]) -> None:
+    """Refreshes cached results of `ages_in_days`, results shared by several windows are refreshed once.
+
+    Results of the next WINDOW_START_STEP are loaded too, so that windows find them when it starts.
+    """
+    now = dt.datetime.utcnow()
+    loads = collections.OrderedDict()
+    for one_now in [now, now + dt.timedelta(seconds=WINDOW_START_STEP)]:
+        for age_in_days in ages_in_days:
+            loads.update(_get_trending_cache_loads(github_token, age_in_days, one_now))
+    for key, load in loads.items():
+        trending_cache.refresh(key, load)
+
+
+def find_trending_repositories_by_language(github_token: GithubTokens, age_in_days: int,
+                                           language: str) -> tp.List[Repo]:
+    """
+    Repositories are found in the corpus of top repositories of the last CORPUS_MAX_AGE_IN_DAYS,
+    so filters by any language and any age up to that share the same few github searches.
+
+    :raises GithubApiError:
+    """
+    repositories = trending_cache.get(
+        (github_token, CORPUS_CACHE_KEY),
+        functools.partial(_find_corpus_repositories, github_token),
+    )
+    created_after = dt.datetime.utcnow() - dt.timedelta(days=age_in_days)
+    return _get_trending_index(repositories).find(language, created_after, TRENDING_REPOSITORIES_LIMIT)
+
+
+class TrendingIndex:
+    """Repositories by language, the most starred first, so that a search stops at the first `limit` matches."""
+
+    def __init__(self, repositories: tp.Iterable[Repo]) -> None:
+        by_language = collections.defaultdict(list)
+        for repo in repositories:
+            if repo.language is not None:
+                by_language[_get_language_key(repo.language)].append(repo)
+        self._by_language = {
+            language_key: tuple(sorted(
+                language_repositories,
+                key=lambda repo: (repo.stargazers_count, repo.created_at or dt.datetime.min),
+                reverse=True,
+            ))
+            for language_key, language_repositories in by_language.items()
+        }
+
+    def find(self, language: str, created_after: dt.datetime, limit: int) -> tp.List[Repo]:
+        """Returns the `limit` most starred repositories in `language` created after `created_after`."""
+        found = []
+        for repo in self._by_language.get(_get_language_key(language), ()):
+            if repo.created_at is None or repo.created_at > created_after:
+                found.append(repo)
+                if len(found) == limit:
+                    break
+        return found
+
+
+def _get_language_key(language: str) -> str:
+    """Languages match case-insensitively, and with dashes instead of spaces, e.g. 'jupyter-notebook'."""
+    return language.lower().replace(' ', '-')
+
+
+_trending_index_lock = threading.Lock()
+_trending_index = ([], TrendingIndex([]))  # the corpus and its index
+
+
+def _get_trending_index(repositories: tp.List[Repo]) -> TrendingIndex:
+    """Returns the index of `repositories`, it's built once per list that `trending_cache` returns."""
+    global _trending_index
+    with _trending_index_lock:
+        indexed_repositories, index = _trending_index
+        if indexed_repositories is not repositories:
+            index = TrendingIndex(repositories)
+            _trending_index = (repositories, index)
+        return index
+
+
+def _find_corpus_repositories(github_token: GithubTokens) -> tp.List[Repo]:
+    """
+    :raises GithubApiError:
+    """
+    # a stable start lets github answer refreshes of the corpus with 304 Not Modified,
+    # the repositories of the extra minutes are filtered out by `TrendingIndex.find`
+    created_after = _get_window_start(dt.datetime.utcnow(), CORPUS_MAX_AGE_IN_DAYS)
+    return get_github_api(github_token).find_trending_repositories(created_after, CORPUS_SIZE)
+
+
+_day_buckets_executor = futures.ThreadPoolExecutor(max_workers=DAY_BUCKETS_WORKERS)
+_search_pages_executor = futures.ThreadPoolExecutor(max_workers=SEARCH_PAGES_CONCURRENCY)
+
+
+def _is_bucketed(age_in_days: int) -> bool:
+    return 0 < age_in_days <= DAY_BUCKETS_MAX_AGE_IN_DAYS
+
+
+def _get_trending_cache_loads(github_token: GithubTokens, age_in_days: int,
+                              now: dt.datetime) -> tp.List[tp.Tuple[tp.Hashable, tp.Callable[[], tp.List[Repo]]]]:
+    """Returns keys in `trending_cache` holding the results of `age_in_days` and functions loading them."""
+    if not _is_bucketed(age_in_days):
+        return [(
+            (github_token, age_in_days),
+            functools.partial(_find_trending_repositories, github_token, age_in_days),
+        )]
+    created_after = _get_window_start(now, age_in_days)
+    first_day = created_after.date()
+    # the top of the whole first day could leave out repositories created after the start of the window
+    first_day_end = dt.datetime.combine(first_day, dt.time(23, 59, 59))
+    loads = [(
+        (github_token, created_after),
+        functools.partial(_find_repositories_created_between, github_token, created_after, first_day_end),
+    )]
+    loads.extend(
+        (
+            (github_token, created_on),
+            functools.partial(_find_repositories_created_on, github_token, created_on),
+        )
+        for created_on in (first_day + dt.timedelta(days=days) for days in range(1, (now.date() - first_day).days + 1))
+    )
+    return loads
+
+
+def _get_fallback_keys(github_token: GithubTokens, age_in_days: int,
+                       now: dt.datetime) -> tp.Dict[tp.Hashable, tp.Hashable]:
+    """Returns keys in `trending_cache` whose values are served while the values of other keys are loaded."""
+    if not _is_bucketed(age_in_days):
+        return {}
+    created_after = _get_window_start(now, age_in_days)
+    return {(github_token, created_after): _get_first_day_fallback_key(github_token, created_after)}
+
+
+def _get_first_day_fallback_key(github_token: GithubTokens, created_after: dt.datetime) -> tp.Hashable:
+    """Returns the key of results that include the search of the rest of the first day from `created_after`."""
+    previous_created_after = created_after - dt.timedelta(seconds=WINDOW_START_STEP)
+    if previous_created_after.date() != created_after.date():
+        # the window starts at midnight, so the rest of its first day is the whole day
+        return github_token, created_after.date()
+    return github_token, previous_created_after
+
+
+def _get_window_start(now: dt.datetime, age_in_days: int) -> dt.datetime:
+    created_after = now - dt.timedelta(days=age_in_days)
+    seconds = (created_after - dt.datetime.combine(created_after.date(), dt.time())).total_seconds()
+    return dt.datetime.combine(created_after.date(), dt.time()) + dt.timedelta(
+        seconds=seconds // WINDOW_START_STEP * WINDOW_START_STEP)
+
+
+def _rank_trending_repositories(repositories: tp.Iterable[Repo], created_after: dt.datetime,
+                                limit: int) -> tp.List[Repo]:
+    in_window = [
+        repo
+        for repo in repositories
+        if repo.created_at is None or repo.created_at > created_after
+    ]
+    in_window.sort(key=lambda repo: repo.stargazers_count, reverse=True)
+    return in_window[:limit]
+
+
+def _find_trending_repositories(github_token: GithubTokens, age_in_days: int) -> tp.List[Repo]:
+    """
+    :raises GithubApiError:
+    """
+    created_after = _get_window_start(dt.datetime.utcnow(), age_in_days)
+    github_api = get_github_api(github_token)
+    return github_api.find_trending_repositories(
+        created_after=created_after,
+        limit=TRENDING_REPOSITORIES_LIMIT,
+    )
+
+
+def _find_repositories_created_on(github_token: GithubTokens, created_on: dt.date) -> tp.List[Repo]:
+    """
+    :raises GithubApiError:
+    """
+    github_api = get_github_api(github_token)
+    return github_api.find_repositories_created_on(
+        created_on=created_on,
+        limit=TRENDING_REPOSITORIES_LIMIT,
+    )
+
+
+def _find_repositories_created_between(github_token: GithubTokens, created_after: dt.datetime,
+                                       created_before: dt.datetime) -> tp.List[Repo]:
+    """
+    :raises GithubApiError:
+    """
+    github_api = get_github_api(github_token)
+    return github_api.find_repositories_created_between(
+        created_after=created_after,
+        created_before=created_before,
+        limit=TRENDING_REPOSITORIES_LIMIT,
+    )
+
+
+class PopularityTracker:
+    """Counts keys among the last `history_size` recorded ones."""
+
+    def __init__(self, history_size: int = PREWARM_HISTORY_SIZE) -> None:
+        self._lock = threading.Lock()
+        self._history = collections.deque(maxlen=history_size)
+        self._counts = collections.Counter()
+
+    def record(self, key: tp.Hashable) -> None:
+        with self._lock:
+            if len(self._history) == self._history.maxlen:
+                oldest_key = self._history[0]
+                self._counts[oldest_key] -= 1
+                if not self._counts[oldest_key]:
+                    del self._counts[oldest_key]
+            self._history.append(key)
+            self._counts[key] += 1
+
+    def most_common(self, count: int) -> tp.List[tp.Hashable]:
+        with self._lock:
+            return [key for key, _ in self._counts.most_common(count)]
+
+
+class TrendingPrewarmer:
+    """Refreshes cached trending repositories in a background thread before they expire.
+
+    Refreshed are `ages_in_days` and the `top_requested` most requested ages in days according to `popularity`.
+    """
+
+    def __init__(self, github_token: GithubTokens, ages_in_days: tp.Sequence[int] = DEFAULT_PREWARM_AGES_IN_DAYS,
+                 popularity: tp.Optional[PopularityTracker] = None, top_requested: int = PREWARM_TOP_REQUESTED,
+                 interval: float = PREWARM_INTERVAL) -> None:
+        self.github_token = github_token
+        self.ages_in_days = ages_in_days
+        self.popularity = popularity
+        self.top_requested = top_requested
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def get_ages_in_days_to_refresh(self) -> tp.List[int]:
+        ages_in_days = list(self.ages_in_days)
+        if self.popularity is not None:
+            ages_in_days.extend(self.popularity.most_common(self.top_requested))
+        return list(collections.OrderedDict.fromkeys(ages_in_days))
+
+    def refresh_all(self) -> None:
+        refresh_trending_repositories(self.github_token, self.get_ages_in_days_to_refresh())
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='trending-prewarmer', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            logging.info('prewarming trending repositories ...')
             try:
-                message_text = commands_executor.execute(parsed_message)
-            except InvalidCommand as exc:
-                message_text = str(exc)
-            except Error:
-                logging.error(f'got an error when executing {parsed_message!r}', exc_info=True)
-                message_text = 'oops, something went wrong'
+                self.refresh_all()
+            except Exception:
+                # refreshes log github errors themselves, anything else shouldn't stop the prewarming for good
+                logging.error('could not prewarm trending repositories', exc_info=True)
+            self._stopped.wait(self.interval)
+
+
+class SubscriptionStore:
+    """Subscriptions of all chats kept under one key of a state backend.
+
+    Changes are serialized within a process, so only one process should change subscriptions.
+    """
+
+    def __init__(self, backend: state.StateBackend, key: str = SUBSCRIPTIONS_STATE_KEY) -> None:
+        self.backend = backend
+        self.key = key
+        self._lock = threading.Lock()
+
+    def get_all(self) -> tp.List[Subscription]:
+        """
+        :raises StateError:
+        """
+        with self._lock:
+            return sorted(self._get_by_chat_id().values())
+
+    def put(self, subscription: Subscription) -> None:
+        """
+        :raises StateError:
+        """
+        with self._lock:
+            subscriptions_by_chat_id = self._get_by_chat_id()
+            subscriptions_by_chat_id[subscription.chat_id] = subscription
+            self._set_by_chat_id(subscriptions_by_chat_id)
+
+    def delete(self, chat_id: int) -> bool:
+        """
+        :raises StateError:
+        """
+        with self._lock:
+            subscriptions_by_chat_id = self._get_by_chat_id()
+            if subscriptions_by_chat_id.pop(chat_id, None) is None:
+                return False
+            self._set_by_chat_id(subscriptions_by_chat_id)
+            return True
+
+    def _get_by_chat_id(self) -> tp.Dict[int, Subscription]:
+        with _convert_exceptions(state.StateBackendError, StateError):
+            data = self.backend.get(self.key)
+        if data is None:
+            return {}
+        # corrupted subscriptions are kept for repair, dropping them would unsubscribe everyone on the next change
+        with _convert_exceptions((ValueError, TypeError, AttributeError), StateError):
+            return {
+                int(chat_id): Subscription(int(chat_id), schedule, age_in_days)
+                for chat_id, (schedule, age_in_days) in loads_json(data).items()
+            }
+
+    def _set_by_chat_id(self, subscriptions_by_chat_id: tp.Dict[int, Subscription]) -> None:
+        dumped = {
+            str(chat_id): [subscription.schedule, subscription.age_in_days]
+            for chat_id, subscription in subscriptions_by_chat_id.items()
+        }
+        with _convert_exceptions(state.StateBackendError, StateError):
+            self.backend.set(self.key, json.dumps(dumped).encode('utf-8'))
+
+
+class DigestScheduler:
+    """Sends trending repositories to subscribed chats in a background thread.
+
+    Every schedule has one run per period, e.g. 'daily:2017-02-18', that starts at DIGEST_HOUR.
+    A run renders the message of every distinct DAYS once and sends it to its subscribers in the order
+    of their chat_id, at most `send_rate` messages per second through `send_queue`.
+    After all `batch_size` messages of a batch are sent or dropped by `send_queue`,
+    the last chat_id is saved in the state backend, so a restarted run resumes after it,
+    messages of a batch that was interrupted are sent again.
+    """
+
+    def __init__(self, subscriptions: SubscriptionStore, send_queue: 'SendQueue', github_token: GithubTokens,
+                 batch_size: int = DIGEST_BATCH_SIZE, send_rate: float = DIGEST_SEND_RATE,
+                 interval: float = DIGEST_CHECK_INTERVAL,
+                 now: tp.Callable[[], dt.datetime] = dt.datetime.utcnow) -> None:
+        self.subscriptions = subscriptions
+        self.send_queue = send_queue
+        self.github_token = github_token
+        self.batch_size = batch_size
+        self.send_rate = send_rate
+        self.interval = interval
+        self.now = now
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, name='digest-scheduler', daemon=True).start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def send_due_digests(self) -> None:
+        now = self.now()
+        for schedule in DIGEST_SCHEDULES:
+            run_id = _get_digest_run_id(schedule, now)
             try:
-                telegram_api.send_message(
-                    chat_id=update.message.chat_id,
-                    text=message_text,
+                self.send_digest(schedule, run_id)
+            except (StateError, GithubApiError):
+                logging.error('could not send digest %s, retrying in %d seconds', run_id, self.interval,
+                              exc_info=True)
+
+    def send_digest(self, schedule: str, run_id: str) -> None:
+        """
+        :raises StateError:
+        :raises GithubApiError:
+        """
+        progress = self._get_progress(run_id)
+        if progress.get('done'):
+            return
+        last_chat_id = progress.get('last_chat_id')
+        recipients = [
+            subscription
+            for subscription in self.subscriptions.get_all()
+            if subscription.schedule == schedule and (last_chat_id is None or subscription.chat_id > last_chat_id)
+            # DAYS of subscriptions saved before it was bounded could fail the run for everyone
+            and 0 < subscription.age_in_days <= MAX_AGE_IN_DAYS
+        ]
+        logging.info('sending digest %s to %d chats after chat_id %s', run_id, len(recipients), last_chat_id)
+        texts_by_age_in_days = {}
+        bucket = TokenBucket(self.send_rate)
+        for start in range(0, len(recipients), self.batch_size):
+            batch = recipients[start:start + self.batch_size]
+            queued_messages = []
+            for subscription in batch:
+                text = texts_by_age_in_days.get(subscription.age_in_days)
+                if text is None:
+                    text = texts_by_age_in_days[subscription.age_in_days] = self._render(subscription.age_in_days)
+                time.sleep(bucket.get_delay())
+                bucket.take()
+                queued_messages.append(self.send_queue.send_message(
+                    chat_id=subscription.chat_id,
+                    text=text,
                     parse_mode='HTML',
                     disable_web_page_preview=True,
                     disable_notification=True,
+                ))
+            if not self._wait_for_batch(run_id, queued_messages):
+                return
+            last_chat_id = batch[-1].chat_id
+            self._set_progress(run_id, {'last_chat_id': last_chat_id})
+        self._set_progress(run_id, {'last_chat_id': last_chat_id, 'done': True})
+        logging.info('sent digest %s', run_id)
+
+    def _wait_for_batch(self, run_id: str, queued_messages: tp.List[tp.Optional['QueuedMessage']]) -> bool:
+        """Waits until the messages of a batch are sent or dropped, returns False when the scheduler is stopped."""
+        for queued_message in queued_messages:
+            if queued_message is None:
+                continue
+            while not queued_message.wait(DIGEST_BATCH_TIMEOUT):
+                if self._stopped.is_set():
+                    return False
+                logging.warning('batch of digest %s is not sent in %d seconds, still waiting',
+                                run_id, DIGEST_BATCH_TIMEOUT)
+        return True
+
+    def _render(self, age_in_days: int) -> str:
+        """
+        :raises GithubApiError:
+        """
+        repositories = find_trending_repositories(self.github_token, age_in_days)
+        if not repositories:
+            return f'no trending repositories were created in the last {age_in_days} days'
+        return format_html_message(repositories)
+
+    def _get_progress(self, run_id: str) -> tp.Dict[str, tp.Any]:
+        with _convert_exceptions(state.StateBackendError, StateError):
+            data = self.subscriptions.backend.get(DIGEST_STATE_KEY_PREFIX + run_id)
+        if data is None:
+            return {}
+        with _convert_exceptions(ValueError, StateError):
+            return loads_json(data)
+
+    def _set_progress(self, run_id: str, progress: tp.Dict[str, tp.Any]) -> None:
+        with _convert_exceptions(state.StateBackendError, StateError):
+            self.subscriptions.backend.set(DIGEST_STATE_KEY_PREFIX + run_id, json.dumps(progress).encode('utf-8'),
+                                           ttl=DIGEST_PROGRESS_TTL)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.send_due_digests()
+            except Exception:
+                # one bad run shouldn't stop the digests of every subscriber for good
+                logging.error('could not send due digests, retrying in %d seconds', self.interval, exc_info=True)
+            self._stopped.wait(self.interval)
+
+
+def _get_digest_run_id(schedule: str, now: dt.datetime) -> str:
+    """Returns the id of the latest run of `schedule` that started before `now`."""
+    started_on = now.date() if now.hour >= DIGEST_HOUR else now.date() - dt.timedelta(days=1)
+    if schedule == 'weekly':
+        started_on -= dt.timedelta(days=started_on.weekday())
+    return f'{schedule}:{started_on.isoformat()}'
+
+
+def _configure_logging():
+    logging.basicConfig(
+        format='%(levelname)s %(message)s %(filename)s:%(lineno)s',
+        level=logging.INFO,
+    )
+
+
+def main(offset_state=None):
+    _configure_logging()
+    config = _get_config_or_exit(os.environ)
+    backend = _setup_trending_store_or_exit(config)
+    offset_state = _get_offset_state_or_exit(config, backend, offset_state)
+    _setup_github_api_base(config)
+    telegram_api = TelegramApi(config.telegram_token, api_base=config.telegram_api_base)
+    send_queue = SendQueue(telegram_api)
+    send_queue.start()
+    popularity = PopularityTracker()
+    subscriptions = None if backend is None else SubscriptionStore(backend)
+    commands_executor = _get_commands_executor(config, popularity, subscriptions)
+    TrendingPrewarmer(config.github_tokens, config.prewarm_ages_in_days, popularity).start()
+    if subscriptions is not None:
+        DigestScheduler(subscriptions, send_queue, config.github_tokens).start()
+    dispatcher = UpdatesDispatcher(
+        functools.partial(_handle_update, send_queue=send_queue, commands_executor=commands_executor),
+        workers=config.workers,
+    )
+    updates_limit = AdaptiveUpdatesLimit()
+    updates_stats = UpdatesStats()
+    metrics_server = _start_metrics_server(config, telegram_api, send_queue, updates_stats)
+    try:
+        while True:
+            try:
+                updates = telegram_api.get_updates(
+                    offset=offset_state.offset,
+                    limit=updates_limit.value,
+                    timeout=DEFAULT_TELEGRAM_API_LONG_POLLING_TIMEOUT,
                 )
             except TelegramApiError:
-                logging.error('could not get send message to telegram, sleeping 10 seconds ...', exc_info=True)
+                polls.inc('error')
+                logging.error('could not get updates from telegram, sleeping 10 seconds ...', exc_info=True)
                 time.sleep(10)
-        offset_state.offset = _get_next_offset(offset_state, updates)
+                continue
+
+            polls.inc('ok')
+            updates_stats.record_batch(updates, updates_limit.value)
+            updates_limit.update(len(updates))
+            dispatcher.dispatch(updates)
+            offset_state.offset = _get_next_offset(offset_state, updates)
+    finally:
+        _flush_offset_state(offset_state)
+        send_queue.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+
+def _start_metrics_server(config: Config, telegram_api: tp.Optional['TelegramApi'] = None,
+                          send_queue: tp.Optional['SendQueue'] = None,
+                          updates_stats: tp.Optional['UpdatesStats'] = None):
+    """Enables metrics and serves them on `config.metrics_port`, returns the server or None when it's not set.
+
+    Every process of the bot serves its own metrics, so processes on the same host need different ports.
+    Stats of the objects that the process doesn't have (e.g. workers don't poll telegram) are left out.
+    """
+    if config.metrics_port is None:
+        return None
+    registry = metrics.registry
+    registry.enable()
+    github_api = get_github_api(config.github_tokens)
+    registry.add_stats('trending_cache', 'Trending cache stats.', trending_cache.stats.as_dict,
+                       counters=CacheStats.counters)
+    registry.add_stats('github_single_flight', 'Github requests shared by concurrent callers.',
+                       github_api.single_flight_stats.as_dict, counters=SingleFlightStats.counters)
+    registry.add_stats('github_token', 'Github requests and rate limit by token.', github_api.token_stats,
+                       labelname='token', counters=GithubTokenStats.counters + RateLimitStats.counters)
+    registry.add_stats('github_connection', 'Github connection pool stats.', github_api.connection_stats,
+                       counters=CONNECTION_STATS_COUNTERS)
+    registry.add_stats('github_conditional', 'Github conditional search requests.',
+                       github_api.conditional_stats.as_dict, counters=ConditionalStats.counters)
+    if telegram_api is not None:
+        registry.add_stats('telegram_connection', 'Telegram connection pool stats.', telegram_api.connection_stats,
+                           counters=CONNECTION_STATS_COUNTERS)
+    if send_queue is not None:
+        registry.add_stats('send_queue', 'Send queue stats.', send_queue.stats.as_dict,
+                           counters=SendQueueStats.counters)
+    if updates_stats is not None:
+        registry.add_stats('updates', 'getUpdates batches stats.', updates_stats.as_dict,
+                           counters=UpdatesStats.counters)
+    try:
+        server = metrics.start_http_server(config.metrics_port, DEFAULT_METRICS_HOST)
+    except OSError:
+        logging.error('could not serve metrics on port %d', config.metrics_port, exc_info=True)
+        sys.exit(1)
+    logging.info('serving metrics on http://%s:%d%s', DEFAULT_METRICS_HOST, config.metrics_port, metrics.METRICS_PATH)
+    return server
+
+
+def _setup_state_or_exit(config: Config, offset_state=None):
+    """Plugs the state backend of `config` into `trending_cache` and returns the offset state to use."""
+    backend = _setup_trending_store_or_exit(config)
+    return _get_offset_state_or_exit(config, backend, offset_state)
+
+
+def _get_offset_state_or_exit(config: Config, backend: tp.Optional[state.StateBackend], offset_state=None):
+    if offset_state is not None:
+        return offset_state
+    if backend is None:
+        return BufferedFileOffsetState(OFFSET_PATH)
+    try:
+        return StateOffsetState(backend)
+    except state.StateBackendError:
+        logging.error('could not get offset from state %s', config.state_url, exc_info=True)
+        sys.exit(1)
+
+
+def _setup_trending_store_or_exit(config: Config) -> tp.Optional[state.StateBackend]:
+    if config.state_url is None:
+        return None
+    try:
+        backend = state.open_state_backend(config.state_url)
+    except state.StateBackendError:
+        logging.error('could not open state %s', config.state_url, exc_info=True)
+        sys.exit(1)
+    trending_cache.store = TrendingStore(backend)
+    return backend
+
 
+def _flush_offset_state(offset_state) -> None:
+    flush = getattr(offset_state, 'flush', None)
+    if flush is not None:
+        flush()
 
-def _get_commands_executor(config: Config) -> CommandsExecutor:
+
+def _handle_update(update: Update, send_queue: 'SendQueue', commands_executor: CommandsExecutor) -> None:
+    if update.message is None:
+        logging.info('update %r has no message', update.update_id)
+        return
+    with update_duration.time():
+        message_text = _get_reply_text(update, commands_executor)
+        _send_reply(send_queue, update.message.chat_id, message_text)
+
+
+def _get_reply_text(update: Update, commands_executor: CommandsExecutor) -> str:
+    parsed_message = _get_parsed_message(update)
+    try:
+        return commands_executor.execute(parsed_message)
+    except InvalidCommand as exc:
+        return str(exc)
+    except Error:
+        logging.error(f'got an error when executing {parsed_message!r}', exc_info=True)
+        return ERROR_REPLY_TEXT
+
+
+def _send_reply(send_queue: 'SendQueue', chat_id: int, message_text: str) -> None:
+    """`send_queue` never raises, it retries and logs failed messages itself."""
+    send_queue.send_message(
+        chat_id=chat_id,
+        text=message_text,
+        parse_mode='HTML',
+        disable_web_page_preview=True,
+        disable_notification=True,
+    )
+
+
+class UpdatesDispatcher:
+    """Handles a batch of updates on a pool of worker threads.
+
+    Updates from the same chat are handled one after another in the order they came in,
+    updates from different chats are handled concurrently.
+    """
+
+    def __init__(self, handle_update: tp.Callable[[Update], None], workers: int = DEFAULT_WORKERS) -> None:
+        self.handle_update = handle_update
+        self._executor = futures.ThreadPoolExecutor(max_workers=workers)
+
+    def dispatch(self, updates: tp.List[Update]) -> None:
+        """
+        Returns only after every update in `updates` has been handled.
+        """
+        pending = [
+            self._executor.submit(self._handle_chat_updates, chat_updates)
+            for chat_updates in _group_updates_by_chat(updates)
+        ]
+        futures.wait(pending)
+        for future in pending:
+            future.result()
+
+    def _handle_chat_updates(self, chat_updates: tp.List[Update]) -> None:
+        for update in chat_updates:
+            self.handle_update(update)
+
+
+class AdaptiveUpdatesLimit:
+    """Number of updates to request from telegram in one getUpdates call.
+
+    The limit doubles after a full batch, because more updates are probably waiting,
+    and halves after a batch that is less than half full.
+    """
+
+    def __init__(self, min_limit: int = TELEGRAM_UPDATES_LIMIT, max_limit: int = TELEGRAM_MAX_UPDATES_LIMIT) -> None:
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.value = min_limit
+
+    def update(self, batch_size: int) -> None:
+        if batch_size >= self.value:
+            self.value = min(self.value * 2, self.max_limit)
+        elif batch_size < self.value // 2:
+            self.value = max(self.value // 2, self.min_limit)
+
+
+class UpdatesStats(Stats):
+    """Sizes of getUpdates batches and queue lag: how long the updates waited in telegram, in seconds."""
+    fields = (
+        'batches', 'updates', 'full_batches', 'limit', 'last_batch_size', 'max_batch_size',
+        'last_queue_lag', 'max_queue_lag',
+    )
+    counters = ('batches', 'updates', 'full_batches')
+
+    def record_batch(self, updates: tp.List[Update], limit: int, now: tp.Optional[float] = None) -> None:
+        if now is None:
+            now = time.time()
+        dates = [update.message.date for update in updates if update.message is not None and update.message.date]
+        queue_lag = max(now - min(dates), 0) if dates else 0
+        self.incr('batches')
+        self.incr('updates', len(updates))
+        if len(updates) >= limit:
+            self.incr('full_batches')
+        self.set('limit', limit)
+        self.set('last_batch_size', len(updates))
+        self.set_max('max_batch_size', len(updates))
+        self.set('last_queue_lag', queue_lag)
+        self.set_max('max_queue_lag', queue_lag)
+        logging.info('got %d updates with limit %d, queue lag is %.1f seconds', len(updates), limit, queue_lag)
+
+
+def _group_updates_by_chat(updates: tp.List[Update]) -> tp.List[tp.List[Update]]:
+    updates_by_chat_id = collections.OrderedDict()
+    for update in updates:
+        chat_id = None if update.message is None else update.message.chat_id
+        updates_by_chat_id.setdefault(chat_id, []).append(update)
+    return list(updates_by_chat_id.values())
+
+
+def _get_commands_executor(config: Config, popularity: tp.Optional[PopularityTracker] = None,
+                           subscriptions: tp.Optional['SubscriptionStore'] = None,
+                           admission_control: tp.Optional[AdmissionControl] = None) -> CommandsExecutor:
+    """`admission_control` is made for `config.workers` threads when it's None."""
+    help_text = HELP_TEXT if subscriptions is None else f'{HELP_TEXT}\n\n{SUBSCRIPTIONS_HELP_TEXT}'
     commands = {
-        HELP_COMMAND: lambda _: HELP_TEXT,
-        START_COMMAND: lambda _: HELP_TEXT,
+        HELP_COMMAND: lambda _: help_text,
+        START_COMMAND: lambda _: help_text,
         ECHO_COMMAND: lambda args: '\n'.join(args),
-        SHOW_COMMAND: GithubShowCommand(config.github_token),
+        SHOW_COMMAND: GithubShowCommand(config.github_tokens, popularity=popularity),
         TIMESTAMP_COMMAND: TimestampCommand(),
+        SUBSCRIBE_COMMAND: SubscribeCommand(subscriptions),
+        UNSUBSCRIBE_COMMAND: UnsubscribeCommand(subscriptions),
     }
-    return CommandsExecutor(commands)
+    if admission_control is None:
+        admission_control = _get_threaded_admission_control(config.workers)
+    return CommandsExecutor(commands, admission_control)
+
+
+def _get_threaded_admission_control(workers: int) -> AdmissionControl:
+    """
+    Commands are executed by `workers` threads, and a command waiting for its turn takes a thread too.
+    Expensive commands run on a share of the threads and wait on all but one of the rest,
+    so one thread is always left to cheap commands and the others are rejected rather than queued.
+    """
+    max_concurrent = _get_expensive_commands_concurrency(workers)
+    return AdmissionControl(max_concurrent=max_concurrent, max_waiting=max(workers - max_concurrent - 1, 0))
+
+
+def _get_expensive_commands_concurrency(workers: int) -> int:
+    return max(int(workers * EXPENSIVE_COMMANDS_WORKERS_SHARE), 1)
 
 
 def _get_parsed_message(update: Update) -> ParsedMessage:
     if update.message is None:
         parsed_message = ParsedMessage(
             HELP_COMMAND,
-            [],
+            (),
         )
     else:
         try:
-            parsed_message = parse_message_text(update.message.text)
+            parsed_message = parse_message_text(update.message.text)._replace(chat_id=update.message.chat_id)
         except ParseError:
+            # with the chat_id, messages without text count against the rate of the chat too
             parsed_message = ParsedMessage(
                 ECHO_COMMAND,
-                args=['oops, something went wrong'],
+                args=(ERROR_REPLY_TEXT,),
+                chat_id=update.message.chat_id,
             )
     return parsed_message
 
@@ -326,6 +2345,123 @@ class FileOffsetState:
             fileobj.write(str(offset))
 
 
+class BufferedFileOffsetState:
+    """Offset that is read from `path` once and then kept in memory.
+
+    It is written back to `path` when it was updated `flush_every` times or `flush_interval` seconds ago,
+    and on `flush`. Writes are atomic: a temporary file is written, fsynced and renamed over `path`.
+    A missing or corrupted file means offset 0, i.e. the earliest update that telegram still keeps.
+
+    Losing the latest offsets in a crash doesn't repeat many updates: telegram forgets the updates
+    that were confirmed by getUpdates with a greater offset, so only the last unconfirmed batch comes again.
+    """
+
+    def __init__(self, path: str, flush_interval: float = OFFSET_FLUSH_INTERVAL, flush_every: int = OFFSET_FLUSH_EVERY,
+                 timer: tp.Callable[[], float] = time.monotonic) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self.timer = timer
+        self._offset = _read_offset(path)
+        self._flushed_offset = self._offset
+        self._updates_since_flush = 0
+        self._flushed_at = timer()
+
+    @property
+    def offset(self) -> int:
+        return self._offset
+
+    @offset.setter
+    def offset(self, offset: int):
+        if offset != self._offset:
+            self._offset = offset
+            self._updates_since_flush += 1
+        if self._offset == self._flushed_offset:
+            return
+        is_due = self.timer() - self._flushed_at >= self.flush_interval
+        if is_due or self._updates_since_flush >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._offset != self._flushed_offset:
+            _write_atomically(self.path, str(self._offset))
+            self._flushed_offset = self._offset
+        self._updates_since_flush = 0
+        self._flushed_at = self.timer()
+
+
+class StateOffsetState:
+    """Offset kept in a state backend, it's read once and then every change is written through.
+
+    When the backend fails, the offset stays in memory and is written with the next change.
+    """
+
+    def __init__(self, backend: state.StateBackend, key: str = OFFSET_STATE_KEY) -> None:
+        self.backend = backend
+        self.key = key
+        self._offset = _get_offset_from_state(backend, key)
+        self._stored_offset = self._offset
+
+    @property
+    def offset(self) -> int:
+        return self._offset
+
+    @offset.setter
+    def offset(self, offset: int):
+        self._offset = offset
+        self.flush()
+
+    def flush(self) -> None:
+        if self._offset == self._stored_offset:
+            return
+        try:
+            self.backend.set(self.key, str(self._offset).encode('ascii'))
+        except state.StateBackendError:
+            logging.error('could not store offset %d', self._offset, exc_info=True)
+        else:
+            self._stored_offset = self._offset
+
+
+def _get_offset_from_state(backend: state.StateBackend, key: str) -> int:
+    """
+    :raises StateBackendError:
+    """
+    data = backend.get(key)
+    if data is None:
+        logging.warning('%s is missing from the state, starting from offset 0', key)
+        return 0
+    try:
+        return int(data)
+    except ValueError:
+        logging.error('%s is corrupted in the state, starting from offset 0', key, exc_info=True)
+        return 0
+
+
+def _read_offset(path: str) -> int:
+    try:
+        with open(path, 'r') as fileobj:
+            return int(fileobj.read())
+    except FileNotFoundError:
+        logging.warning('%s does not exist, starting from offset 0', path)
+    except ValueError:
+        logging.error('%s is corrupted, starting from offset 0', path, exc_info=True)
+    return 0
+
+
+def _write_atomically(path: str, content: str) -> None:
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as fileobj:
+        fileobj.write(content)
+        fileobj.flush()
+        os.fsync(fileobj.fileno())
+    os.replace(tmp_path, path)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
 def _get_next_offset(offset_state: FileOffsetState, bot_updates: tp.List[Update]) -> int:
     if not bot_updates:
         return offset_state.offset
@@ -358,35 +2494,128 @@ def _get_config_or_exit(environment: tp.Mapping[str, str]) -> Config:
         sys.exit(1)
 
 
+def _get_positive_int_or_invalid_config(environment: tp.Mapping[str, str], key: str,
+                                        default: tp.Optional[int]) -> tp.Optional[int]:
+    """
+    :raises InvalidConfig: When `key` is present in `environment` but is not a positive integer.
+    """
+    if key not in environment:
+        return default
+    try:
+        value = int(environment[key])
+    except ValueError:
+        raise InvalidConfig(f'{key} should be an integer, got {environment[key]!r}')
+    if value <= 0:
+        raise InvalidConfig(f'{key} should be positive, got {value}')
+    return value
+
+
+def _get_int_list_or_invalid_config(environment: tp.Mapping[str, str], key: str,
+                                    default: tp.Sequence[int]) -> tp.Sequence[int]:
+    """
+    :raises InvalidConfig: When `key` is present in `environment` but is not a comma-separated list of integers.
+    """
+    if key not in environment:
+        return default
+    try:
+        return tuple(int(item) for item in environment[key].split(',') if item.strip())
+    except ValueError:
+        raise InvalidConfig(f'{key} should be a comma-separated list of integers, got {environment[key]!r}')
+
+
+def _get_ages_in_days_or_invalid_config(environment: tp.Mapping[str, str], key: str,
+                                        default: tp.Sequence[int]) -> tp.Sequence[int]:
+    """
+    :raises InvalidConfig: When `key` is present in `environment` but is not a comma-separated list of integers
+        from 1 to MAX_AGE_IN_DAYS, like DAYS of `/show`.
+    """
+    ages_in_days = _get_int_list_or_invalid_config(environment, key, default)
+    for age_in_days in ages_in_days:
+        if not 0 < age_in_days <= MAX_AGE_IN_DAYS:
+            raise InvalidConfig(f'{key} should contain days from 1 to {MAX_AGE_IN_DAYS}, got {age_in_days}')
+    return ages_in_days
+
+
+def _get_github_tokens_or_invalid_config(environment: tp.Mapping[str, str]) -> tp.Tuple[str, ...]:
+    """
+    :raises InvalidConfig: When 'GITHUB_TOKEN' is missing or has no tokens.
+    """
+    value = _get_or_invalid_config(environment, 'GITHUB_TOKEN')
+    github_tokens = tuple(token.strip() for token in value.split(',') if token.strip())
+    if not github_tokens:
+        raise InvalidConfig('GITHUB_TOKEN has no tokens')
+    return github_tokens
+
+
 def get_config(environment: tp.Mapping[str, str]) -> Config:
     """
+    'GITHUB_TOKEN' is a comma-separated list of github tokens.
+    'STATE_URL' is an optional url of a state backend, e.g. 'sqlite:///var/lib/github_trending_bot/state.db'.
+    'METRICS_PORT' is an optional port of the /metrics endpoint on localhost.
+    'GITHUB_API_BASE' and 'TELEGRAM_API_BASE' optionally replace the urls of github and telegram apis.
+
     :raises InvalidConfig: When either 'GITHUB_TOKEN' or 'TELEGRAM_TOKEN' are missing
     """
-    github_token = _get_or_invalid_config(environment, 'GITHUB_TOKEN')
+    github_tokens = _get_github_tokens_or_invalid_config(environment)
     telegram_token = _get_or_invalid_config(environment, 'TELEGRAM_TOKEN')
+    workers = _get_positive_int_or_invalid_config(environment, 'WORKERS', DEFAULT_WORKERS)
+    prewarm_ages_in_days = _get_ages_in_days_or_invalid_config(
+        environment, 'PREWARM_DAYS', DEFAULT_PREWARM_AGES_IN_DAYS)
     return Config(
-        github_token=github_token,
+        github_tokens=github_tokens,
         telegram_token=telegram_token,
+        workers=workers,
+        prewarm_ages_in_days=prewarm_ages_in_days,
+        state_url=environment.get('STATE_URL'),
+        metrics_port=_get_positive_int_or_invalid_config(environment, 'METRICS_PORT', None),
+        github_api_base=environment.get('GITHUB_API_BASE', GITHUB_API_BASE),
+        telegram_api_base=environment.get('TELEGRAM_API_BASE', TELEGRAM_API_BASE),
     )
 
 
 def format_html_message(repositories: tp.List[Repo]) -> str:
-    message_parts = []
-    for repo in repositories:
-        part = f'<a href="{html.escape(repo.html_url)}">{html.escape(repo.name)}</a> - {html.escape(repo.description)}'
-        if repo.language is not None:
-            language_part = f'{html.escape(repo.language)} '
-        else:
-            language_part = ''
-        part += f' [{language_part}{repo.stargazers_count}{STAR_SYMBOL}]'
-        message_parts.append(part)
-    return '\n\n'.join(message_parts)
+    """
+    Rendered messages and rendered repositories are memoized by their content,
+    so unchanged cached lists and repositories shared by several lists are rendered once.
+    """
+    return _format_html_message(tuple(_get_repo_html_key(repo) for repo in repositories))
+
+
+def _get_repo_html_key(repo: Repo) -> tp.Tuple:
+    return repo.name, repo.description, repo.html_url, repo.language, repo.stargazers_count
+
+
+@functools.lru_cache(maxsize=HTML_MESSAGE_CACHE_MAXSIZE)
+def _format_html_message(repo_html_keys: tp.Tuple[tp.Tuple, ...]) -> str:
+    return '\n\n'.join(_format_repo_html(*key) for key in repo_html_keys)
+
+
+@functools.lru_cache(maxsize=REPO_HTML_CACHE_MAXSIZE)
+def _format_repo_html(name: str, description: str, html_url: str, language: tp.Optional[str],
+                      stargazers_count: int) -> str:
+    part = f'<a href="{html.escape(html_url)}">{html.escape(name)}</a> - {html.escape(description)}'
+    if language is not None:
+        language_part = f'{html.escape(language)} '
+    else:
+        language_part = ''
+    part += f' [{language_part}{stargazers_count}{STAR_SYMBOL}]'
+    return part
 
 
 class TelegramApi:
-    def __init__(self, token: str, socket_timeout: int = DEFAULT_TELEGRAM_API_SOCKET_TIMEOUT) -> None:
+    def __init__(self, token: str, socket_timeout: int = DEFAULT_TELEGRAM_API_SOCKET_TIMEOUT,
+                 pool_connections: int = DEFAULT_POOL_CONNECTIONS, pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+                 max_retries: int = DEFAULT_MAX_RETRIES, api_base: str = TELEGRAM_API_BASE) -> None:
         self.token = token
         self.socket_timeout = socket_timeout
+        self.api_base = api_base
+        self.session = _make_session(pool_connections, pool_maxsize, max_retries)
+
+    def connection_stats(self) -> tp.Dict[str, int]:
+        return _get_connection_stats(self.session)
+
+    def close(self) -> None:
+        self.session.close()
 
     def send_message(self, chat_id: int, text: str, parse_mode: str = '', disable_web_page_preview: bool = False,
                      disable_notification: bool = False) -> None:
@@ -396,18 +2625,14 @@ class TelegramApi:
         if not text:
             return
         url = self._get_method_url('sendMessage')
-        params = {
-            'chat_id': chat_id,
-            'text': text,
-            'disable_web_page_preview': disable_web_page_preview,
-            'disable_notification': disable_notification,
-        }
-        if parse_mode:
-            params['parse_mode'] = parse_mode
-
+        params = _get_send_message_params(chat_id, text, parse_mode, disable_web_page_preview, disable_notification)
         logging.info('sending message to chat_id %s with params %r ...', chat_id, params)
         with _convert_exceptions(requests.RequestException, TelegramApiError):
-            response = requests.post(url, json=params, timeout=self.socket_timeout)
+            with telegram_request_duration.time('sendMessage'):
+                response = self.session.post(url, json=params, timeout=self.socket_timeout)
+            telegram_responses.inc('sendMessage', str(response.status_code))
+            if response.status_code == 429:
+                raise TelegramRetryAfter(_get_retry_after(_get_json_or_none(response)))
             response.raise_for_status()
         logging.info('sent message to chat_id %s with params %r', chat_id, params)
 
@@ -423,69 +2648,348 @@ class TelegramApi:
         )
         logging.info('getting updates from telegram ...')
         with _convert_exceptions(requests.RequestException, TelegramApiError):
-            response = requests.post(url, json=params, timeout=self.socket_timeout)
+            with telegram_request_duration.time('getUpdates'):
+                response = self.session.post(url, json=params, timeout=self.socket_timeout)
+            telegram_responses.inc('getUpdates', str(response.status_code))
             response.raise_for_status()
-        try:
-            response_data = response.json()
-        except ValueError as exc:
-            raise TelegramApiError(f"can't convert {response.text!r} to json") from exc
-        logging.info('got response %s', response_data)
-        result = _get_or_raise(response_data, 'result', list, TelegramApiError)
-        updates = [
-            _make_update_from_api_item(item)
-            for item in result
-            ]
+        logging.debug('got response %r', response.content)
+        updates = parse_updates_response(response.content)
         logging.info('got %d updates from telegram', len(updates))
         return updates
 
     def _get_method_url(self, method_name: str) -> str:
-        return urlparse.urljoin(
-            f'https://api.telegram.org/bot{self.token}/',
-            method_name,
-        )
+        return _get_telegram_method_url(self.api_base, self.token, method_name)
 
 
-def _is_message(update_item: tp.Mapping) -> bool:
+def _get_json_or_none(response: requests.Response):
     try:
-        _get_or_raise(update_item, 'message', dict, ValueError)
+        return response.json()
     except ValueError:
-        return False
-    else:
+        return None
+
+
+def _get_retry_after(response_data) -> float:
+    """Returns seconds to wait from the response to a request that exceeded the flood limit."""
+    try:
+        retry_after = response_data['parameters']['retry_after']
+    except (KeyError, TypeError):
+        return SEND_RETRY_INTERVAL
+    if not isinstance(retry_after, (int, float)) or retry_after < 0:
+        return SEND_RETRY_INTERVAL
+    return retry_after
+
+
+class TokenBucket:
+    """Gives out `rate` tokens per second, at most `capacity` of them are saved up while nobody takes them.
+
+    It's not thread-safe.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1, timer: tp.Callable[[], float] = time.monotonic) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.timer = timer
+        self._tokens = capacity
+        self._updated_at = timer()
+
+    def get_delay(self) -> float:
+        """Returns seconds until a token is available, 0 when it's available right now."""
+        self._refill()
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def take(self) -> None:
+        self._refill()
+        self._tokens -= 1
+
+    def try_take(self) -> bool:
+        if self.get_delay():
+            return False
+        self.take()
         return True
 
+    def pause(self, seconds: float) -> None:
+        """Makes the next token available not earlier than in `seconds`."""
+        self._refill()
+        self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+    def _refill(self) -> None:
+        now = self.timer()
+        self._tokens = min(self._tokens + (now - self._updated_at) * self.rate, self.capacity)
+        self._updated_at = now
+
+
+class SendQueueStats(Stats):
+    fields = ('queued', 'max_queued', 'sent', 'retries', 'flood_waits', 'failed')
+    counters = ('sent', 'retries', 'flood_waits', 'failed')
+
+
+class QueuedMessage:
+    """A message in `SendQueue`, `wait` tells when it's sent or dropped."""
+
+    def __init__(self, params: tp.Dict[str, tp.Any]) -> None:
+        self.params = params
+        self.attempts = 0
+        self.sent = False
+        self._done = threading.Event()
+
+    def wait(self, timeout: tp.Optional[float] = None) -> bool:
+        """Waits at most `timeout` seconds for the message to be sent or dropped, returns whether it was."""
+        return self._done.wait(timeout)
+
+
+class SendQueue:
+    """Sends messages to telegram on background threads, so that handling of updates doesn't wait for it.
+
+    It has the same `send_message` as `TelegramApi`, which only queues a message, and waits
+    while `maxsize` messages are already queued.
+    Messages are sent at most `global_rate` per second and at most `chat_rate` per second to the same chat,
+    messages to the same chat are sent in the order they were queued.
+    A message that exceeds the flood limit anyway is sent again after `retry_after` seconds that telegram asks for,
+    a message that fails otherwise is sent again `max_attempts` times at most.
+    Messages that are still queued when the process crashes are lost.
+    """
+
+    def __init__(self, telegram_api: 'TelegramApi', global_rate: float = TELEGRAM_GLOBAL_SEND_RATE,
+                 chat_rate: float = TELEGRAM_CHAT_SEND_RATE, maxsize: int = SEND_QUEUE_MAXSIZE,
+                 workers: int = SEND_QUEUE_WORKERS, max_attempts: int = SEND_MAX_ATTEMPTS,
+                 retry_interval: float = SEND_RETRY_INTERVAL, timer: tp.Callable[[], float] = time.monotonic) -> None:
+        self.telegram_api = telegram_api
+        self.chat_rate = chat_rate
+        self.maxsize = maxsize
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_interval = retry_interval
+        self.timer = timer
+        self.stats = SendQueueStats()
+        self._condition = threading.Condition()
+        # no burst, so that any second has at most `global_rate` messages like telegram counts them
+        self._global_bucket = TokenBucket(global_rate, timer=timer)
+        self._chat_buckets = {}
+        self._queued_by_chat_id = collections.OrderedDict()  # chat_id -> deque of QueuedMessage
+        self._size = 0
+        self._sending_chat_ids = set()
+        self._closed = False
+
+    def start(self) -> None:
+        for _ in range(self.workers):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def send_message(self, chat_id: int, text: str, parse_mode: str = '', disable_web_page_preview: bool = False,
+                     disable_notification: bool = False) -> tp.Optional[QueuedMessage]:
+        """Returns the queued message, or None when `text` is empty and there is nothing to send."""
+        if not text:
+            return None
+        message = QueuedMessage(dict(
+            text=text,
+            parse_mode=parse_mode,
+            disable_web_page_preview=disable_web_page_preview,
+            disable_notification=disable_notification,
+        ))
+        with self._condition:
+            while self._size >= self.maxsize:
+                self._condition.wait()
+            self._queued_by_chat_id.setdefault(chat_id, collections.deque()).append(message)
+            self._size += 1
+            self._forget_idle_chats()
+            self._condition.notify_all()
+        self.stats.set('queued', self._size)
+        self.stats.set_max('max_queued', self._size)
+        return message
+
+    def close(self, timeout: float = SEND_QUEUE_CLOSE_TIMEOUT) -> None:
+        """Waits at most `timeout` seconds for the queued messages to be sent and stops sending."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: not self._size, timeout):
+                logging.error('%d messages were not sent', self._size)
+            self._closed = True
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            taken = self._take()
+            if taken is None:
+                return
+            self._send(*taken)
+
+    def _take(self) -> tp.Optional[tp.Tuple[int, QueuedMessage]]:
+        """Waits for a message that can be sent within the flood limits."""
+        with self._condition:
+            while not self._closed:
+                delay = None
+                for chat_id, messages in self._queued_by_chat_id.items():
+                    if chat_id in self._sending_chat_ids:
+                        continue
+                    chat_delay = self._get_chat_bucket(chat_id).get_delay()
+                    if chat_delay:
+                        delay = chat_delay if delay is None else min(delay, chat_delay)
+                        continue
+                    global_delay = self._global_bucket.get_delay()
+                    if global_delay:
+                        delay = global_delay if delay is None else min(delay, global_delay)
+                        break
+                    self._global_bucket.take()
+                    self._get_chat_bucket(chat_id).take()
+                    message = messages.popleft()
+                    if not messages:
+                        del self._queued_by_chat_id[chat_id]
+                    self._sending_chat_ids.add(chat_id)
+                    return chat_id, message
+                self._condition.wait(delay)
+        return None
+
+    def _send(self, chat_id: int, message: QueuedMessage) -> None:
+        message.attempts += 1
+        retry_after = None
+        try:
+            self.telegram_api.send_message(chat_id=chat_id, **message.params)
+        except TelegramRetryAfter as exc:
+            logging.warning('could not send message to chat_id %s: %s', chat_id, exc)
+            self.stats.incr('flood_waits')
+            retry_after = exc.retry_after
+        except TelegramApiError:
+            if message.attempts < self.max_attempts:
+                logging.warning('could not send message to chat_id %s, retrying ...', chat_id, exc_info=True)
+                self.stats.incr('retries')
+                retry_after = self.retry_interval
+            else:
+                logging.error('could not send message to chat_id %s, dropping it', chat_id, exc_info=True)
+                self.stats.incr('failed')
+        else:
+            message.sent = True
+            self.stats.incr('sent')
+        with self._condition:
+            self._sending_chat_ids.discard(chat_id)
+            if retry_after is None:
+                self._size -= 1
+                message._done.set()
+            else:
+                self._get_chat_bucket(chat_id).pause(retry_after)
+                self._queued_by_chat_id.setdefault(chat_id, collections.deque()).appendleft(message)
+            self._condition.notify_all()
+        self.stats.set('queued', self._size)
+
+    def _get_chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, timer=self.timer)
+        return bucket
+
+    def _forget_idle_chats(self) -> None:
+        """Forgets buckets of chats that could send right now anyway, so that buckets don't pile up."""
+        if len(self._chat_buckets) <= self.maxsize:
+            return
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            is_busy = chat_id in self._queued_by_chat_id or chat_id in self._sending_chat_ids
+            if not is_busy and bucket.is_full():
+                del self._chat_buckets[chat_id]
+
+
+def _get_telegram_method_url(api_base: str, token: str, method_name: str) -> str:
+    return urlparse.urljoin(
+        f'{api_base}/bot{token}/',
+        method_name,
+    )
+
+
+def _get_send_message_params(chat_id: int, text: str, parse_mode: str, disable_web_page_preview: bool,
+                             disable_notification: bool) -> tp.Dict[str, tp.Any]:
+    params = {
+        'chat_id': chat_id,
+        'text': text,
+        'disable_web_page_preview': disable_web_page_preview,
+        'disable_notification': disable_notification,
+    }
+    if parse_mode:
+        params['parse_mode'] = parse_mode
+    return params
+
+
+def parse_updates_response(data: bytes) -> tp.List[Update]:
+    """
+    Parses the body of a getUpdates response.
+
+    :raises TelegramApiError:
+    """
+    try:
+        response_data = loads_json(data)
+    except ValueError as exc:
+        raise TelegramApiError(f"can't convert {data[:1000]!r} to json") from exc
+    return _make_updates_from_api_response(response_data)
+
+
+def loads_json(data: tp.Union[bytes, str]):
+    """
+    Uses orjson when it's installed.
+
+    :raises ValueError:
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _make_updates_from_api_response(response_data) -> tp.List[Update]:
+    """
+    :raises TelegramApiError:
+    """
+    if not isinstance(response_data, dict):
+        raise TelegramApiError(f'response should be an object, got {response_data!r}')
+    result = _get_or_raise(response_data, 'result', list, TelegramApiError)
+    return [
+        _make_update_from_api_item(item)
+        for item in result
+        ]
+
 
 def _make_update_from_api_item(item: tp.Mapping) -> Update:
     """
+    Looks only at the fields that the bot needs, an update without a valid message gets None instead of it.
+
     :raises TelegramApiError:
     """
+    if not isinstance(item, dict):
+        raise TelegramApiError(f'update should be an object, got {item!r}')
     update_id = _get_or_raise(item, 'update_id', int, TelegramApiError)
-    try:
-        message = _make_message_from_api_item(item)
-    except ValueError:
+    message_item = item.get('message')
+    if message_item is None:
+        return Update(update_id=update_id, message=None)
+    message = _make_message_from_api_item(message_item)
+    if message is None:
         logging.error("can't parse %r into message", item)
-        message = None
     return Update(
         update_id=update_id,
         message=message,
     )
 
 
-def _make_message_from_api_item(item: tp.Mapping) -> tp.Union[Message, None]:
-    """
-    :raises ValueError: When can't parse item as a Message
-    """
-    if not _is_message(item):
+def _make_message_from_api_item(message_item) -> tp.Optional[Message]:
+    """Returns None when `message_item` is not a valid message."""
+    if not isinstance(message_item, dict):
+        return None
+    chat_item = message_item.get('chat')
+    if not isinstance(chat_item, dict):
+        return None
+    chat_id = chat_item.get('id')
+    message_id = message_item.get('message_id')
+    text = message_item.get('text', '')
+    date = message_item.get('date')
+    is_valid = (
+        isinstance(chat_id, int) and isinstance(message_id, int) and isinstance(text, str)
+        and (date is None or isinstance(date, int))
+    )
+    if not is_valid:
         return None
-    message_item = _get_or_raise(item, 'message', dict, ValueError)
-    chat_item = _get_or_raise(message_item, 'chat', dict, ValueError)
-    if 'text' not in message_item:
-        text = ''
-    else:
-        text = _get_or_raise(message_item, 'text', str, ValueError)
     return Message(
-        chat_id=_get_or_raise(chat_item, 'id', int, ValueError),
-        message_id=_get_or_raise(message_item, 'message_id', int, ValueError),
+        chat_id=chat_id,
+        message_id=message_id,
         text=text,
+        date=date,
     )
 
 
@@ -498,5 +3002,5 @@ def parse_message_text(text: str) -> ParsedMessage:
     splitted = text.split(' ')
     return ParsedMessage(
         name=splitted[0],
-        args=splitted[1:],
+        args=tuple(splitted[1:]),
     )
@@ -0,0 +1,276 @@
+"""Counters, gauges and histograms exposed over http in the Prometheus text format.
+
+Metrics are recorded only after `Registry.enable`, until then recording a metric is a single attribute check.
+"""
+import http.server
+import math
+import socketserver
+import threading
+import time
+import typing as tp
+
+METRICS_PREFIX = 'github_trending_bot_'
+METRICS_PATH = '/metrics'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # seconds
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LabelValues = tp.Tuple[str, ...]
+Sample = tp.Tuple[str, tp.Dict[str, str], float]  # suffix of the name, labels and value
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, registry: 'Registry', name: str, help_text: str, labelnames: tp.Sequence[str] = ()) -> None:
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}  # label values -> value
+
+    def collect(self) -> tp.List[Sample]:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            sample
+            for label_values, value in sorted(values)
+            for sample in self._get_samples(dict(zip(self.labelnames, label_values)), value)
+        ]
+
+    def _get_samples(self, labels: tp.Dict[str, str], value) -> tp.List[Sample]:
+        return [('', labels, value)]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values: str, value: float = 1) -> None:
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, *label_values: str) -> None:
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry: 'Registry', name: str, help_text: str, labelnames: tp.Sequence[str] = (),
+                 buckets: tp.Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(registry, name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, *label_values: str) -> None:
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            observations = self._values.get(label_values)
+            if observations is None:
+                observations = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            bucket_counts = observations[0]
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    bucket_counts[i] += 1
+                    break
+            observations[1] += value
+            observations[2] += 1
+
+    def time(self, *label_values: str) -> tp.ContextManager:
+        """Observes seconds spent in the `with` block."""
+        if not self.registry.enabled:
+            return _NO_TIMER
+        return _Timer(self, label_values)
+
+    def collect(self) -> tp.List[Sample]:
+        with self._lock:
+            values = [(label_values, [list(observations[0])] + observations[1:])
+                      for label_values, observations in self._values.items()]
+        return [
+            sample
+            for label_values, observations in sorted(values)
+            for sample in self._get_samples(dict(zip(self.labelnames, label_values)), observations)
+        ]
+
+    def _get_samples(self, labels: tp.Dict[str, str], observations) -> tp.List[Sample]:
+        bucket_counts, total, count = observations
+        samples = []
+        cumulative_count = 0
+        for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative_count += bucket_count
+            samples.append(('_bucket', dict(labels, le=_format_value(upper_bound)), cumulative_count))
+        samples.append(('_sum', labels, total))
+        samples.append(('_count', labels, count))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, label_values: LabelValues) -> None:
+        self.histogram = histogram
+        self.label_values = label_values
+        self._started_at = None
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self._started_at, *self.label_values)
+        return False
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+class _StatsCollector:
+    """Exposes every field of stats returned by `get_stats` as a counter when it's in `counters`, else as a gauge."""
+
+    def __init__(self, name: str, help_text: str, get_stats: tp.Callable[[], tp.Mapping],
+                 labelname: tp.Optional[str] = None, counters: tp.Collection[str] = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.get_stats = get_stats
+        self.labelname = labelname
+        self.counters = frozenset(counters)
+
+    def collect_by_name(self) -> tp.Dict[str, tp.Tuple[str, tp.List[Sample]]]:
+        """Returns the kind and samples of every exposed field by its name."""
+        stats = self.get_stats()
+        if self.labelname is None:
+            stats = {None: stats}
+        by_name = {}
+        for label_value, one_stats in sorted(stats.items(), key=lambda item: str(item[0])):
+            labels = {} if self.labelname is None else {self.labelname: str(label_value)}
+            for field, value in one_stats.items():
+                if isinstance(value, (int, float)):
+                    kind = Counter.kind if field in self.counters else Gauge.kind
+                    by_name.setdefault(f'{self.name}_{field}', (kind, []))[1].append(('', labels, value))
+        return by_name
+
+
+class Registry:
+    def __init__(self, prefix: str = METRICS_PREFIX) -> None:
+        self.prefix = prefix
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._stats_collectors = []
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def counter(self, name: str, help_text: str, labelnames: tp.Sequence[str] = ()) -> Counter:
+        return self._add(Counter(self, name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: tp.Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(self, name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: tp.Sequence[str] = (),
+                  buckets: tp.Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(self, name, help_text, labelnames, buckets))
+
+    def add_stats(self, name: str, help_text: str, get_stats: tp.Callable[[], tp.Mapping],
+                  labelname: tp.Optional[str] = None, counters: tp.Collection[str] = ()) -> None:
+        """
+        Exposes stats that are already counted elsewhere, e.g. `Stats.as_dict`, as metrics named `name`_<field>.
+        Fields in `counters` only ever grow and are exposed as counters, the other fields are exposed as gauges.
+        With `labelname` `get_stats` returns stats by the value of that label.
+        """
+        with self._lock:
+            self._stats_collectors.append(_StatsCollector(name, help_text, get_stats, labelname, counters))
+
+    def expose(self) -> str:
+        """Returns all metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics)
+            stats_collectors = list(self._stats_collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(self._format_family(metric.name, metric.kind, metric.help_text, metric.collect()))
+        for stats_collector in stats_collectors:
+            for name, (kind, samples) in stats_collector.collect_by_name().items():
+                lines.extend(self._format_family(name, kind, stats_collector.help_text, samples))
+        return ''.join(line + '\n' for line in lines)
+
+    def _add(self, metric: Metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def _format_family(self, name: str, kind: str, help_text: str, samples: tp.List[Sample]) -> tp.List[str]:
+        full_name = self.prefix + name
+        lines = [f'# HELP {full_name} {_escape_help(help_text)}', f'# TYPE {full_name} {kind}']
+        for suffix, labels, value in samples:
+            lines.append(f'{full_name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return lines
+
+
+def _format_labels(labels: tp.Mapping[str, str]) -> str:
+    if not labels:
+        return ''
+    formatted = ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in labels.items())
+    return '{' + formatted + '}'
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _escape_help(help_text: str) -> str:
+    return help_text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port: int, host: str = '127.0.0.1', metrics_registry: tp.Optional[Registry] = None):
+    """Serves `metrics_registry` on `METRICS_PATH` in a background thread and returns the server."""
+    metrics_registry = registry if metrics_registry is None else metrics_registry
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != METRICS_PATH:
+                self.send_error(404)
+                return
+            body = metrics_registry.expose().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = _ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+registry = Registry()
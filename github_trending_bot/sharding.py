@@ -0,0 +1,296 @@
+"""Bot split into one ingress process and several worker processes.
+
+The ingress polls telegram and sends every update to the worker of its chat, `chat_id % shards`,
+so updates of the same chat are handled by one worker in the order they came in.
+Workers execute commands and return replies, the ingress sends them to telegram and
+moves the offset forward only after every worker has returned the replies of a batch.
+When a worker fails, the batch is handled again from the start, no reply of it is sent twice.
+
+Workers listen on `SHARD_LISTEN_ADDRESS` and the ingress connects to all of `SHARD_ADDRESSES`,
+both authenticate with `SHARD_AUTHKEY`. Batches are pickled, so workers should be reachable only by the ingress.
+"""
+import collections
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import typing as tp
+from contextlib import contextmanager
+from multiprocessing.connection import Client, Connection, Listener
+
+from github_trending_bot import bot
+
+SHARD_TIMEOUT = 60  # seconds a worker has to handle a batch
+SHARD_RETRY_INTERVAL = 10  # seconds
+
+Address = tp.Tuple[str, int]
+Reply = tp.Tuple[int, str]  # chat_id and text
+
+
+class ShardError(bot.Error):
+    pass
+
+
+def get_shard(chat_id: int, shards: int) -> int:
+    return chat_id % shards
+
+
+class ShardClient:
+    """Connection of the ingress to one worker, it's reopened after a failure."""
+
+    def __init__(self, address: Address, authkey: bytes, timeout: float = SHARD_TIMEOUT,
+                 connect: tp.Callable[..., Connection] = None) -> None:
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+        self.connect = connect or Client
+        self._connection = None
+
+    def send(self, batch_id: int, updates: tp.List[bot.Update]) -> None:
+        """
+        :raises ShardError:
+        """
+        with self._close_on_error():
+            if self._connection is None:
+                self._connection = self.connect(self.address, authkey=self.authkey)
+            self._connection.send((batch_id, updates))
+
+    def receive(self, batch_id: int) -> tp.List[Reply]:
+        """
+        Replies to earlier batches that failed on other workers are skipped.
+
+        :raises ShardError:
+        """
+        with self._close_on_error():
+            while True:
+                if not self._connection.poll(self.timeout):
+                    raise ShardError(
+                        f'worker {self.address} did not handle batch {batch_id} in {self.timeout} seconds')
+                received_batch_id, replies = self._connection.recv()
+                if received_batch_id == batch_id:
+                    return replies
+                if received_batch_id > batch_id:
+                    raise ShardError(f'worker {self.address} returned batch {received_batch_id} before {batch_id}')
+                logging.info('skipping replies of batch %d from worker %s', received_batch_id, self.address)
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @contextmanager
+    def _close_on_error(self):
+        try:
+            yield
+        except ShardError:
+            self.close()
+            raise
+        except (OSError, EOFError, multiprocessing.AuthenticationError) as exc:
+            self.close()
+            raise ShardError(f'worker {self.address} failed') from exc
+
+
+class ShardedDispatcher:
+    """Sends updates to the workers of their chats and collects the replies."""
+
+    def __init__(self, shard_clients: tp.List[ShardClient]) -> None:
+        self.shard_clients = shard_clients
+        self._batch_id = 0
+
+    def dispatch(self, updates: tp.List[bot.Update]) -> tp.List[Reply]:
+        """
+        Returns only after every worker has handled its updates.
+
+        :raises ShardError: When any of the workers fails, no replies are returned then.
+        """
+        self._batch_id += 1
+        updates_by_shard = collections.defaultdict(list)
+        for update in updates:
+            if update.message is None:
+                logging.info('update %r has no message', update.update_id)
+                continue
+            updates_by_shard[get_shard(update.message.chat_id, len(self.shard_clients))].append(update)
+        for shard, shard_updates in updates_by_shard.items():
+            self.shard_clients[shard].send(self._batch_id, shard_updates)
+        replies = []
+        for shard in updates_by_shard:
+            replies.extend(self.shard_clients[shard].receive(self._batch_id))
+        return replies
+
+    def close(self) -> None:
+        for shard_client in self.shard_clients:
+            shard_client.close()
+
+
+class ShardWorker:
+    """Handles batches of updates sent by the ingress and returns replies to them."""
+
+    def __init__(self, commands_executor: bot.CommandsExecutor, workers: int = bot.DEFAULT_WORKERS) -> None:
+        self.commands_executor = commands_executor
+        self._dispatcher = bot.UpdatesDispatcher(self._handle_update, workers)
+        self._lock = threading.Lock()  # one batch at a time, its updates are handled concurrently
+        self._replies_by_update_id = {}
+
+    def handle_batch(self, updates: tp.List[bot.Update]) -> tp.List[Reply]:
+        with self._lock:
+            self._replies_by_update_id = {}
+            self._dispatcher.dispatch(updates)
+            return [
+                self._replies_by_update_id[update.update_id]
+                for update in updates
+                if update.update_id in self._replies_by_update_id
+            ]
+
+    def serve(self, listener: Listener) -> None:
+        """Serves connections from `listener` one at a time until it's closed."""
+        while True:
+            try:
+                connection = listener.accept()
+            except multiprocessing.AuthenticationError:
+                logging.error('could not authenticate connection', exc_info=True)
+                continue
+            except OSError:
+                logging.info('listener is closed')
+                return
+            with connection:
+                self._serve_connection(connection)
+
+    def _serve_connection(self, connection: Connection) -> None:
+        while True:
+            try:
+                batch_id, updates = connection.recv()
+            except (EOFError, OSError):
+                logging.info('ingress disconnected')
+                return
+            logging.info('got batch %d of %d updates', batch_id, len(updates))
+            replies = self.handle_batch(updates)
+            try:
+                connection.send((batch_id, replies))
+            except OSError:
+                logging.info('ingress disconnected')
+                return
+
+    def _handle_update(self, update: bot.Update) -> None:
+        if update.message is None:
+            return
+        with bot.update_duration.time():
+            text = bot._get_reply_text(update, self.commands_executor)
+        self._replies_by_update_id[update.update_id] = (update.message.chat_id, text)
+
+
+def ingress_main(offset_state=None):
+    bot._configure_logging()
+    config = bot._get_config_or_exit(os.environ)
+    addresses, authkey = _get_or_exit(get_ingress_config, os.environ)
+    offset_state = bot._setup_state_or_exit(config, offset_state)
+    telegram_api = bot.TelegramApi(config.telegram_token, api_base=config.telegram_api_base)
+    dispatcher = ShardedDispatcher([ShardClient(address, authkey) for address in addresses])
+    send_queue = bot.SendQueue(telegram_api)
+    send_queue.start()
+    updates_limit = bot.AdaptiveUpdatesLimit()
+    updates_stats = bot.UpdatesStats()
+    metrics_server = bot._start_metrics_server(config, telegram_api, send_queue, updates_stats)
+    try:
+        while True:
+            try:
+                updates = telegram_api.get_updates(
+                    offset=offset_state.offset,
+                    limit=updates_limit.value,
+                    timeout=bot.DEFAULT_TELEGRAM_API_LONG_POLLING_TIMEOUT,
+                )
+            except bot.TelegramApiError:
+                bot.polls.inc('error')
+                logging.error('could not get updates from telegram, sleeping 10 seconds ...', exc_info=True)
+                time.sleep(10)
+                continue
+
+            bot.polls.inc('ok')
+            updates_stats.record_batch(updates, updates_limit.value)
+            updates_limit.update(len(updates))
+            try:
+                replies = dispatcher.dispatch(updates)
+            except ShardError:
+                logging.error(f'could not handle updates, sleeping {SHARD_RETRY_INTERVAL} seconds ...',
+                              exc_info=True)
+                time.sleep(SHARD_RETRY_INTERVAL)
+                continue
+            for chat_id, text in replies:
+                bot._send_reply(send_queue, chat_id, text)
+            offset_state.offset = bot._get_next_offset(offset_state, updates)
+    finally:
+        bot._flush_offset_state(offset_state)
+        dispatcher.close()
+        send_queue.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+
+def worker_main():
+    bot._configure_logging()
+    config = bot._get_config_or_exit(os.environ)
+    address, authkey = _get_or_exit(get_worker_config, os.environ)
+    bot._setup_trending_store_or_exit(config)
+    bot._setup_github_api_base(config)
+    popularity = bot.PopularityTracker()
+    commands_executor = bot._get_commands_executor(config, popularity)
+    bot.TrendingPrewarmer(config.github_tokens, config.prewarm_ages_in_days, popularity).start()
+    worker = ShardWorker(commands_executor, config.workers)
+    bot._start_metrics_server(config)
+    with Listener(address, authkey=authkey) as listener:
+        logging.info('listening for batches on %s:%d', *address)
+        worker.serve(listener)
+
+
+def get_ingress_config(environment: tp.Mapping[str, str]) -> tp.Tuple[tp.List[Address], bytes]:
+    """
+    'SHARD_ADDRESSES' is a comma-separated list of host:port of workers.
+
+    :raises InvalidConfig: When either 'SHARD_ADDRESSES' or 'SHARD_AUTHKEY' are missing or invalid.
+    """
+    value = bot._get_or_invalid_config(environment, 'SHARD_ADDRESSES')
+    addresses = [
+        _parse_address_or_invalid_config('SHARD_ADDRESSES', address.strip())
+        for address in value.split(',')
+        if address.strip()
+    ]
+    if not addresses:
+        raise bot.InvalidConfig('SHARD_ADDRESSES has no addresses')
+    return addresses, _get_authkey_or_invalid_config(environment)
+
+
+def get_worker_config(environment: tp.Mapping[str, str]) -> tp.Tuple[Address, bytes]:
+    """
+    :raises InvalidConfig: When either 'SHARD_LISTEN_ADDRESS' or 'SHARD_AUTHKEY' are missing or invalid.
+    """
+    value = bot._get_or_invalid_config(environment, 'SHARD_LISTEN_ADDRESS')
+    return _parse_address_or_invalid_config('SHARD_LISTEN_ADDRESS', value), _get_authkey_or_invalid_config(environment)
+
+
+def _parse_address_or_invalid_config(key: str, value: str) -> Address:
+    """
+    :raises InvalidConfig:
+    """
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise bot.InvalidConfig(f'{key} should contain host:port, got {value!r}')
+    return host, int(port)
+
+
+def _get_authkey_or_invalid_config(environment: tp.Mapping[str, str]) -> bytes:
+    """
+    :raises InvalidConfig:
+    """
+    authkey = bot._get_or_invalid_config(environment, 'SHARD_AUTHKEY')
+    if not authkey:
+        raise bot.InvalidConfig('SHARD_AUTHKEY is empty')
+    return authkey.encode('utf-8')
+
+
+def _get_or_exit(get_config: tp.Callable, environment: tp.Mapping[str, str]):
+    try:
+        return get_config(environment)
+    except bot.InvalidConfig as exc:
+        logging.error('invalid config: %s', exc)
+        sys.exit(1)
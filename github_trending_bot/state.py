@@ -0,0 +1,221 @@
+"""Key-value storage of the bot state that outlives the process and can be shared by several processes."""
+import socket
+import sqlite3
+import threading
+import time
+import typing as tp
+import urllib.parse as urlparse
+
+DEFAULT_REDIS_PORT = 6379
+DEFAULT_REDIS_SOCKET_TIMEOUT = 5  # seconds
+SQLITE_PURGE_INTERVAL = 600  # seconds between deletes of expired values
+
+
+class StateBackendError(Exception):
+    pass
+
+
+class StateBackend:
+    """Stores bytes by string keys."""
+
+    def get(self, key: str) -> tp.Optional[bytes]:
+        """
+        :raises StateBackendError:
+        """
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl: tp.Optional[float] = None) -> None:
+        """
+        Stores `value` for `ttl` seconds or forever when `ttl` is None.
+
+        :raises StateBackendError:
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteStateBackend(StateBackend):
+    """State in an SQLite database in WAL mode, so that several processes can read it while one writes.
+
+    Expired values are deleted by writes, at most once in `purge_interval` seconds.
+    """
+
+    def __init__(self, path: str, timer: tp.Callable[[], float] = time.time,
+                 purge_interval: float = SQLITE_PURGE_INTERVAL) -> None:
+        self.path = path
+        self.timer = timer
+        self.purge_interval = purge_interval
+        self._lock = threading.Lock()
+        self._purged_at = None
+        with self._convert_exceptions():
+            self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)'
+            )
+
+    def get(self, key: str) -> tp.Optional[bytes]:
+        with self._lock, self._convert_exceptions():
+            row = self._connection.execute(
+                'SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+                (key, self.timer()),
+            ).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def set(self, key: str, value: bytes, ttl: tp.Optional[float] = None) -> None:
+        now = self.timer()
+        expires_at = None if ttl is None else now + ttl
+        with self._lock, self._convert_exceptions():
+            self._connection.execute(
+                'INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, value, expires_at),
+            )
+            if self._purged_at is None or now - self._purged_at >= self.purge_interval:
+                self._connection.execute('DELETE FROM state WHERE expires_at <= ?', (now,))
+                self._purged_at = now
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    @staticmethod
+    def _convert_exceptions():
+        return _ConvertExceptions(sqlite3.Error)
+
+
+class RedisStateBackend(StateBackend):
+    """State in Redis or in anything that speaks its protocol, talks RESP over a single connection."""
+
+    def __init__(self, host: str = 'localhost', port: int = DEFAULT_REDIS_PORT, db: int = 0,
+                 socket_timeout: float = DEFAULT_REDIS_SOCKET_TIMEOUT) -> None:
+        self.host = host
+        self.port = port
+        self.db = db
+        self.socket_timeout = socket_timeout
+        self._lock = threading.Lock()
+        self._socket = None
+        self._reader = None
+
+    def get(self, key: str) -> tp.Optional[bytes]:
+        return self._execute('GET', key)
+
+    def set(self, key: str, value: bytes, ttl: tp.Optional[float] = None) -> None:
+        if ttl is None:
+            self._execute('SET', key, value)
+        else:
+            self._execute('SET', key, value, 'PX', str(max(int(ttl * 1000), 1)))
+
+    def close(self) -> None:
+        with self._lock:
+            self._disconnect()
+
+    def _execute(self, *args):
+        """
+        :raises StateBackendError:
+        """
+        with self._lock:
+            try:
+                if self._socket is None:
+                    self._connect()
+                return self._send_command(args)
+            except (OSError, ValueError) as exc:
+                self._disconnect()
+                raise StateBackendError(f'redis at {self.host}:{self.port} failed') from exc
+
+    def _connect(self) -> None:
+        self._socket = socket.create_connection((self.host, self.port), timeout=self.socket_timeout)
+        self._reader = self._socket.makefile('rb')
+        if self.db:
+            self._send_command(('SELECT', str(self.db)))
+
+    def _disconnect(self) -> None:
+        if self._socket is not None:
+            self._reader.close()
+            self._socket.close()
+        self._socket = None
+        self._reader = None
+
+    def _send_command(self, args):
+        self._socket.sendall(encode_command(args))
+        return read_reply(self._reader)
+
+
+def encode_command(args: tp.Sequence[tp.Union[str, bytes]]) -> bytes:
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode('utf-8')
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+def read_reply(reader):
+    """
+    :raises StateBackendError: When redis replies with an error.
+    :raises ValueError: When the reply is malformed.
+    """
+    line = reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise ValueError(f'unexpected end of reply {line!r}')
+    kind, payload = line[:1], line[1:-2]
+    if kind == b'+':
+        return payload.decode('utf-8')
+    if kind == b'-':
+        raise StateBackendError(payload.decode('utf-8'))
+    if kind == b':':
+        return int(payload)
+    if kind == b'$':
+        length = int(payload)
+        if length == -1:
+            return None
+        data = reader.read(length + 2)
+        if len(data) != length + 2:
+            raise ValueError('unexpected end of bulk reply')
+        return data[:-2]
+    if kind == b'*':
+        length = int(payload)
+        if length == -1:
+            return None
+        return [read_reply(reader) for _ in range(length)]
+    raise ValueError(f'unknown reply {line!r}')
+
+
+def open_state_backend(url: str) -> StateBackend:
+    """
+    Opens `sqlite:///path/to/state.db` or `redis://host:port/db`.
+
+    :raises StateBackendError:
+    """
+    parse_result = urlparse.urlparse(url)
+    if parse_result.scheme == 'sqlite':
+        if not parse_result.path:
+            # sqlite3 would open a private temporary database
+            raise StateBackendError(f'no path in {url!r}, use sqlite:///path/to/state.db')
+        return SqliteStateBackend(parse_result.path)
+    if parse_result.scheme == 'redis':
+        db = parse_result.path.lstrip('/') or '0'
+        try:
+            return RedisStateBackend(
+                host=parse_result.hostname or 'localhost',
+                port=parse_result.port or DEFAULT_REDIS_PORT,
+                db=int(db),
+            )
+        except ValueError as exc:
+            raise StateBackendError(f'bad redis url {url!r}') from exc
+    raise StateBackendError(f'unknown state backend {url!r}')
+
+
+class _ConvertExceptions:
+    def __init__(self, from_exception_class):
+        self.from_exception_class = from_exception_class
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and issubclass(exc_type, self.from_exception_class):
+            raise StateBackendError(str(exc_value)) from exc_value
+        return False
@@ -5,11 +5,22 @@ setup(
     version='0.1.9',
     install_requires=[
         'requests==2.12.4',
-        'cachetools==2.0.0',
     ],
+    extras_require={
+        'async': [
+            'aiohttp==3.7.4',
+        ],
+        'fast': [
+            'orjson==3.6.1',
+        ],
+    },
     entry_points={
         'console_scripts': [
             'github_trending_bot = github_trending_bot.bot:main',
+            'github_trending_bot_async = github_trending_bot.aio:main',
+            'github_trending_bot_ingress = github_trending_bot.sharding:ingress_main',
+            'github_trending_bot_worker = github_trending_bot.sharding:worker_main',
+            'github_trending_bot_webhook = github_trending_bot.aio:webhook_main',
         ]
     },
     tests_require=[
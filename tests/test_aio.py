@@ -0,0 +1,398 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from github_trending_bot import aio
+from github_trending_bot import bot
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class _FakeServer:
+    def __init__(self, handler, method='POST'):
+        app = web.Application()
+        app.router.add_route(method, '/{tail:.*}', self._handle)
+        self.handler = handler
+        self.requests = []
+        self._server = TestServer(app)
+
+    async def __aenter__(self):
+        await self._server.start_server()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._server.close()
+
+    @property
+    def api_base(self):
+        return str(self._server.make_url('')).rstrip('/')
+
+    async def _handle(self, request):
+        body = await request.json() if request.can_read_body else None
+        self.requests.append((request.path, dict(request.query), dict(request.headers), body))
+        return self.handler(request)
+
+
+def test_async_telegram_api_get_updates():
+    async def go():
+        item = {'update_id': 1, 'message': {'chat': {'id': 2}, 'message_id': 3, 'text': '/show'}}
+        async with _FakeServer(lambda request: web.json_response({'result': [item]})) as server:
+            async with aiohttp.ClientSession() as session:
+                api = aio.AsyncTelegramApi('some_telegram_token', session, api_base=server.api_base)
+                updates = await api.get_updates(offset=1, limit=2, timeout=3)
+        return server, updates
+
+    server, updates = _run(go())
+    (path, _, _, body), = server.requests
+    assert path == '/botsome_telegram_token/getUpdates'
+    assert body == {'offset': 1, 'limit': 2, 'timeout': 3}
+    update, = updates
+    assert update.update_id == 1
+    assert update.message.chat_id == 2
+    assert update.message.text == '/show'
+
+
+@pytest.mark.parametrize('handler', [
+    lambda request: web.Response(status=400),
+    lambda request: web.Response(text='not a json'),
+    lambda request: web.json_response({'result': 9}),
+])
+def test_async_telegram_api_get_updates_error_handling(handler):
+    async def go():
+        async with _FakeServer(handler) as server:
+            async with aiohttp.ClientSession() as session:
+                api = aio.AsyncTelegramApi('some_telegram_token', session, api_base=server.api_base)
+                await api.get_updates(offset=1, limit=2, timeout=3)
+
+    with pytest.raises(bot.TelegramApiError):
+        _run(go())
+
+
+def test_async_telegram_api_send_message():
+    async def go():
+        async with _FakeServer(lambda request: web.json_response({'ok': True})) as server:
+            async with aiohttp.ClientSession() as session:
+                api = aio.AsyncTelegramApi('some_telegram_token', session, api_base=server.api_base)
+                await api.send_message(chat_id=99, text='<b>some_text</b>', parse_mode='HTML')
+        return server
+
+    (path, _, _, body), = _run(go()).requests
+    assert path == '/botsome_telegram_token/sendMessage'
+    assert body == {
+        'chat_id': 99,
+        'text': '<b>some_text</b>',
+        'parse_mode': 'HTML',
+        'disable_web_page_preview': False,
+        'disable_notification': False,
+    }
+
+
+def test_async_telegram_api_send_message_flood_limit():
+    async def go():
+        response = {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 7}}
+        async with _FakeServer(lambda request: web.json_response(response, status=429)) as server:
+            async with aiohttp.ClientSession() as session:
+                api = aio.AsyncTelegramApi('some_telegram_token', session, api_base=server.api_base)
+                await api.send_message(chat_id=99, text='some_text')
+
+    with pytest.raises(bot.TelegramRetryAfter) as exc_info:
+        _run(go())
+    assert exc_info.value.retry_after == 7
+
+
+def test_async_github_show_command_filters_by_language(monkeypatch):
+    repo = bot.Repo('some_name', '', 'http://example.com', 'Rust', 3)
+    monkeypatch.setattr(bot, 'find_trending_repositories_by_language',
+                        lambda github_token, age_in_days, language: [repo] if language == 'rust' else [])
+    command = aio.AsyncGithubShowCommand('some_github_token')
+    assert _run(command(('7', 'rust'))) == bot.format_html_message([repo])
+    assert _run(command(('go',))).endswith('are go repositories created in the last 7 days')
+    with pytest.raises(bot.InvalidCommand):
+        _run(command(('7', 'rust', 'extra')))
+
+
+def test_async_github_show_command_uses_all_tokens(monkeypatch):
+    repo = bot.Repo('some_name', '', 'http://example.com', 'Rust', 3)
+    calls = []
+
+    def find_trending_repositories(github_token, age_in_days):
+        calls.append((github_token, age_in_days))
+        return [repo]
+
+    monkeypatch.setattr(bot, 'find_trending_repositories', find_trending_repositories)
+    config = bot.Config(('first_token', 'second_token'), 'some_telegram_token')
+    commands_executor = aio._get_commands_executor(config)
+    reply = _run(commands_executor.execute_async(bot.ParsedMessage('/show', ('3',), chat_id=1)))
+    assert reply == bot.format_html_message([repo])
+    assert calls == [(('first_token', 'second_token'), 3)]
+
+
+def test_async_commands_executor_fits_workers():
+    config = bot.Config(('some_github_token',), 'some_telegram_token', workers=6)
+    admission_control = aio._get_commands_executor(config).admission_control
+    assert admission_control.max_concurrent == 3
+    assert admission_control.max_waiting == bot.EXPENSIVE_COMMANDS_MAX_WAITING
+
+
+def test_commands_executor_runs_sync_and_async_commands():
+    async def async_command(args):
+        return 'async ' + ' '.join(args)
+
+    commands = bot.CommandsExecutor({
+        '/sync': lambda args: 'sync ' + ' '.join(args),
+        '/async': async_command,
+    })
+    assert commands.execute(bot.ParsedMessage('/async', ('a',))) == 'async a'
+    assert _run(commands.execute_async(bot.ParsedMessage('/sync', ('b',)))) == 'sync b'
+    assert _run(commands.execute_async(bot.ParsedMessage('/async', ('c',)))) == 'async c'
+    with pytest.raises(bot.InvalidCommand):
+        _run(commands.execute_async(bot.ParsedMessage('/unknown', ())))
+
+
+def test_commands_executor_gives_turns_to_expensive_async_commands():
+    class ExpensiveCommand:
+        expensive = True
+
+        async def __call__(self, args):
+            return str(admission_control._running)
+
+    admission_control = bot.AdmissionControl(max_concurrent=1)
+    commands = bot.CommandsExecutor({'/expensive': ExpensiveCommand()}, admission_control)
+    assert _run(commands.execute_async(bot.ParsedMessage('/expensive', (), chat_id=1))) == '1'
+    assert admission_control._running == 0
+
+
+def test_chat_serializer_keeps_per_chat_order():
+    handled = []
+
+    async def handle(chat_id, update_id, delay):
+        await asyncio.sleep(delay)
+        handled.append((chat_id, update_id))
+
+    async def go():
+        serializer = aio.ChatSerializer()
+        await asyncio.gather(
+            serializer.submit(1, lambda: handle(1, 1, 0.02)),
+            serializer.submit(2, lambda: handle(2, 2, 0)),
+            serializer.submit(1, lambda: handle(1, 3, 0)),
+        )
+
+    _run(go())
+    assert handled == [(2, 2), (1, 1), (1, 3)]
+
+
+class _BreakFromInfiniteLoop(Exception):
+    pass
+
+
+class _FakeTelegramApi:
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.sent_messages = []
+
+    async def get_updates(self, offset, limit, timeout):
+        if not self.batches:
+            await asyncio.sleep(0.01)
+            return []
+        return self.batches.pop(0)
+
+    async def send_message(self, **kwargs):
+        self.sent_messages.append(kwargs)
+
+
+class _FakeUpdatesTelegramApi:
+    """Forgets the updates before the offset of getUpdates, like telegram."""
+
+    def __init__(self, updates):
+        self.updates = list(updates)
+        self.offsets = []
+        self.sent_messages = []
+
+    async def get_updates(self, offset, limit, timeout):
+        self.offsets.append(offset)
+        self.updates = [update for update in self.updates if update.update_id >= offset]
+        if not self.updates:
+            await asyncio.sleep(0.01)
+        return self.updates[:limit]
+
+    async def send_message(self, **kwargs):
+        self.sent_messages.append(kwargs)
+
+
+class _FakeSendTelegramApi:
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.sent_messages = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.sent_messages.append((chat_id, text, time.monotonic()))
+
+
+class _OffsetState:
+    def __init__(self, stop_at):
+        self._offset = 0
+        self.stop_at = stop_at
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @offset.setter
+    def offset(self, offset):
+        self._offset = offset
+        if offset == self.stop_at:
+            raise _BreakFromInfiniteLoop
+
+
+def test_run_polling_loop():
+    telegram_api = _FakeTelegramApi([
+        [bot.Update(1, bot.Message(1, 1, '/echo first'))],
+        [bot.Update(2, bot.Message(1, 2, '/echo second')), bot.Update(3, None)],
+    ])
+    commands_executor = bot.CommandsExecutor({'/echo': lambda args: ' '.join(args)})
+    offset_state = _OffsetState(stop_at=4)
+    with pytest.raises(_BreakFromInfiniteLoop):
+        _run(aio._run_polling_loop(offset_state, telegram_api, commands_executor, max_pending_batches=2,
+                                   sender=aio.AsyncSender(telegram_api, chat_rate=1000)))
+    assert [message['text'] for message in telegram_api.sent_messages] == ['first', 'second']
+    assert offset_state.offset == 4
+
+
+def test_run_polling_loop_doesnt_confirm_updates_being_handled():
+    updates = [bot.Update(1, bot.Message(1, 1, '/slow'))] + [
+        bot.Update(update_id, bot.Message(update_id, update_id, f'/echo {update_id}'))
+        for update_id in range(2, 8)
+    ]
+    telegram_api = _FakeUpdatesTelegramApi(updates)
+
+    async def slow_command(args):
+        # finishes after the updates of the next poll
+        while len(telegram_api.sent_messages) < 6:
+            await asyncio.sleep(0.01)
+        return 'slow'
+
+    commands_executor = bot.CommandsExecutor({'/echo': lambda args: ' '.join(args), '/slow': slow_command})
+    offset_state = _OffsetState(stop_at=8)
+    with pytest.raises(_BreakFromInfiniteLoop):
+        _run(asyncio.wait_for(
+            aio._run_polling_loop(offset_state, telegram_api, commands_executor, max_pending_batches=4,
+                                  sender=aio.AsyncSender(telegram_api, chat_rate=1000)),
+            timeout=5,
+        ))
+    texts = [message['text'] for message in telegram_api.sent_messages]
+    assert sorted(texts[:6]) == [str(update_id) for update_id in range(2, 8)]
+    assert texts[6:] == ['slow']
+    # update 1 is not confirmed until it's handled, and no update is handled twice
+    assert max(telegram_api.offsets) <= 1
+
+
+def test_async_sender_retries_after_flood_limit():
+    telegram_api = _FakeSendTelegramApi(failures=[bot.TelegramRetryAfter(0.1)])
+    sender = aio.AsyncSender(telegram_api, chat_rate=1000)
+    started_at = time.monotonic()
+    _run(sender.send_message(1, 'first'))
+    (chat_id, text, sent_at), = telegram_api.sent_messages
+    assert (chat_id, text) == (1, 'first')
+    assert sent_at - started_at >= 0.1
+    assert sender.stats['flood_waits'] == 1
+
+
+def test_async_sender_keeps_rates_and_drops_failing_messages():
+    telegram_api = _FakeSendTelegramApi(failures=[bot.TelegramApiError('some error')] * 2)
+    sender = aio.AsyncSender(telegram_api, global_rate=20, chat_rate=10, max_attempts=2, retry_interval=0)
+
+    async def go():
+        await sender.send_message(1, 'dropped')
+        await asyncio.gather(*[sender.send_message(chat_id, 'some_text') for chat_id in range(1, 11)])
+
+    _run(go())
+    assert sender.stats['failed'] == 1
+    sent_at = sorted(at for _, _, at in telegram_api.sent_messages)
+    assert len(sent_at) == 10
+    assert sent_at[-1] - sent_at[0] >= 0.4
+
+
+def _post_to_webhook(app, body, headers=None):
+    async def go():
+        async with TestClient(TestServer(app)) as client:
+            response = await client.post(aio.WEBHOOK_PATH, data=body, headers=headers)
+            text = await response.text()
+            return response.status, (json.loads(text) if text else None)
+
+    return _run(go())
+
+
+def _make_webhook_body(text, chat_id=2):
+    return json.dumps({'update_id': 1, 'message': {'chat': {'id': chat_id}, 'message_id': 3, 'text': text}})
+
+
+def test_webhook_replies_inline():
+    commands_executor = bot.CommandsExecutor({'/echo': lambda args: ' '.join(args)})
+    status, reply = _post_to_webhook(aio.make_webhook_app(commands_executor), _make_webhook_body('/echo <b>hi</b>'))
+    assert status == 200
+    assert reply == {
+        'method': 'sendMessage',
+        'chat_id': 2,
+        'text': '<b>hi</b>',
+        'parse_mode': 'HTML',
+        'disable_web_page_preview': True,
+        'disable_notification': True,
+    }
+
+
+@pytest.mark.parametrize('body, expected_status', [
+    (json.dumps({'update_id': 1}), 200),
+    (_make_webhook_body('/echo'), 200),
+    ('not a json', 400),
+    ('[]', 400),
+    (json.dumps({'message': {}}), 400),
+])
+def test_webhook_without_reply(body, expected_status):
+    commands_executor = bot.CommandsExecutor({'/echo': lambda args: ' '.join(args)})
+    assert _post_to_webhook(aio.make_webhook_app(commands_executor), body) == (expected_status, None)
+
+
+def test_webhook_checks_secret_token():
+    commands_executor = bot.CommandsExecutor({'/echo': lambda args: ' '.join(args)})
+    body = _make_webhook_body('/echo hi')
+    for secret_token, expected_status in [(None, 403), ('other_secret', 403), ('some_secret', 200)]:
+        app = aio.make_webhook_app(commands_executor, secret_token='some_secret')
+        headers = {} if secret_token is None else {aio.WEBHOOK_SECRET_TOKEN_HEADER: secret_token}
+        assert _post_to_webhook(app, body, headers=headers)[0] == expected_status
+
+
+def test_async_telegram_api_set_webhook():
+    async def go():
+        async with _FakeServer(lambda request: web.json_response({'ok': True})) as server:
+            async with aiohttp.ClientSession() as session:
+                api = aio.AsyncTelegramApi('some_telegram_token', session, api_base=server.api_base)
+                await api.set_webhook('https://example.com/webhook', secret_token='some_secret')
+        return server
+
+    (path, _, _, body), = _run(go()).requests
+    assert path == '/botsome_telegram_token/setWebhook'
+    assert body == {'url': 'https://example.com/webhook', 'secret_token': 'some_secret'}
+
+
+def test_get_webhook_config():
+    webhook_config = aio.get_webhook_config({'WEBHOOK_PORT': '8080', 'WEBHOOK_URL': 'https://example.com/webhook'})
+    assert webhook_config.host == aio.DEFAULT_WEBHOOK_HOST
+    assert webhook_config.port == 8080
+    assert webhook_config.url == 'https://example.com/webhook'
+    assert webhook_config.secret_token is None
+    with pytest.raises(bot.InvalidConfig):
+        aio.get_webhook_config({'WEBHOOK_PORT': 'https'})
@@ -1,6 +1,12 @@
+import asyncio
+import concurrent.futures
 import datetime as dt
+import functools
+import http.server
 import json
 import os
+import threading
+import time
 import urllib.parse as urlparse
 
 from freezegun import freeze_time
@@ -9,6 +15,7 @@ import requests
 import responses
 
 from github_trending_bot import bot
+from github_trending_bot import state
 
 
 def test_get_config():
@@ -18,7 +25,53 @@ def test_get_config():
     }
     config = bot.get_config(environment)
     assert config.github_token == 'some_github_token'
+    assert config.github_tokens == ('some_github_token',)
     assert config.telegram_token == 'some_telegram_token'
+    assert config.workers == bot.DEFAULT_WORKERS
+    assert config.state_url is None
+    assert config.metrics_port is None
+
+
+def test_get_config_github_tokens():
+    environment = {
+        'GITHUB_TOKEN': 'first_github_token, second_github_token',
+        'TELEGRAM_TOKEN': 'some_telegram_token',
+    }
+    assert bot.get_config(environment).github_tokens == ('first_github_token', 'second_github_token')
+
+
+def test_get_config_workers():
+    environment = {
+        'GITHUB_TOKEN': 'some_github_token',
+        'TELEGRAM_TOKEN': 'some_telegram_token',
+        'WORKERS': '16',
+    }
+    assert bot.get_config(environment).workers == 16
+
+
+def test_get_config_api_bases():
+    environment = {
+        'GITHUB_TOKEN': 'some_github_token',
+        'TELEGRAM_TOKEN': 'some_telegram_token',
+    }
+    config = bot.get_config(environment)
+    assert (config.github_api_base, config.telegram_api_base) == (bot.GITHUB_API_BASE, bot.TELEGRAM_API_BASE)
+    environment.update(GITHUB_API_BASE='http://127.0.0.1:8001', TELEGRAM_API_BASE='http://127.0.0.1:8002')
+    config = bot.get_config(environment)
+    assert (config.github_api_base, config.telegram_api_base) == ('http://127.0.0.1:8001', 'http://127.0.0.1:8002')
+
+
+@pytest.mark.parametrize('prewarm_days, expected_ages_in_days', [
+    ('1,7, 30', (1, 7, 30)),
+    ('', ()),
+])
+def test_get_config_prewarm_days(prewarm_days, expected_ages_in_days):
+    environment = {
+        'GITHUB_TOKEN': 'some_github_token',
+        'TELEGRAM_TOKEN': 'some_telegram_token',
+        'PREWARM_DAYS': prewarm_days,
+    }
+    assert bot.get_config(environment).prewarm_ages_in_days == expected_ages_in_days
 
 
 @pytest.mark.parametrize('environment', [
@@ -26,6 +79,20 @@ def test_get_config():
     {'TELEGRAM_TOKEN': 'some_telegram_token'},
     # no TELEGRAM_TOKEN
     {'GITHUB_TOKEN': 'some_github_token'},
+    # no tokens in GITHUB_TOKEN
+    {'GITHUB_TOKEN': ' , ', 'TELEGRAM_TOKEN': 'some_telegram_token'},
+    # WORKERS is not an integer
+    {'GITHUB_TOKEN': 'some_github_token', 'TELEGRAM_TOKEN': 'some_telegram_token', 'WORKERS': 'many'},
+    # WORKERS is not positive
+    {'GITHUB_TOKEN': 'some_github_token', 'TELEGRAM_TOKEN': 'some_telegram_token', 'WORKERS': '0'},
+    # PREWARM_DAYS is not a list of integers
+    {'GITHUB_TOKEN': 'some_github_token', 'TELEGRAM_TOKEN': 'some_telegram_token', 'PREWARM_DAYS': '1,week'},
+    # PREWARM_DAYS has days that /show never searches
+    {'GITHUB_TOKEN': 'some_github_token', 'TELEGRAM_TOKEN': 'some_telegram_token', 'PREWARM_DAYS': '1,0'},
+    {'GITHUB_TOKEN': 'some_github_token', 'TELEGRAM_TOKEN': 'some_telegram_token', 'PREWARM_DAYS': '-7'},
+    {'GITHUB_TOKEN': 'some_github_token', 'TELEGRAM_TOKEN': 'some_telegram_token', 'PREWARM_DAYS': '99999999'},
+    # METRICS_PORT is not an integer
+    {'GITHUB_TOKEN': 'some_github_token', 'TELEGRAM_TOKEN': 'some_telegram_token', 'METRICS_PORT': 'http'},
 ])
 def test_get_config_failure(environment):
     with pytest.raises(bot.InvalidConfig):
@@ -44,7 +111,8 @@ def test_github_api_find_trending_repositories():
                     'description': 'some_description',
                     'html_url': 'http://example.com',
                     'language': 'Python',
-                    'stargazers_count': 3
+                    'stargazers_count': 3,
+                    'created_at': '2017-01-06T10:00:00Z',
                 }
             ]
         }
@@ -77,6 +145,27 @@ def test_github_api_find_trending_repositories():
     assert repo.html_url == 'http://example.com'
     assert repo.language == 'Python'
     assert repo.stargazers_count == 3
+    assert repo.created_at == dt.datetime(2017, 1, 6, 10)
+
+
+@responses.activate
+def test_github_api_find_repositories_created_on():
+    responses.add(
+        responses.GET,
+        'https://api.github.com/search/repositories',
+        json={'items': []},
+    )
+    api = bot.GithubApi('some_github_token')
+    assert api.find_repositories_created_on(created_on=dt.date(2017, 1, 5), limit=10) == []
+    _assert_requests_call(
+        responses.calls[0],
+        expected_params={
+            'sort': 'stars',
+            'order': 'desc',
+            'per_page': '10',
+            'q': 'created:2017-01-05',
+        },
+    )
 
 
 @pytest.mark.parametrize('mock_kwargs', [
@@ -105,7 +194,22 @@ def test_github_api_find_trending_repositories():
         'json': {
             'items': 9,
         },
-    }
+    },
+    # bad created_at
+    {
+        'json': {
+            'items': [
+                {
+                    'name': 'some_name',
+                    'description': None,
+                    'html_url': 'http://example.com',
+                    'language': None,
+                    'stargazers_count': 3,
+                    'created_at': 'yesterday',
+                }
+            ]
+        },
+    },
 
 ])
 @responses.activate
@@ -123,6 +227,302 @@ def test_github_api_find_trending_repositories_error_handling(mock_kwargs):
         )
 
 
+def _wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+def _call_concurrently(func, count):
+    results = []
+    errors = []
+
+    def run():
+        try:
+            results.append(func())
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=run) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    single_flight = bot.SingleFlight()
+    release = threading.Event()
+
+    def slow_call():
+        release.wait(5)
+        return 'result'
+
+    threads, results, errors = _call_concurrently(lambda: single_flight.do('key', slow_call), 5)
+    _wait_until(lambda: single_flight.stats['coalesced'] == 4)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ['result'] * 5
+    assert errors == []
+    assert single_flight.stats.as_dict() == {'calls': 1, 'coalesced': 4}
+
+
+def test_single_flight_shares_errors():
+    single_flight = bot.SingleFlight()
+    release = threading.Event()
+
+    def failing_call():
+        release.wait(5)
+        raise bot.GithubApiError('boom')
+
+    threads, results, errors = _call_concurrently(lambda: single_flight.do('key', failing_call), 3)
+    _wait_until(lambda: single_flight.stats['coalesced'] == 2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == []
+    assert [str(exc) for exc in errors] == ['boom'] * 3
+    # the key is free again after the call
+    assert single_flight.do('key', lambda: 'result') == 'result'
+
+
+def test_github_api_find_trending_repositories_coalesces_same_query(monkeypatch):
+    api = bot.GithubApi('some_github_token')
+    release = threading.Event()
+    searches = []
+
+    def search_repositories(params, deferrable):
+        searches.append(params)
+        release.wait(5)
+        return [_make_repo(1)]
+
+    monkeypatch.setattr(api, '_search_repositories', search_repositories)
+    threads, results, _ = _call_concurrently(
+        lambda: api.find_trending_repositories(created_after=dt.datetime(2017, 1, 5), limit=10), 3)
+    _wait_until(lambda: api.single_flight_stats['coalesced'] == 2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(searches) == 1
+    assert len(results) == 3
+
+
+class _FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def _make_rate_limiter(clock, **kwargs):
+    return bot.GithubRateLimiter(timer=clock.time, sleep=clock.sleep, **kwargs)
+
+
+def test_github_rate_limiter_spends_quota():
+    clock = _FakeClock()
+    rate_limiter = _make_rate_limiter(clock, limit=3, window=60, max_wait=100)
+    for _ in range(3):
+        rate_limiter.acquire()
+    assert rate_limiter.remaining == 0
+    # waits for the window to reset
+    rate_limiter.acquire()
+    assert clock.sleeps == [60]
+    assert rate_limiter.stats['remaining'] == 2
+
+
+def test_github_rate_limiter_rejects_long_waits():
+    clock = _FakeClock()
+    rate_limiter = _make_rate_limiter(clock, limit=1, window=60, max_wait=3)
+    rate_limiter.acquire()
+    with pytest.raises(bot.GithubRateLimitExceeded):
+        rate_limiter.acquire()
+    assert clock.sleeps == []
+    assert rate_limiter.stats['rejected'] == 1
+
+
+def test_github_rate_limiter_defers_requests_when_quota_is_low():
+    clock = _FakeClock()
+    rate_limiter = _make_rate_limiter(clock, limit=3, reserve=2)
+    rate_limiter.acquire(deferrable=True)
+    with pytest.raises(bot.GithubRateLimitExceeded):
+        rate_limiter.acquire(deferrable=True)
+    # the reserve is left to other requests
+    rate_limiter.acquire()
+    rate_limiter.acquire()
+    assert rate_limiter.stats['deferred'] == 1
+
+
+def test_github_rate_limiter_syncs_with_headers():
+    clock = _FakeClock()
+    rate_limiter = _make_rate_limiter(clock, max_wait=100)
+    rate_limiter.update({'X-RateLimit-Limit': '30', 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '1010'})
+    assert rate_limiter.remaining == 0
+    rate_limiter.acquire()
+    assert clock.sleeps == [10]
+    # bad headers are ignored
+    rate_limiter.update({'X-RateLimit-Remaining': 'many'})
+    assert rate_limiter.stats.as_dict() == {
+        'limit': 30,
+        'remaining': 29,
+        'reset_at': 1070,
+        'waits': 1,
+        'deferred': 0,
+        'rejected': 0,
+    }
+
+
+@responses.activate
+def test_github_api_tracks_rate_limit():
+    responses.add(
+        responses.GET,
+        'https://api.github.com/search/repositories',
+        json={'items': []},
+        headers={'X-RateLimit-Limit': '30', 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '4102444800'},
+    )
+    api = bot.GithubApi('some_github_token')
+    api.find_repositories_created_on(created_on=dt.date(2017, 1, 5), limit=10)
+    with pytest.raises(bot.GithubRateLimitExceeded):
+        api.find_repositories_created_on(created_on=dt.date(2017, 1, 6), limit=10)
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_github_api_sends_conditional_requests():
+    item = {
+        'name': 'some_name',
+        'description': 'some_description',
+        'html_url': 'http://example.com',
+        'language': 'Python',
+        'stargazers_count': 3,
+    }
+    body = json.dumps({'items': [item]})
+    requests_headers = []
+
+    def callback(request):
+        requests_headers.append(request.headers)
+        if request.headers.get('If-None-Match') == '"some_etag"':
+            return 304, {'ETag': '"some_etag"'}, ''
+        return 200, {'ETag': '"some_etag"', 'Last-Modified': 'Sat, 18 Feb 2017 11:55:03 GMT'}, body
+
+    responses.add_callback(responses.GET, 'https://api.github.com/search/repositories', callback=callback)
+    api = bot.GithubApi('some_github_token')
+    first = api.find_repositories_created_on(created_on=dt.date(2017, 1, 5), limit=10)
+    second = api.find_repositories_created_on(created_on=dt.date(2017, 1, 5), limit=10)
+    other = api.find_repositories_created_on(created_on=dt.date(2017, 1, 6), limit=10)
+    assert first == second == other == [bot._make_repo_from_api_item(item)]
+    assert 'If-None-Match' not in requests_headers[0]
+    assert requests_headers[1]['If-None-Match'] == '"some_etag"'
+    assert requests_headers[1]['If-Modified-Since'] == 'Sat, 18 Feb 2017 11:55:03 GMT'
+    # validators are kept per query
+    assert 'If-None-Match' not in requests_headers[2]
+    assert api.conditional_stats['requests'] == 1
+    assert api.conditional_stats['not_modified'] == 1
+    assert api.conditional_stats['bytes_saved'] == len(body)
+    assert api.conditional_stats['parse_seconds_saved'] > 0
+
+
+@responses.activate
+def test_github_api_requests_evicted_not_modified_results_again(monkeypatch):
+    item = {
+        'name': 'some_name',
+        'description': 'some_description',
+        'html_url': 'http://example.com',
+        'language': 'Python',
+        'stargazers_count': 3,
+    }
+    requests_headers = []
+
+    def callback(request):
+        requests_headers.append(request.headers)
+        if request.headers.get('If-None-Match') == '"some_etag"':
+            return 304, {'ETag': '"some_etag"'}, ''
+        return 200, {'ETag': '"some_etag"'}, json.dumps({'items': [item]})
+
+    responses.add_callback(responses.GET, 'https://api.github.com/search/repositories', callback=callback)
+    api = bot.GithubApi('some_github_token')
+    api.find_repositories_created_on(created_on=dt.date(2017, 1, 5), limit=10)
+    # the results are evicted between sending the validators and getting the 304
+    monkeypatch.setattr(api._conditional_cache, 'get_not_modified', lambda key: None)
+    repositories = api.find_repositories_created_on(created_on=dt.date(2017, 1, 5), limit=10)
+    assert repositories == [bot._make_repo_from_api_item(item)]
+    assert [headers.get('If-None-Match') for headers in requests_headers] == [None, '"some_etag"', None]
+
+
+def test_conditional_cache_evicts_least_recently_used():
+    cache = bot.ConditionalCache(maxsize=2)
+    for key in ['first', 'second']:
+        cache.put(key, {'ETag': key}, [_make_repo(1)], size=10, parse_seconds=0.1)
+    assert cache.get_not_modified('first') == [_make_repo(1)]
+    cache.put('third', {'ETag': 'third'}, [], size=10, parse_seconds=0.1)
+    cache.put('fourth', {}, [], size=10, parse_seconds=0.1)
+    assert cache.get_headers('first') == {'If-None-Match': 'first'}
+    assert cache.get_headers('second') == {}
+    assert cache.get_headers('fourth') == {}
+    assert cache.get_not_modified('second') is None
+
+
+def _add_github_search_callback(statuses_by_token, remaining_by_token=None):
+    remaining_by_token = remaining_by_token or {}
+    used_tokens = []
+
+    def callback(request):
+        token = request.headers['Authorization'][len('token '):]
+        used_tokens.append(token)
+        headers = {}
+        if token in remaining_by_token:
+            headers = {
+                'X-RateLimit-Limit': '30',
+                'X-RateLimit-Remaining': str(remaining_by_token[token]),
+                'X-RateLimit-Reset': '4102444800',
+            }
+        return statuses_by_token.get(token, 200), headers, json.dumps({'items': []})
+
+    responses.add_callback(responses.GET, 'https://api.github.com/search/repositories', callback=callback)
+    return used_tokens
+
+
+@responses.activate
+def test_github_api_picks_token_with_most_remaining_quota():
+    used_tokens = _add_github_search_callback({}, remaining_by_token={'first': 5, 'second': 20})
+    api = bot.GithubApi(('first', 'second'))
+    for day in range(1, 4):
+        api.find_repositories_created_on(created_on=dt.date(2017, 1, day), limit=10)
+    # both start with the full quota, then second has more of it left
+    assert used_tokens == ['first', 'second', 'second']
+    assert api.token_stats()['1:...cond']['requests'] == 2
+    assert api.token_stats()['1:...cond']['remaining'] == 20
+
+
+@responses.activate
+def test_github_api_skips_revoked_tokens():
+    used_tokens = _add_github_search_callback({'first': 401})
+    api = bot.GithubApi(('first', 'second'))
+    api.find_repositories_created_on(created_on=dt.date(2017, 1, 1), limit=10)
+    api.find_repositories_created_on(created_on=dt.date(2017, 1, 2), limit=10)
+    assert used_tokens == ['first', 'second', 'second']
+    assert api.token_stats()['0:...irst']['revoked'] == 1
+
+
+def test_github_api_tells_tokens_with_the_same_prefix_apart():
+    api = bot.GithubApi(('ghp_' + 'a' * 36, 'ghp_' + 'b' * 36))
+    assert sorted(api.token_stats()) == ['0:...aaaa', '1:...bbbb']
+
+
+@responses.activate
+def test_github_api_fails_when_all_tokens_are_revoked():
+    _add_github_search_callback({'first': 401, 'second': 401})
+    api = bot.GithubApi(('first', 'second'))
+    with pytest.raises(bot.GithubTokenRevoked):
+        api.find_repositories_created_on(created_on=dt.date(2017, 1, 1), limit=10)
+
+
 def test_format_html_message():
     repositories = [
         bot.Repo(
@@ -149,6 +549,16 @@ def test_format_html_message():
     assert actual_message == expected_message
 
 
+def test_format_html_message_renders_shared_repositories_once():
+    repositories = [_make_repo(age_in_days) for age_in_days in range(1000, 1003)]
+    misses_before = bot._format_repo_html.cache_info().misses
+    first_message = bot.format_html_message(repositories[:2])
+    second_message = bot.format_html_message(repositories[1:])
+    assert bot._format_repo_html.cache_info().misses - misses_before == 3
+    assert first_message.split('\n\n')[1] == second_message.split('\n\n')[0]
+    assert bot.format_html_message(repositories[:2]) is first_message
+
+
 @responses.activate
 def test_telegram_api_send_message():
     responses.add(
@@ -201,7 +611,154 @@ def test_telegram_api_send_message_bad_status(mock_kwargs):
         )
 
 
-def _make_message_item(update_id, chat_id, message_id, text=None):
+@responses.activate
+@pytest.mark.parametrize('body, expected_retry_after', [
+    ('{"ok": false, "error_code": 429, "parameters": {"retry_after": 7}}', 7),
+    ('{"ok": false, "error_code": 429}', bot.SEND_RETRY_INTERVAL),
+    ('not a json', bot.SEND_RETRY_INTERVAL),
+])
+def test_telegram_api_send_message_flood_limit(body, expected_retry_after):
+    responses.add(
+        responses.POST,
+        'https://api.telegram.org/botsome_telegram_token/sendMessage',
+        status=429,
+        body=body,
+    )
+    api = bot.TelegramApi('some_telegram_token')
+    with pytest.raises(bot.TelegramRetryAfter) as exc_info:
+        api.send_message(chat_id=99, text='some_text')
+    assert exc_info.value.retry_after == expected_retry_after
+
+
+def test_token_bucket():
+    timer = _FakeTimer()
+    bucket = bot.TokenBucket(rate=2, capacity=3, timer=timer)
+    assert [bucket.try_take() for _ in range(4)] == [True, True, True, False]
+    assert bucket.get_delay() == 0.5
+    timer.now = 0.5
+    assert bucket.try_take()
+    assert not bucket.is_full()
+    bucket.pause(10)
+    timer.now = 10
+    assert bucket.get_delay() == 0.5
+    timer.now = 100
+    assert bucket.is_full()
+
+
+class _FakeSendTelegramApi:
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.sent_messages = []
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self._lock:
+            failure = self.failures.pop(0) if self.failures else None
+        if failure is not None:
+            raise failure
+        with self._lock:
+            self.sent_messages.append((chat_id, text, time.monotonic()))
+
+
+def _send_all(send_queue, messages):
+    send_queue.start()
+    for chat_id, text in messages:
+        send_queue.send_message(chat_id, text)
+    send_queue.close(timeout=5)
+
+
+def test_send_queue_keeps_chat_rate_and_order():
+    telegram_api = _FakeSendTelegramApi()
+    send_queue = bot.SendQueue(telegram_api, chat_rate=20)
+    _send_all(send_queue, [(1, 'first'), (2, 'other'), (1, 'second'), (1, 'third'), (3, '')])
+    chat_messages = [(text, sent_at) for chat_id, text, sent_at in telegram_api.sent_messages if chat_id == 1]
+    assert [text for text, _ in chat_messages] == ['first', 'second', 'third']
+    assert chat_messages[2][1] - chat_messages[0][1] >= 0.09
+    assert send_queue.stats['sent'] == 4
+    assert send_queue.stats['queued'] == 0
+
+
+def test_send_queue_keeps_global_rate():
+    telegram_api = _FakeSendTelegramApi()
+    send_queue = bot.SendQueue(telegram_api, global_rate=20)
+    _send_all(send_queue, [(chat_id, 'some_text') for chat_id in range(30)])
+    assert len(telegram_api.sent_messages) == 30
+    sent_at = sorted(sent_at for _, _, sent_at in telegram_api.sent_messages)
+    # no burst on start, one more message is allowed for the scheduling of threads
+    assert sum(1 for at in sent_at if at < sent_at[0] + 1) <= 21
+
+
+def test_send_queue_retries_after_flood_limit():
+    telegram_api = _FakeSendTelegramApi(failures=[bot.TelegramRetryAfter(0.1)])
+    send_queue = bot.SendQueue(telegram_api, chat_rate=1000)
+    started_at = time.monotonic()
+    _send_all(send_queue, [(1, 'first'), (1, 'second')])
+    assert [text for _, text, _ in telegram_api.sent_messages] == ['first', 'second']
+    assert telegram_api.sent_messages[0][2] - started_at >= 0.1
+    assert send_queue.stats['flood_waits'] == 1
+
+
+def test_send_queue_drops_message_after_max_attempts():
+    telegram_api = _FakeSendTelegramApi(failures=[bot.TelegramApiError] * 3)
+    send_queue = bot.SendQueue(telegram_api, chat_rate=1000, max_attempts=2, retry_interval=0)
+    _send_all(send_queue, [(1, 'first'), (1, 'second')])
+    assert [text for _, text, _ in telegram_api.sent_messages] == ['second']
+    assert send_queue.stats['retries'] == 2
+    assert send_queue.stats['failed'] == 1
+
+
+def test_send_queue_is_bounded():
+    send_queue = bot.SendQueue(_FakeSendTelegramApi(), maxsize=1)
+    send_queue.send_message(1, 'first')
+    second_sent = threading.Event()
+    threading.Thread(target=lambda: (send_queue.send_message(2, 'second'), second_sent.set()), daemon=True).start()
+    assert not second_sent.wait(0.05)
+    send_queue.start()
+    assert second_sent.wait(5)
+    send_queue.close(timeout=5)
+    assert send_queue.stats['max_queued'] == 1
+
+
+class _KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def keep_alive_server():
+    server = http.server.HTTPServer(('127.0.0.1', 0), _KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_telegram_api_reuses_connections(keep_alive_server):
+    api = bot.TelegramApi('some_telegram_token', api_base=keep_alive_server)
+    for _ in range(3):
+        api.send_message(chat_id=99, text='some_text')
+    assert api.connection_stats() == {'requests': 3, 'connections': 1, 'reused': 2}
+    api.close()
+
+
+def test_get_github_api_is_shared():
+    assert bot.get_github_api('some_github_token') is bot.get_github_api('some_github_token')
+    assert bot.get_github_api('some_github_token') is not bot.get_github_api('other_github_token')
+
+
+def _make_message_item(update_id, chat_id, message_id, text=None, date=None):
     result = {
         'message': {
             'chat': {
@@ -213,6 +770,8 @@ def _make_message_item(update_id, chat_id, message_id, text=None):
     }
     if text is not None:
         result['message']['text'] = text
+    if date is not None:
+        result['message']['date'] = date
     return result
 
 
@@ -228,6 +787,12 @@ def _make_message_item(update_id, chat_id, message_id, text=None):
         1,
         bot.Message(2, 3, ''),
     ),
+    # with date
+    (
+        _make_message_item(1, 2, 3, '/show', date=1487418903),
+        1,
+        bot.Message(2, 3, '/show', date=1487418903),
+    ),
     # malformed message
     (
         {'update_id': 1},
@@ -271,10 +836,45 @@ def test_telegram_api_get_updates(message_item, expected_update_id, expected_mes
         assert message.chat_id == expected_message.chat_id
         assert message.message_id == expected_message.message_id
         assert message.text == expected_message.text
+        assert message.date == expected_message.date
     else:
         assert message is None
 
 
+@pytest.fixture(params=['orjson', 'json'])
+def json_backend(request, monkeypatch):
+    if request.param == 'json':
+        monkeypatch.setattr(bot, 'orjson', None)
+    elif bot.orjson is None:
+        pytest.skip('orjson is not installed')
+    return request.param
+
+
+def test_parse_updates_response(json_backend):
+    data = json.dumps({'ok': True, 'result': [
+        _make_message_item(1, 2, 3, '/show 7', date=1487418903),
+        {'update_id': 2, 'edited_message': {'chat': {'id': 2}, 'message_id': 3}},
+        {'update_id': 3, 'message': {'chat': {'id': 2}, 'message_id': 'not an int'}},
+        {'update_id': 4, 'message': {'chat': [], 'message_id': 4}},
+        {'update_id': 5, 'message': 'not an object'},
+    ]}).encode('utf-8')
+    updates = bot.parse_updates_response(data)
+    assert [update.update_id for update in updates] == [1, 2, 3, 4, 5]
+    assert updates[0].message == bot.Message(2, 3, '/show 7', date=1487418903)
+    assert [update.message for update in updates[1:]] == [None] * 4
+
+
+@pytest.mark.parametrize('data', [
+    b'not a json',
+    b'[]',
+    b'{"result": [[]]}',
+    b'{"result": [{"message": {}}]}',
+])
+def test_parse_updates_response_failure(json_backend, data):
+    with pytest.raises(bot.TelegramApiError):
+        bot.parse_updates_response(data)
+
+
 @pytest.mark.parametrize('mock_kwargs', [
     # requests raises
     {
@@ -316,8 +916,8 @@ def test_telegram_api_get_updates_error_handling(mock_kwargs):
 
 
 @pytest.mark.parametrize('text, expected_name, expected_args', [
-    ('/help', '/help', []),
-    ('/show 1', '/show', ['1']),
+    ('/help', '/help', ()),
+    ('/show 1', '/show', ('1',)),
 ])
 def test_parse_message_text(text, expected_name, expected_args):
     parsed = bot.parse_message_text(text)
@@ -337,7 +937,7 @@ def test_parse_message_text_error():
 def test_run_help_command(name):
     parsed_message = bot.ParsedMessage(
         name=name,
-        args=[],
+        args=(),
     )
     commands = bot.CommandsExecutor({
         '/help': lambda _: 'some_help_text',
@@ -346,6 +946,231 @@ def test_run_help_command(name):
     assert commands.execute(parsed_message) == 'some_help_text'
 
 
+def test_admission_control_limits_chat_rate():
+    timer = _FakeTimer()
+    commands = bot.CommandsExecutor({'/echo': lambda args: ' '.join(args)},
+                                    bot.AdmissionControl(chat_rate=1, chat_burst=2, timer=timer))
+    assert commands.execute(bot.ParsedMessage('/echo', ('first',), chat_id=1)) == 'first'
+    assert commands.execute(bot.ParsedMessage('/echo', ('second',), chat_id=1)) == 'second'
+    with pytest.raises(bot.CommandRejected, match=bot.RATE_LIMITED_REPLY_TEXT):
+        commands.execute(bot.ParsedMessage('/echo', ('third',), chat_id=1))
+    assert commands.execute(bot.ParsedMessage('/echo', ('other',), chat_id=2)) == 'other'
+    timer.now = 1
+    assert commands.execute(bot.ParsedMessage('/echo', ('third',), chat_id=1)) == 'third'
+
+
+def test_admission_control_limits_chat_rate_of_messages_without_text():
+    config = bot.Config(('some_github_token',), 'some_telegram_token')
+    commands = bot._get_commands_executor(config)
+    replies = [bot._get_reply_text(_make_update(update_id, chat_id=1, text=None), commands) for update_id in range(8)]
+    assert replies == [bot.ERROR_REPLY_TEXT] * bot.COMMAND_CHAT_BURST + [bot.RATE_LIMITED_REPLY_TEXT, '', '']
+
+
+def test_admission_control_tells_chat_about_rate_limit_once_per_admitted_command():
+    timer = _FakeTimer()
+    admission_control = bot.AdmissionControl(chat_rate=1, chat_burst=1, timer=timer)
+    admission_control.admit_chat(1)
+    for expected_text in [bot.RATE_LIMITED_REPLY_TEXT, '', '']:
+        with pytest.raises(bot.CommandRejected) as exc_info:
+            admission_control.admit_chat(1)
+        assert str(exc_info.value) == expected_text
+    timer.now = 1
+    admission_control.admit_chat(1)
+    with pytest.raises(bot.CommandRejected, match=bot.RATE_LIMITED_REPLY_TEXT):
+        admission_control.admit_chat(1)
+
+
+def test_flooding_chat_doesnt_delay_replies_to_other_chats():
+    config = bot.Config(('some_github_token',), 'some_telegram_token')
+    commands_executor = bot._get_commands_executor(config)
+    telegram_api = _FakeSendTelegramApi()
+    send_queue = bot.SendQueue(telegram_api, maxsize=10)
+    send_queue.start()
+    dispatcher = bot.UpdatesDispatcher(
+        functools.partial(bot._handle_update, send_queue=send_queue, commands_executor=commands_executor))
+    started_at = time.monotonic()
+    try:
+        dispatcher.dispatch([_make_update(update_id, chat_id=1) for update_id in range(30)])
+        dispatcher.dispatch([_make_update(30, chat_id=2)])
+        _wait_until(lambda: any(chat_id == 2 for chat_id, _, _ in telegram_api.sent_messages))
+    finally:
+        send_queue.close(timeout=0)
+    sent_at, = [sent_at for chat_id, _, sent_at in telegram_api.sent_messages if chat_id == 2]
+    assert sent_at - started_at < 2
+    assert send_queue.stats['max_queued'] <= bot.COMMAND_CHAT_BURST + 2
+
+
+def test_admission_control_forgets_least_recent_chats():
+    admission_control = bot.AdmissionControl(chat_rate=1, chat_burst=1, chat_buckets_maxsize=2, timer=_FakeTimer())
+    admission_control.admit_chat(1)
+    admission_control.admit_chat(2)
+    admission_control.admit_chat(3)
+    admission_control.admit_chat(1)
+    with pytest.raises(bot.CommandRejected):
+        admission_control.admit_chat(3)
+
+
+def test_admission_control_sheds_expensive_commands():
+    finish = threading.Event()
+
+    class SlowCommand:
+        expensive = True
+
+        def __call__(self, args):
+            finish.wait(timeout=5)
+            return 'slow'
+
+    commands = bot.CommandsExecutor({'/slow': SlowCommand(), '/echo': lambda args: ' '.join(args)},
+                                    bot.AdmissionControl(max_concurrent=2, max_waiting=1, max_wait=5))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        running = [executor.submit(commands.execute, bot.ParsedMessage('/slow', (), chat_id=i)) for i in range(2)]
+        while commands.admission_control._running < 2:
+            time.sleep(0.01)
+        waiting = executor.submit(commands.execute, bot.ParsedMessage('/slow', (), chat_id=2))
+        while commands.admission_control._waiting < 1:
+            time.sleep(0.01)
+        with pytest.raises(bot.CommandRejected, match=bot.OVERLOADED_REPLY_TEXT):
+            commands.execute(bot.ParsedMessage('/slow', (), chat_id=3))
+        assert commands.execute(bot.ParsedMessage('/echo', ('cheap',), chat_id=3)) == 'cheap'
+        finish.set()
+        assert [future.result(timeout=5) for future in running + [waiting]] == ['slow'] * 3
+
+
+def test_help_text_lists_subscriptions_only_when_available():
+    config = bot.Config(('some_github_token',), 'some_telegram_token')
+    help_text = bot._get_commands_executor(config).execute(bot.ParsedMessage('/help', ()))
+    assert help_text == bot.HELP_TEXT
+    assert '/subscribe' not in help_text
+    subscriptions = bot.SubscriptionStore(_MemoryStateBackend())
+    help_text = bot._get_commands_executor(config, subscriptions=subscriptions).execute(bot.ParsedMessage('/help', ()))
+    assert help_text.endswith(bot.SUBSCRIPTIONS_HELP_TEXT)
+
+
+@pytest.mark.parametrize('workers, expected_max_concurrent, expected_max_waiting', [
+    (1, 1, 0),
+    (2, 1, 0),
+    (4, 2, 1),
+    (16, 8, 7),
+])
+def test_commands_executor_admission_control_fits_workers(workers, expected_max_concurrent, expected_max_waiting):
+    config = bot.Config(('some_github_token',), 'some_telegram_token', workers=workers)
+    admission_control = bot._get_commands_executor(config).admission_control
+    assert admission_control.max_concurrent == expected_max_concurrent
+    assert admission_control.max_waiting == expected_max_waiting
+    # expensive commands never take the last worker
+    assert admission_control.max_concurrent + admission_control.max_waiting < workers or workers == 1
+
+
+def test_admission_control_rejects_after_max_wait():
+    admission_control = bot.AdmissionControl(max_concurrent=1, max_wait=0.01)
+    with admission_control.turn():
+        with pytest.raises(bot.CommandRejected):
+            admission_control.acquire()
+    with admission_control.turn():
+        pass
+
+
+def test_admission_control_shares_turns_of_the_same_key():
+    admission_control = bot.AdmissionControl(max_concurrent=1, max_waiting=0)
+    admission_control.acquire('some_key')
+    admission_control.acquire('some_key')
+    _run_until_complete(admission_control.acquire_async('some_key'))
+    with pytest.raises(bot.CommandRejected):
+        admission_control.acquire('other_key')
+    with pytest.raises(bot.CommandRejected):
+        admission_control.acquire()
+    for _ in range(3):
+        admission_control.release('some_key')
+    with admission_control.turn('other_key'):
+        assert admission_control._running == 1
+    assert admission_control._running == 0
+
+
+def test_admission_control_passes_wakeups_of_cancelled_waiters():
+    admission_control = bot.AdmissionControl(max_concurrent=1, max_wait=5)
+    admission_control.acquire()
+
+    async def go():
+        first = asyncio.ensure_future(admission_control.acquire_async())
+        second = asyncio.ensure_future(admission_control.acquire_async())
+        await asyncio.sleep(0.01)
+        # the first waiter is woken up when it's cancelled already
+        first.cancel()
+        admission_control.release()
+        started_at = time.monotonic()
+        await second
+        return first.cancelled(), time.monotonic() - started_at
+
+    first_cancelled, second_wait = _run_until_complete(go())
+    assert first_cancelled
+    assert second_wait < 1
+    assert admission_control._running == 1
+    assert admission_control._waiting == 0
+
+
+def test_admission_control_keeps_order_of_async_waiters():
+    admission_control = bot.AdmissionControl(max_concurrent=1, max_wait=5)
+    admission_control.acquire()
+    acquired = []
+
+    async def acquire(name):
+        await admission_control.acquire_async()
+        acquired.append(name)
+
+    async def go():
+        first = asyncio.ensure_future(acquire('first'))
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(acquire('second'))
+        await asyncio.sleep(0.01)
+        # a thread takes the turn before the woken up first waiter does
+        admission_control.release()
+        admission_control.acquire()
+        await asyncio.sleep(0.01)
+        admission_control.release()
+        await first
+        admission_control.release()
+        await second
+
+    _run_until_complete(go())
+    assert acquired == ['first', 'second']
+
+
+def _run_until_complete(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_commands_executor_waits_for_turns_without_taking_threads():
+    class SlowCommand:
+        expensive = True
+
+        def __call__(self, args):
+            time.sleep(0.05)
+            return 'slow'
+
+    commands = bot.CommandsExecutor({'/slow': SlowCommand()},
+                                    bot.AdmissionControl(max_concurrent=1, max_waiting=2, max_wait=2))
+
+    async def execute_all():
+        return await asyncio.gather(*[
+            commands.execute_async(bot.ParsedMessage('/slow', (), chat_id=i)) for i in range(3)
+        ])
+
+    loop = asyncio.new_event_loop()
+    # with a single thread, a turn waited for in the executor would block the running command
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=1))
+    try:
+        results = loop.run_until_complete(execute_all())
+    finally:
+        loop.close()
+    assert results == ['slow'] * 3
+    assert commands.admission_control._running == 0
+    assert commands.admission_control._waiting == 0
+
+
 def _make_repo(age_in_days):
     return bot.Repo(
         name=f'some_name {age_in_days}',
@@ -377,15 +1202,45 @@ def test_github_show_command(monkeypatch, args, expected_result):
     assert result == expected_result
 
 
+def test_github_show_command_with_language(monkeypatch):
+    calls = []
+
+    def find_trending_repositories_by_language(github_token, age_in_days, language):
+        calls.append((age_in_days, language))
+        return [_make_repo(age_in_days)] if language == 'python' else []
+
+    monkeypatch.setattr(bot, 'find_trending_repositories_by_language', find_trending_repositories_by_language)
+    command = bot.GithubShowCommand('some_github_token')
+    assert command(['3', 'python']) == (
+        f'<a href="http://example.com">some_name 3</a> - some_description [Python 3{bot.STAR_SYMBOL}]')
+    assert command(['rust']) == (f'none of the {bot.CORPUS_SIZE} most starred repositories of the last '
+                                 f'{bot.CORPUS_MAX_AGE_IN_DAYS} days are rust repositories created in the last 7 days')
+    assert calls == [(3, 'python'), (7, 'rust')]
+
+
 @pytest.mark.parametrize('args', [
     # many args
-    ['3', '4'],
+    ['3', 'rust', '4'],
     # not an int
     [''],
+    ['week', 'rust'],
+    # empty language, e.g. of a trailing space
+    ['7', ''],
+    ['7', ' '],
+    # language of a window older than the corpus
+    [str(bot.CORPUS_MAX_AGE_IN_DAYS + 1), 'rust'],
+    ['0', 'rust'],
+    # out of range
+    ['0'],
+    ['-1'],
+    [str(bot.MAX_AGE_IN_DAYS + 1)],
+    ['99999999'],
 ])
 def test_github_show_command_error_handling(args):
+    popularity = bot.PopularityTracker()
     with pytest.raises(bot.InvalidCommand):
-        bot.GithubShowCommand('some_github_token')(args)
+        bot.GithubShowCommand('some_github_token', popularity=popularity)(args)
+    assert popularity.most_common(1) == []
 
 
 class _BreakFromInfiniteLoop(Exception):
@@ -479,6 +1334,911 @@ def test_main(monkeypatch, update_texts, expected_text):
     assert offset_state.offset == 4
 
 
+def _make_update(update_id, chat_id, text='/help'):
+    return bot.Update(
+        update_id=update_id,
+        message=bot.Message(chat_id=chat_id, message_id=update_id, text=text),
+    )
+
+
+def test_updates_dispatcher_keeps_per_chat_order():
+    handled = []
+    lock = threading.Lock()
+
+    def handle_update(update):
+        with lock:
+            handled.append((update.message.chat_id, update.update_id))
+
+    updates = [_make_update(update_id, chat_id=update_id % 3) for update_id in range(30)]
+    bot.UpdatesDispatcher(handle_update, workers=4).dispatch(updates)
+    assert len(handled) == len(updates)
+    for chat_id in range(3):
+        chat_update_ids = [update_id for handled_chat_id, update_id in handled if handled_chat_id == chat_id]
+        assert chat_update_ids == sorted(chat_update_ids)
+
+
+def test_updates_dispatcher_handles_chats_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    # would time out if the two chats were handled one after another
+    bot.UpdatesDispatcher(lambda update: barrier.wait(), workers=2).dispatch([
+        _make_update(1, chat_id=1),
+        _make_update(2, chat_id=2),
+    ])
+
+
+def test_updates_dispatcher_propagates_errors():
+    def handle_update(update):
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        bot.UpdatesDispatcher(handle_update).dispatch([_make_update(1, chat_id=1)])
+
+
+def test_adaptive_updates_limit():
+    updates_limit = bot.AdaptiveUpdatesLimit(min_limit=5, max_limit=100)
+    values = []
+    for batch_size in [5, 10, 20, 40, 80, 100, 100, 30, 10, 0, 0, 0]:
+        updates_limit.update(batch_size)
+        values.append(updates_limit.value)
+    assert values == [10, 20, 40, 80, 100, 100, 100, 50, 25, 12, 6, 5]
+
+
+def test_updates_stats():
+    stats = bot.UpdatesStats()
+    updates = [
+        bot.Update(1, bot.Message(1, 1, '/show', date=90)),
+        bot.Update(2, bot.Message(1, 2, '/show', date=95)),
+        bot.Update(3, None),
+    ]
+    stats.record_batch(updates, limit=3, now=100)
+    stats.record_batch([], limit=6, now=200)
+    assert stats.as_dict() == {
+        'batches': 2,
+        'updates': 3,
+        'full_batches': 1,
+        'limit': 6,
+        'last_batch_size': 0,
+        'max_batch_size': 3,
+        'last_queue_lag': 0,
+        'max_queue_lag': 10,
+    }
+
+
+class _FakeTimer:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_trending_cache_serves_fallback_key_while_loading():
+    timer = _FakeTimer()
+    background = []
+    cache = bot.TrendingCache(ttl=10, stale_ttl=100, timer=timer, run_in_background=background.append)
+    cache.get('previous', lambda: 'previous value')
+    assert cache.get('key', lambda: 'value', fallback_key='previous') == 'previous value'
+    assert cache.get('key', lambda: 'value', fallback_key='previous') == 'previous value'
+    background.pop()()
+    assert background == []
+    assert cache.get('key', lambda: 'other value', fallback_key='previous') == 'value'
+    # an expired fallback is not served
+    timer.now += 110
+    assert cache.get('other_key', lambda: 'other value', fallback_key='previous') == 'other value'
+    assert cache.stats['fallback_hits'] == 2
+
+
+def _make_trending_cache(timer, **kwargs):
+    return bot.TrendingCache(ttl=10, stale_ttl=100, timer=timer, run_in_background=lambda func: func(), **kwargs)
+
+
+def test_trending_cache_serves_stale_values_while_refreshing():
+    timer = _FakeTimer()
+    cache = _make_trending_cache(timer)
+    loaded = []
+
+    def load():
+        loaded.append(timer.now)
+        return f'loaded at {timer.now}'
+
+    assert cache.get('key', load) == 'loaded at 0'
+    timer.now = 5
+    assert cache.get('key', load) == 'loaded at 0'
+    timer.now = 50
+    # stale value is returned, refresh runs in the background
+    assert cache.get('key', load) == 'loaded at 0'
+    assert cache.get('key', load) == 'loaded at 50'
+    timer.now = 1000
+    # too old to be served
+    assert cache.get('key', load) == 'loaded at 1000'
+    assert loaded == [0, 50, 1000]
+    assert cache.stats.as_dict() == {
+        'hits': 2,
+        'misses': 2,
+        'stale_hits': 1,
+        'fallback_hits': 0,
+        'expired_hits': 0,
+        'refreshes': 1,
+        'refresh_errors': 0,
+        'evictions': 0,
+        'store_hits': 0,
+        'store_errors': 0,
+    }
+
+
+def test_trending_cache_keeps_stale_value_when_refresh_fails():
+    timer = _FakeTimer()
+    cache = _make_trending_cache(timer)
+    cache.get('key', lambda: 'first')
+    timer.now = 50
+
+    def fail():
+        raise bot.GithubApiError
+
+    assert cache.get('key', fail) == 'first'
+    assert cache.get('key', fail) == 'first'
+    assert cache.stats['refresh_errors'] == 2
+
+
+def test_trending_cache_serves_expired_value_when_load_fails():
+    timer = _FakeTimer()
+    cache = _make_trending_cache(timer)
+    cache.get('key', lambda: 'first')
+    timer.now = 1000
+
+    def fail():
+        raise bot.GithubRateLimitExceeded
+
+    assert cache.get('key', fail) == 'first'
+    assert cache.stats['expired_hits'] == 1
+    with pytest.raises(bot.GithubRateLimitExceeded):
+        cache.get('other_key', fail)
+
+
+def test_trending_cache_refreshes_with_deferrable_requests():
+    cache = bot.TrendingCache()
+    cache.refresh('key', lambda: bot._are_requests_deferrable())
+    assert cache.get('key', lambda: None) is True
+    assert not bot._are_requests_deferrable()
+
+
+def test_trending_cache_evicts_least_recently_used():
+    timer = _FakeTimer()
+    cache = _make_trending_cache(timer, maxsize=2)
+    cache.get('first', lambda: 1)
+    cache.get('second', lambda: 2)
+    cache.get('first', lambda: 1)
+    cache.get('third', lambda: 3)
+    assert cache.get('first', lambda: 'reloaded') == 1
+    assert cache.get('second', lambda: 'reloaded') == 'reloaded'
+    assert cache.stats['evictions'] == 2
+
+
+class _MemoryStateBackend(state.StateBackend):
+    def __init__(self, fail=False):
+        self.values = {}
+        self.fail = fail
+
+    def get(self, key):
+        if self.fail:
+            raise state.StateBackendError
+        return self.values.get(key)
+
+    def set(self, key, value, ttl=None):
+        if self.fail:
+            raise state.StateBackendError
+        self.values[key] = value
+
+
+def test_models_are_immutable_and_hashable():
+    repo = bot.Repo('some_name', '', 'https://some_url', None, 3)
+    assert repo == bot.Repo('some_name', '', 'https://some_url', None, 3)
+    assert len({repo, bot.Repo('some_name', '', 'https://some_url', None, 3)}) == 1
+    assert repr(repo) == ("Repo(name='some_name', description='', html_url='https://some_url', language=None, "
+                          "stargazers_count=3, created_at=None)")
+    assert not hasattr(repo, '__dict__')
+    with pytest.raises(AttributeError):
+        repo.stargazers_count = 4
+    update = bot.Update(1, bot.Message(2, 3, '/show'))
+    assert hash(update) == hash(bot.Update(1, bot.Message(2, 3, '/show')))
+    assert repr(bot.parse_message_text('/show 7')) == "ParsedMessage(name='/show', args=('7',), chat_id=None)"
+
+
+def test_dump_and_load_repositories():
+    repositories = [
+        bot.Repo('first', 'first description', 'https://first', 'Python', 3, dt.datetime(2017, 2, 18, 10, 30)),
+        bot.Repo('second', '', 'https://second', None, 1),
+    ]
+    dumped = json.loads(json.dumps(bot.dump_repositories(repositories)))
+    loaded = bot.load_repositories(dumped)
+    assert loaded == repositories
+
+
+def test_trending_store():
+    clock = _FakeTimer()
+    backend = _MemoryStateBackend()
+    store = bot.TrendingStore(backend, timer=clock)
+    assert store.get(('some_github_token', 7)) is None
+    store.put(('some_github_token', 7), [bot.Repo('some_name', '', 'https://some_url', None, 3)])
+    assert list(backend.values) == ['trending:7']
+    assert b'some_github_token' not in backend.values['trending:7']
+    clock.now = 5
+    (repo,), age = store.get(('other_github_token', 7))
+    assert repo.name == 'some_name'
+    assert age == 5
+    backend.values['trending:7'] = b'corrupted'
+    assert store.get(('some_github_token', 7)) is None
+
+
+def test_trending_cache_loads_fresh_values_from_store():
+    clock = _FakeTimer()
+    store = bot.TrendingStore(_MemoryStateBackend(), timer=clock)
+    repositories = [bot.Repo('some_name', '', 'https://some_url', None, 3)]
+    first_cache = _make_trending_cache(clock, store=store)
+    assert first_cache.get(('some_github_token', 7), lambda: repositories) is repositories
+    # e.g. another process or the same one after a restart
+    second_cache = _make_trending_cache(clock, store=store)
+    clock.now = 5
+    repo, = second_cache.get(('some_github_token', 7), lambda: [])
+    assert repo.name == 'some_name'
+    assert second_cache.stats['store_hits'] == 1
+    # stored values are fresh only for ttl seconds since they were loaded
+    clock.now = 15
+    third_cache = _make_trending_cache(clock, store=store)
+    assert third_cache.get(('some_github_token', 7), lambda: []) == []
+
+
+def test_trending_cache_refresh_reloads_value_in_store():
+    clock = _FakeTimer()
+    store = bot.TrendingStore(_MemoryStateBackend(), timer=clock)
+    cache = _make_trending_cache(clock, store=store)
+    loaded = [bot.Repo('loaded', '', 'https://loaded', None, 3)]
+    refreshed = [bot.Repo('refreshed', '', 'https://refreshed', None, 3)]
+    cache.get(('some_github_token', 7), lambda: loaded)
+    clock.now = 8  # the store still has the fresh value that this cache has put there
+    cache.refresh(('some_github_token', 7), lambda: refreshed)
+    assert cache.get(('some_github_token', 7), lambda: []) is refreshed
+    assert store.get(('some_github_token', 7)) == (refreshed, 0)
+    assert cache.stats['store_hits'] == 0
+
+
+def test_trending_cache_works_without_store():
+    cache = _make_trending_cache(_FakeTimer(), store=bot.TrendingStore(_MemoryStateBackend(fail=True)))
+    repositories = [bot.Repo('some_name', '', 'https://some_url', None, 3)]
+    assert cache.get(('some_github_token', 7), lambda: repositories) is repositories
+    assert cache.stats['store_errors'] == 2
+
+
+def test_state_offset_state():
+    backend = _MemoryStateBackend()
+    offset_state = bot.StateOffsetState(backend)
+    assert offset_state.offset == 0
+    offset_state.offset = 3
+    assert backend.values == {'offset': b'3'}
+    assert bot.StateOffsetState(backend).offset == 3
+    backend.fail = True
+    offset_state.offset = 4
+    assert offset_state.offset == 4
+    backend.fail = False
+    offset_state.flush()
+    assert backend.values == {'offset': b'4'}
+
+
+def test_trending_cache_loads_missing_key_once():
+    cache = bot.TrendingCache()
+    started = threading.Event()
+    release = threading.Event()
+    loads = []
+
+    def load():
+        loads.append(1)
+        started.set()
+        release.wait(5)
+        return 'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('key', load))) for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ['value'] * 5
+    assert loads == [1]
+
+
+def test_trending_cache_shares_load_error():
+    cache = bot.TrendingCache()
+    with pytest.raises(bot.GithubApiError):
+        cache.get('key', lambda: (_ for _ in ()).throw(bot.GithubApiError()))
+    assert cache.get('key', lambda: 'value') == 'value'
+
+
+def test_trending_cache_refresh():
+    cache = bot.TrendingCache()
+    cache.get('key', lambda: 'first')
+    cache.refresh('key', lambda: 'second')
+    assert cache.get('key', lambda: 'third') == 'second'
+
+
+def test_popularity_tracker_counts_recent_keys():
+    popularity = bot.PopularityTracker(history_size=4)
+    for key in [1, 1, 1, 7, 30, 30]:
+        popularity.record(key)
+    # the oldest two 1s are out of history
+    assert popularity.most_common(2) == [30, 1]
+
+
+def test_github_show_command_records_popularity(monkeypatch):
+    monkeypatch.setattr(
+        bot,
+        'find_trending_repositories',
+        lambda github_token, age_in_days: [_make_repo(age_in_days)]
+    )
+    popularity = bot.PopularityTracker()
+    command = bot.GithubShowCommand('some_github_token', popularity=popularity)
+    command(['3'])
+    command(['3'])
+    command([])
+    assert popularity.most_common(2) == [3, bot.DEFAULT_AGE_IN_DAYS]
+
+
+def test_trending_prewarmer_refreshes_configured_and_popular_ages(monkeypatch):
+    refreshed = []
+    monkeypatch.setattr(
+        bot,
+        'refresh_trending_repositories',
+        lambda github_token, ages_in_days: refreshed.append((github_token, ages_in_days))
+    )
+    popularity = bot.PopularityTracker()
+    for key in [3, 3, 7, 14]:
+        popularity.record(key)
+    prewarmer = bot.TrendingPrewarmer('some_github_token', ages_in_days=(1, 7), popularity=popularity,
+                                      top_requested=2)
+    prewarmer.refresh_all()
+    assert refreshed == [('some_github_token', [1, 7, 3])]
+
+
+def test_trending_prewarmer_survives_unexpected_errors(monkeypatch):
+    calls = []
+
+    def refresh_trending_repositories(github_token, ages_in_days):
+        calls.append(ages_in_days)
+        if len(calls) == 1:
+            raise OverflowError('date value out of range')
+
+    monkeypatch.setattr(bot, 'refresh_trending_repositories', refresh_trending_repositories)
+    prewarmer = bot.TrendingPrewarmer('some_github_token', ages_in_days=(1,), interval=0.01)
+    prewarmer.start()
+    try:
+        _wait_until(lambda: len(calls) >= 2)
+    finally:
+        prewarmer.stop()
+
+
+class _FakeDayBucketsGithubApi:
+    def __init__(self, repositories):
+        self.repositories = repositories
+        self.calls = []
+
+    def find_repositories_created_on(self, created_on, limit):
+        self.calls.append(created_on)
+        return [repo for repo in self.repositories if repo.created_at.date() == created_on][:limit]
+
+    def find_repositories_created_between(self, created_after, created_before, limit):
+        self.calls.append(created_after)
+        return sorted(
+            (repo for repo in self.repositories if created_after <= repo.created_at <= created_before),
+            key=lambda repo: repo.stargazers_count,
+            reverse=True,
+        )[:limit]
+
+    def find_trending_repositories(self, created_after, limit):
+        self.calls.append(created_after)
+        return [repo for repo in self.repositories if repo.created_at > created_after][:limit]
+
+
+def _make_dated_repo(name, created_at, stargazers_count, language=None):
+    return bot.Repo(
+        name=name,
+        description='',
+        html_url=f'http://example.com/{name}',
+        language=language,
+        stargazers_count=stargazers_count,
+        created_at=created_at,
+    )
+
+
+@pytest.fixture
+def fake_day_buckets_github_api(monkeypatch):
+    monkeypatch.setattr(bot, 'trending_cache', bot.TrendingCache())
+    github_api = _FakeDayBucketsGithubApi([
+        _make_dated_repo('today', dt.datetime(2017, 2, 18, 9), 5),
+        _make_dated_repo('yesterday', dt.datetime(2017, 2, 17, 12), 20),
+        _make_dated_repo('two_days_ago_in_window', dt.datetime(2017, 2, 16, 12), 10),
+        _make_dated_repo('two_days_ago_out_of_window', dt.datetime(2017, 2, 16, 11), 30),
+    ])
+    monkeypatch.setattr(bot, 'get_github_api', lambda github_token: github_api)
+    return github_api
+
+
+@freeze_time('2017-02-18T11:55:03Z')
+def test_find_trending_repositories_merges_day_buckets(fake_day_buckets_github_api):
+    repositories = bot.find_trending_repositories('some_github_token', 2)
+    assert [repo.name for repo in repositories] == ['yesterday', 'two_days_ago_in_window', 'today']
+    assert sorted(fake_day_buckets_github_api.calls, key=str) == [
+        dt.datetime(2017, 2, 16, 11, 50), dt.date(2017, 2, 17), dt.date(2017, 2, 18)]
+    # a shorter window shares the day buckets of its whole days
+    repositories = bot.find_trending_repositories('some_github_token', 1)
+    assert [repo.name for repo in repositories] == ['yesterday', 'today']
+    assert fake_day_buckets_github_api.calls[3:] == [dt.datetime(2017, 2, 17, 11, 50)]
+
+
+@freeze_time('2017-02-18T11:55:03Z')
+def test_find_trending_repositories_reads_cached_day_buckets_without_threads(fake_day_buckets_github_api,
+                                                                               monkeypatch):
+    mapped_keys = []
+
+    class RecordingExecutor:
+        def map(self, func, keys_and_loads):
+            mapped_keys.append([key for key, _ in keys_and_loads])
+            return map(func, keys_and_loads)
+
+    monkeypatch.setattr(bot, '_day_buckets_executor', RecordingExecutor())
+    bot.find_trending_repositories('some_github_token', 1)
+    assert len(mapped_keys[0]) == 2
+    bot.find_trending_repositories('some_github_token', 2)
+    # the day bucket of today is cached already
+    assert ('some_github_token', dt.date(2017, 2, 18)) not in mapped_keys[1]
+    repositories = bot.find_trending_repositories('some_github_token', 2)
+    assert [repo.name for repo in repositories] == ['yesterday', 'two_days_ago_in_window', 'today']
+    assert mapped_keys[2] == []
+
+
+@freeze_time('2017-01-10T23:00:00Z')
+def test_find_trending_repositories_keeps_late_repositories_of_first_day(fake_day_buckets_github_api):
+    fake_day_buckets_github_api.repositories = [
+        _make_dated_repo('today', dt.datetime(2017, 1, 10, 9), 5),
+        _make_dated_repo('first_day_late', dt.datetime(2017, 1, 9, 23, 30), 50),
+    ] + [
+        _make_dated_repo(f'first_day_early_{i}', dt.datetime(2017, 1, 9, 10, i), 100 + i)
+        for i in range(bot.TRENDING_REPOSITORIES_LIMIT)
+    ]
+    repositories = bot.find_trending_repositories('some_github_token', 1)
+    assert [repo.name for repo in repositories] == ['first_day_late', 'today']
+
+
+@freeze_time('2017-02-18T11:55:03Z')
+def test_find_trending_repositories_searches_long_windows(fake_day_buckets_github_api):
+    bot.find_trending_repositories('some_github_token', bot.DAY_BUCKETS_MAX_AGE_IN_DAYS + 1)
+    assert fake_day_buckets_github_api.calls == [dt.datetime(2017, 2, 3, 11, 50)]
+
+
+def test_find_trending_repositories_repeats_searches_of_long_windows(fake_day_buckets_github_api):
+    # the same search within a step can be answered with 304 Not Modified
+    for now in ['2017-02-18T11:50:00Z', '2017-02-18T11:55:03Z', '2017-02-18T11:59:59Z']:
+        with freeze_time(now):
+            bot._find_trending_repositories('some_github_token', 30)
+            bot._find_corpus_repositories('some_github_token')
+    assert set(fake_day_buckets_github_api.calls) == {dt.datetime(2017, 1, 19, 11, 50)}
+
+
+@freeze_time('2017-02-18T23:00:00Z')
+def test_find_trending_repositories_leaves_out_repositories_before_long_windows(fake_day_buckets_github_api):
+    fake_day_buckets_github_api.repositories = [
+        _make_dated_repo('before_window', dt.datetime(2017, 1, 19, 1), 100, language='Go'),
+        _make_dated_repo('in_window', dt.datetime(2017, 1, 20), 10, language='Go'),
+    ]
+    assert [repo.name for repo in bot.find_trending_repositories('some_github_token', 30)] == ['in_window']
+    repositories = bot.find_trending_repositories_by_language('some_github_token', 30, 'go')
+    assert [repo.name for repo in repositories] == ['in_window']
+
+
+@freeze_time('2017-02-18T23:00:00Z')
+def test_find_trending_repositories_filters_long_windows_loaded_in_previous_step(fake_day_buckets_github_api):
+    fake_day_buckets_github_api.repositories = [
+        _make_dated_repo('start_of_previous_step', dt.datetime(2017, 1, 19, 22, 55), 100),
+        _make_dated_repo('in_window', dt.datetime(2017, 1, 20), 10),
+    ]
+    with freeze_time('2017-02-18T22:59:00Z'):
+        bot.find_trending_repositories('some_github_token', 30)
+    assert [repo.name for repo in bot.find_trending_repositories('some_github_token', 30)] == ['in_window']
+
+
+@freeze_time('2017-02-18T11:55:03Z')
+def test_refresh_trending_repositories_refreshes_shared_day_buckets_once(fake_day_buckets_github_api):
+    bot.refresh_trending_repositories('some_github_token', [1, 2])
+    # the first days of the next WINDOW_START_STEP are searched too
+    assert sorted(fake_day_buckets_github_api.calls, key=str) == [
+        dt.datetime(2017, 2, 16, 11, 50), dt.datetime(2017, 2, 16, 12), dt.date(2017, 2, 17),
+        dt.datetime(2017, 2, 17, 11, 50), dt.datetime(2017, 2, 17, 12), dt.date(2017, 2, 18)]
+
+
+@pytest.mark.parametrize('first_now, second_now, expected_search', [
+    ('2017-02-18T12:09:00Z', '2017-02-18T12:10:01Z', dt.datetime(2017, 2, 17, 12, 10)),
+    # the whole first day is a day bucket of the previous step
+    ('2017-02-18T23:59:00Z', '2017-02-19T00:00:01Z', dt.datetime(2017, 2, 18)),
+])
+def test_find_trending_repositories_serves_previous_step_while_loading(fake_day_buckets_github_api, monkeypatch,
+                                                                       first_now, second_now, expected_search):
+    background = []
+    monkeypatch.setattr(bot.trending_cache, 'run_in_background', background.append)
+    with freeze_time(first_now):
+        first = bot.find_trending_repositories('some_github_token', 1)
+    searches = len(fake_day_buckets_github_api.calls)
+    with freeze_time(second_now):
+        assert bot.find_trending_repositories('some_github_token', 1)[:1] == first[:1]
+        assert expected_search not in fake_day_buckets_github_api.calls[searches:]
+        for refresh in background:
+            refresh()
+    assert expected_search in fake_day_buckets_github_api.calls[searches:]
+
+
+@freeze_time('2017-02-18T11:55:03Z')
+def test_show_commands_take_turns_only_for_github_searches(fake_day_buckets_github_api, monkeypatch):
+    find_trending_repositories = fake_day_buckets_github_api.find_trending_repositories
+
+    def find_trending_repositories_slowly(created_after, limit):
+        time.sleep(0.2)
+        return find_trending_repositories(created_after, limit)
+
+    monkeypatch.setattr(fake_day_buckets_github_api, 'find_trending_repositories', find_trending_repositories_slowly)
+    config = bot.Config(('some_github_token',), 'some_telegram_token', workers=4)
+    commands_executor = bot._get_commands_executor(config)
+    replies = []
+    dispatcher = bot.UpdatesDispatcher(
+        lambda update: replies.append(bot._get_reply_text(update, commands_executor)), workers=config.workers)
+    # a burst of the same /show on a cold cache makes one search, and everyone waits for it
+    dispatcher.dispatch([_make_update(update_id, chat_id=update_id, text='/show 30') for update_id in range(8)])
+    assert len(replies) == 8
+    assert len(set(replies)) == 1
+    assert 'yesterday' in replies[0]
+    assert len(fake_day_buckets_github_api.calls) == 1
+    # cached results take no turn
+    commands_executor.admission_control = bot.AdmissionControl(max_concurrent=1, max_waiting=0)
+    with commands_executor.admission_control.turn():
+        assert commands_executor.execute(bot.ParsedMessage('/show', ('30',), chat_id=100)) == replies[0]
+        with pytest.raises(bot.CommandRejected):
+            commands_executor.execute(bot.ParsedMessage('/show', ('365',), chat_id=100))
+
+
+@freeze_time('2017-02-18T11:55:03Z')
+def test_find_trending_repositories_by_language_searches_corpus_once(fake_day_buckets_github_api):
+    fake_day_buckets_github_api.repositories = [
+        _make_dated_repo('rust_today', dt.datetime(2017, 2, 18, 9), 5, 'Rust'),
+        _make_dated_repo('rust_last_week', dt.datetime(2017, 2, 12), 50, 'Rust'),
+        _make_dated_repo('notebook_yesterday', dt.datetime(2017, 2, 17, 12), 20, 'Jupyter Notebook'),
+        _make_dated_repo('no_language', dt.datetime(2017, 2, 17, 12), 30),
+    ]
+    find = bot.find_trending_repositories_by_language
+    assert [repo.name for repo in find('some_github_token', 7, 'rust')] == ['rust_last_week', 'rust_today']
+    assert [repo.name for repo in find('some_github_token', 1, 'RUST')] == ['rust_today']
+    assert [repo.name for repo in find('some_github_token', 2, 'jupyter-notebook')] == ['notebook_yesterday']
+    assert find('some_github_token', 7, 'go') == []
+    assert fake_day_buckets_github_api.calls == [
+        dt.datetime(2017, 2, 18, 11, 50) - dt.timedelta(days=bot.CORPUS_MAX_AGE_IN_DAYS)]
+
+
+def test_trending_index_find_stops_at_limit():
+    repositories = [
+        _make_dated_repo(f'repo_{i}', dt.datetime(2017, 2, 10 + i % 2), i, 'Python')
+        for i in range(10)
+    ]
+    index = bot.TrendingIndex(repositories)
+    found = index.find('python', created_after=dt.datetime(2017, 2, 10, 12), limit=3)
+    assert [repo.name for repo in found] == ['repo_9', 'repo_7', 'repo_5']
+
+
+def _make_search_pages_callback(get_names, requested_pages):
+    def callback(request):
+        query = urlparse.parse_qs(urlparse.urlparse(request.url).query)
+        page = int(query['page'][0])
+        requested_pages.append(page)
+        items = [
+            {'name': name, 'description': '', 'html_url': f'http://example.com/{name}', 'language': 'Python',
+             'stargazers_count': 1}
+            for name in get_names(page, int(query['per_page'][0]))
+        ]
+        return 200, {}, json.dumps({'items': items})
+
+    return callback
+
+
+@responses.activate
+def test_github_api_iter_trending_repositories_dedupes_and_stops_at_short_page():
+    requested_pages = []
+    responses.add_callback(
+        responses.GET,
+        'https://api.github.com/search/repositories',
+        callback=_make_search_pages_callback(lambda page, per_page: {
+            1: ['first', 'second'],
+            # 'second' moved to the next page between requests
+            2: ['second', 'third'],
+            3: ['fourth'],
+        }.get(page, []), requested_pages),
+    )
+    api = bot.GithubApi('some_github_token')
+    repositories = api.iter_trending_repositories(dt.datetime(2017, 1, 5), limit=100, page_size=2, concurrency=2)
+    assert [repo.name for repo in repositories] == ['first', 'second', 'third', 'fourth']
+    # the first page goes alone, then two at a time, the fourth page is cancelled unless it has already started
+    assert requested_pages[0] == 1
+    assert sorted(requested_pages)[:3] == [1, 2, 3]
+    assert max(requested_pages) <= 4
+
+
+@responses.activate
+def test_github_api_iter_trending_repositories_stops_at_limit():
+    requested_pages = []
+    responses.add_callback(
+        responses.GET,
+        'https://api.github.com/search/repositories',
+        callback=_make_search_pages_callback(
+            lambda page, per_page: [f'repo_{page}_{i}' for i in range(per_page)], requested_pages),
+    )
+    api = bot.GithubApi('some_github_token')
+    repositories = api.find_trending_repositories(dt.datetime(2017, 1, 5), limit=bot.GITHUB_SEARCH_PAGE_SIZE + 1)
+    assert len(repositories) == bot.GITHUB_SEARCH_PAGE_SIZE + 1
+    repositories = api.iter_trending_repositories(dt.datetime(2017, 1, 5), limit=3, page_size=2, concurrency=1)
+    assert [repo.name for repo in repositories] == ['repo_1_0', 'repo_1_1', 'repo_2_0']
+
+
+def test_github_api_iter_trending_repositories_keeps_to_rate_budget(monkeypatch):
+    api = bot.GithubApi('some_github_token')
+    api.tokens[0].rate_limiter.update({'X-RateLimit-Limit': '30', 'X-RateLimit-Remaining': '2',
+                                       'X-RateLimit-Reset': str(int(time.time()) + 60)})
+    in_flight = []
+    max_in_flight = []
+    lock = threading.Lock()
+
+    def search_repositories(params, deferrable):
+        with lock:
+            in_flight.append(params['page'])
+            max_in_flight.append(len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.remove(params['page'])
+        page = int(params['page'])
+        return [_make_dated_repo(f'repo_{page}_{i}', dt.datetime(2017, 1, 6), 1) for i in range(2)]
+
+    monkeypatch.setattr(api, '_search_repositories', search_repositories)
+    repositories = list(api.iter_trending_repositories(dt.datetime(2017, 1, 5), limit=10, page_size=2,
+                                                       concurrency=4))
+    assert len(repositories) == 10
+    assert max(max_in_flight) <= 2
+
+
+def test_buffered_file_offset_state_flushes_every_n_updates(tmp_path):
+    path = tmp_path / 'last_update'
+    path.write_text('10')
+    timer = _FakeTimer()
+    offset_state = bot.BufferedFileOffsetState(str(path), flush_interval=60, flush_every=3, timer=timer)
+    assert offset_state.offset == 10
+    offset_state.offset = 11
+    offset_state.offset = 12
+    assert path.read_text() == '10'
+    assert offset_state.offset == 12
+    offset_state.offset = 13
+    assert path.read_text() == '13'
+    assert not (tmp_path / 'last_update.tmp').exists()
+
+
+def test_buffered_file_offset_state_flushes_every_interval(tmp_path):
+    path = tmp_path / 'last_update'
+    path.write_text('10')
+    timer = _FakeTimer()
+    offset_state = bot.BufferedFileOffsetState(str(path), flush_interval=60, flush_every=100, timer=timer)
+    offset_state.offset = 11
+    timer.now = 59
+    offset_state.offset = 11
+    assert path.read_text() == '10'
+    timer.now = 60
+    # the offset didn't change, but the unflushed one is due
+    offset_state.offset = 11
+    assert path.read_text() == '11'
+
+
+def test_buffered_file_offset_state_flush(tmp_path):
+    path = tmp_path / 'last_update'
+    path.write_text('10')
+    offset_state = bot.BufferedFileOffsetState(str(path))
+    offset_state.offset = 11
+    offset_state.flush()
+    assert path.read_text() == '11'
+
+
+@pytest.mark.parametrize('content', [
+    # missing file
+    None,
+    # torn write of an older version
+    '',
+    'garbage',
+])
+def test_buffered_file_offset_state_recovers(tmp_path, content):
+    path = tmp_path / 'last_update'
+    if content is not None:
+        path.write_text(content)
+    offset_state = bot.BufferedFileOffsetState(str(path))
+    assert offset_state.offset == 0
+    offset_state.offset = 5
+    offset_state.flush()
+    assert path.read_text() == '5'
+
+
+@pytest.mark.parametrize('args, expected_subscription', [
+    (('daily',), bot.Subscription(5, 'daily', 1)),
+    (('weekly',), bot.Subscription(5, 'weekly', 7)),
+    (('weekly', '30'), bot.Subscription(5, 'weekly', 30)),
+])
+def test_subscribe_command(args, expected_subscription):
+    subscriptions = bot.SubscriptionStore(_MemoryStateBackend())
+    commands = bot.CommandsExecutor({'/subscribe': bot.SubscribeCommand(subscriptions)})
+    commands.execute(bot.ParsedMessage('/subscribe', args, chat_id=5))
+    assert subscriptions.get_all() == [expected_subscription]
+
+
+@pytest.mark.parametrize('args', [
+    (), ('hourly',), ('daily', 'x'), ('daily', '0'), ('daily', '1', '2'), ('daily', str(bot.MAX_AGE_IN_DAYS + 1)),
+])
+def test_subscribe_command_invalid_args(args):
+    with pytest.raises(bot.InvalidCommand):
+        bot.SubscribeCommand(bot.SubscriptionStore(_MemoryStateBackend()))(args, 5)
+
+
+def test_subscribe_command_without_store():
+    with pytest.raises(bot.InvalidCommand, match='not available'):
+        bot.SubscribeCommand(None)(('daily',), 5)
+
+
+def test_unsubscribe_command():
+    subscriptions = bot.SubscriptionStore(_MemoryStateBackend())
+    subscriptions.put(bot.Subscription(5, 'daily', 1))
+    subscriptions.put(bot.Subscription(6, 'weekly', 7))
+    assert bot.UnsubscribeCommand(subscriptions)((), 5) == 'unsubscribed'
+    assert bot.UnsubscribeCommand(subscriptions)((), 5) == 'you are not subscribed'
+    assert subscriptions.get_all() == [bot.Subscription(6, 'weekly', 7)]
+
+
+def test_subscription_store_converts_state_errors():
+    with pytest.raises(bot.StateError):
+        bot.SubscriptionStore(_MemoryStateBackend(fail=True)).get_all()
+
+
+@pytest.mark.parametrize('data', [b'not json', b'[]', b'{"5": "daily"}'])
+def test_subscribe_command_replies_with_error_to_corrupted_subscriptions(data):
+    backend = _MemoryStateBackend()
+    backend.values[bot.SUBSCRIPTIONS_STATE_KEY] = data
+    commands = bot.CommandsExecutor({'/subscribe': bot.SubscribeCommand(bot.SubscriptionStore(backend))})
+    update = _make_update(1, chat_id=5, text='/subscribe daily')
+    assert bot._get_reply_text(update, commands) == bot.ERROR_REPLY_TEXT
+    # corrupted subscriptions are kept for repair
+    assert backend.values[bot.SUBSCRIPTIONS_STATE_KEY] == data
+
+
+@pytest.mark.parametrize('schedule, now, expected_run_id', [
+    ('daily', dt.datetime(2017, 2, 18, 9), 'daily:2017-02-18'),
+    ('daily', dt.datetime(2017, 2, 18, 8, 59), 'daily:2017-02-17'),
+    ('weekly', dt.datetime(2017, 2, 18, 9), 'weekly:2017-02-13'),
+    ('weekly', dt.datetime(2017, 2, 13, 8), 'weekly:2017-02-06'),
+])
+def test_get_digest_run_id(schedule, now, expected_run_id):
+    assert bot._get_digest_run_id(schedule, now) == expected_run_id
+
+
+class _FakeQueuedMessage:
+    def __init__(self, is_sent):
+        self.is_sent = is_sent
+
+    def wait(self, timeout=None):
+        if not self.is_sent:
+            raise KeyboardInterrupt  # the process is stopped in the middle of a digest
+        return True
+
+
+class _FakeDigestSendQueue:
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.sent_messages = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent_messages.append((chat_id, text))
+        return _FakeQueuedMessage(self.fail_after is None or len(self.sent_messages) <= self.fail_after)
+
+
+def test_digest_scheduler_skips_out_of_range_days(monkeypatch):
+    rendered_ages = []
+    send_queue = _FakeDigestSendQueue()
+    scheduler = _make_digest_scheduler(monkeypatch, send_queue, _MemoryStateBackend(), rendered_ages)
+    scheduler.subscriptions.put(bot.Subscription(1, 'daily', 99999999))
+    scheduler.subscriptions.put(bot.Subscription(2, 'daily', 1))
+    scheduler.send_digest('daily', 'daily:2017-02-18')
+    assert rendered_ages == [1]
+    assert [chat_id for chat_id, _ in send_queue.sent_messages] == [2]
+
+
+def test_digest_scheduler_survives_unexpected_errors(monkeypatch):
+    runs = []
+
+    def send_due_digests():
+        runs.append(len(runs))
+        if len(runs) == 1:
+            raise OverflowError('date value out of range')
+
+    scheduler = bot.DigestScheduler(bot.SubscriptionStore(_MemoryStateBackend()), _FakeDigestSendQueue(),
+                                    'some_token', interval=0.01)
+    monkeypatch.setattr(scheduler, 'send_due_digests', send_due_digests)
+    scheduler.start()
+    try:
+        _wait_until(lambda: len(runs) >= 2)
+    finally:
+        scheduler.stop()
+
+
+def _make_digest_scheduler(monkeypatch, send_queue, backend, rendered_ages):
+    def find_trending_repositories(github_token, age_in_days):
+        rendered_ages.append(age_in_days)
+        return [_make_repo(age_in_days)]
+
+    monkeypatch.setattr(bot, 'find_trending_repositories', find_trending_repositories)
+    subscriptions = bot.SubscriptionStore(backend)
+    return bot.DigestScheduler(subscriptions, send_queue, 'some_token', batch_size=2, send_rate=1000)
+
+
+def test_digest_scheduler_renders_each_window_once(monkeypatch):
+    rendered_ages = []
+    send_queue = _FakeDigestSendQueue()
+    scheduler = _make_digest_scheduler(monkeypatch, send_queue, _MemoryStateBackend(), rendered_ages)
+    for chat_id, schedule, age_in_days in [(1, 'daily', 1), (2, 'daily', 7), (3, 'daily', 1), (4, 'weekly', 1)]:
+        scheduler.subscriptions.put(bot.Subscription(chat_id, schedule, age_in_days))
+    scheduler.send_digest('daily', 'daily:2017-02-18')
+    assert sorted(rendered_ages) == [1, 7]
+    assert [chat_id for chat_id, _ in send_queue.sent_messages] == [1, 2, 3]
+    assert send_queue.sent_messages[0][1] == send_queue.sent_messages[2][1] != send_queue.sent_messages[1][1]
+    scheduler.send_digest('daily', 'daily:2017-02-18')
+    assert len(send_queue.sent_messages) == 3
+
+
+def test_digest_scheduler_resumes_after_last_saved_batch(monkeypatch):
+    backend = _MemoryStateBackend()
+    send_queue = _FakeDigestSendQueue(fail_after=2)
+    scheduler = _make_digest_scheduler(monkeypatch, send_queue, backend, [])
+    for chat_id in range(1, 6):
+        scheduler.subscriptions.put(bot.Subscription(chat_id, 'weekly', 7))
+    with pytest.raises(KeyboardInterrupt):
+        scheduler.send_digest('weekly', 'weekly:2017-02-13')
+    resumed_send_queue = _FakeDigestSendQueue()
+    _make_digest_scheduler(monkeypatch, resumed_send_queue, backend, []).send_digest('weekly', 'weekly:2017-02-13')
+    assert [chat_id for chat_id, _ in send_queue.sent_messages] == [1, 2, 3, 4]
+    assert [chat_id for chat_id, _ in resumed_send_queue.sent_messages] == [3, 4, 5]
+
+
+def test_send_queue_returns_queued_messages():
+    telegram_api = _FakeSendTelegramApi(failures=[bot.TelegramApiError('some error')])
+    send_queue = bot.SendQueue(telegram_api, max_attempts=1)
+    assert send_queue.send_message(1, '') is None
+    dropped = send_queue.send_message(1, 'dropped')
+    sent = send_queue.send_message(2, 'sent')
+    assert not sent.wait(timeout=0.01)
+    send_queue.start()
+    assert sent.wait(timeout=5) and sent.sent
+    assert dropped.wait(timeout=5) and not dropped.sent
+    send_queue.close(timeout=5)
+
+
+def test_digest_scheduler_waits_for_its_batch_only(monkeypatch):
+    telegram_api = _FakeSendTelegramApi()
+    send_queue = bot.SendQueue(telegram_api, chat_rate=1000)
+    send_queue.start()
+    backend = _MemoryStateBackend()
+    scheduler = _make_digest_scheduler(monkeypatch, send_queue, backend, [])
+    scheduler.subscriptions.put(bot.Subscription(1, 'daily', 1))
+    scheduler.send_digest('daily', 'daily:2017-02-18')
+    assert [chat_id for chat_id, _, _ in telegram_api.sent_messages] == [1]
+    assert json.loads(backend.values['digest:daily:2017-02-18']) == {'last_chat_id': 1, 'done': True}
+    send_queue.close(timeout=5)
+
+
 def _monkeypatch_for_main(monkeypatch, updates):
     sent_messages = []
     monkeypatch.setattr(
@@ -486,6 +2246,11 @@ def _monkeypatch_for_main(monkeypatch, updates):
         'find_trending_repositories',
         lambda github_token, age_in_days: [_make_repo(age_in_days)]
     )
+    monkeypatch.setattr(
+        bot,
+        'refresh_trending_repositories',
+        lambda github_token, ages_in_days: None
+    )
     monkeypatch.setattr(
         os,
         'environ',
@@ -0,0 +1,188 @@
+import urllib.error
+import urllib.request
+
+import pytest
+import responses
+
+from github_trending_bot import bot
+from github_trending_bot import metrics
+
+
+@pytest.fixture
+def enabled_registry(monkeypatch):
+    monkeypatch.setattr(metrics.registry, 'enabled', True)
+    return metrics.registry
+
+
+def _get_value(metric, suffix='', **labels):
+    for sample_suffix, sample_labels, value in metric.collect():
+        if sample_suffix == suffix and sample_labels == labels:
+            return value
+    return 0
+
+
+def test_disabled_registry_records_nothing():
+    registry = metrics.Registry()
+    counter = registry.counter('requests_total', 'Requests.')
+    histogram = registry.histogram('request_duration_seconds', 'Request time.')
+    counter.inc()
+    histogram.observe(1)
+    with histogram.time():
+        pass
+    assert counter.collect() == []
+    assert histogram.collect() == []
+
+
+def test_expose():
+    registry = metrics.Registry()
+    registry.enable()
+    counter = registry.counter('requests_total', 'Requests.', ['status'])
+    gauge = registry.gauge('queued', 'Queued\nmessages.')
+    histogram = registry.histogram('request_duration_seconds', 'Request time.', buckets=[0.1, 1])
+    counter.inc('200')
+    counter.inc('200', value=2)
+    counter.inc('say "hi"\\')
+    gauge.set(1.5)
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    assert registry.expose() == '\n'.join([
+        '# HELP github_trending_bot_requests_total Requests.',
+        '# TYPE github_trending_bot_requests_total counter',
+        'github_trending_bot_requests_total{status="200"} 3',
+        'github_trending_bot_requests_total{status="say \\"hi\\"\\\\"} 1',
+        '# HELP github_trending_bot_queued Queued\\nmessages.',
+        '# TYPE github_trending_bot_queued gauge',
+        'github_trending_bot_queued 1.5',
+        '# HELP github_trending_bot_request_duration_seconds Request time.',
+        '# TYPE github_trending_bot_request_duration_seconds histogram',
+        'github_trending_bot_request_duration_seconds_bucket{le="0.1"} 1',
+        'github_trending_bot_request_duration_seconds_bucket{le="1"} 2',
+        'github_trending_bot_request_duration_seconds_bucket{le="+Inf"} 3',
+        'github_trending_bot_request_duration_seconds_sum 5.55',
+        'github_trending_bot_request_duration_seconds_count 3',
+        '',
+    ])
+
+
+def test_expose_stats():
+    registry = metrics.Registry()
+    stats = bot.CacheStats()
+    stats.incr('hits', 2)
+    registry.add_stats('cache', 'Cache stats.', stats.as_dict, counters=['hits'])
+    registry.add_stats('token', 'Token stats.', lambda: {
+        'abcd...': {'requests': 3, 'reset_at': None},
+        'efgh...': {'requests': 1, 'reset_at': 10.5},
+    }, labelname='name', counters=['requests'])
+    lines = registry.expose().splitlines()
+    assert 'github_trending_bot_cache_hits 2' in lines
+    assert '# TYPE github_trending_bot_cache_hits counter' in lines
+    assert '# TYPE github_trending_bot_cache_misses gauge' in lines
+    assert lines[-7:] == [
+        '# HELP github_trending_bot_token_requests Token stats.',
+        '# TYPE github_trending_bot_token_requests counter',
+        'github_trending_bot_token_requests{name="abcd..."} 3',
+        'github_trending_bot_token_requests{name="efgh..."} 1',
+        '# HELP github_trending_bot_token_reset_at Token stats.',
+        '# TYPE github_trending_bot_token_reset_at gauge',
+        'github_trending_bot_token_reset_at{name="efgh..."} 10.5',
+    ]
+
+
+def test_start_http_server():
+    registry = metrics.Registry()
+    registry.enable()
+    registry.counter('requests_total', 'Requests.').inc()
+    server = metrics.start_http_server(0, metrics_registry=registry)
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+    try:
+        with urllib.request.urlopen(base + metrics.METRICS_PATH) as response:
+            assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+            assert response.read().decode('utf-8') == registry.expose()
+        with pytest.raises(urllib.error.HTTPError) as exc_info:
+            urllib.request.urlopen(base + '/other')
+        assert exc_info.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_commands_executor_records_metrics(enabled_registry):
+    def fail(args):
+        raise bot.GithubApiError
+
+    commands_executor = bot.CommandsExecutor({'/echo': lambda args: ' '.join(args), '/fail': fail})
+    echo_count = _get_value(bot.command_duration, '_count', command='/echo')
+    fail_errors = _get_value(bot.command_errors, command='/fail', error='GithubApiError')
+    unknown_errors = _get_value(bot.command_errors, command='unknown', error='InvalidCommand')
+    assert commands_executor.execute(bot.ParsedMessage('/echo', ('some', 'text'))) == 'some text'
+    with pytest.raises(bot.GithubApiError):
+        commands_executor.execute(bot.ParsedMessage('/fail', ()))
+    with pytest.raises(bot.InvalidCommand):
+        commands_executor.execute(bot.ParsedMessage('/some_unknown_command', ()))
+    assert _get_value(bot.command_duration, '_count', command='/echo') == echo_count + 1
+    assert _get_value(bot.command_errors, command='/fail', error='GithubApiError') == fail_errors + 1
+    assert _get_value(bot.command_errors, command='unknown', error='InvalidCommand') == unknown_errors + 1
+    assert '/some_unknown_command' not in enabled_registry.expose()
+
+
+@responses.activate
+def test_telegram_api_records_metrics(enabled_registry):
+    responses.add(responses.POST, 'https://api.telegram.org/botsome_token/sendMessage', status=500)
+    count = _get_value(bot.telegram_request_duration, '_count', method='sendMessage')
+    errors = _get_value(bot.telegram_responses, method='sendMessage', status='500')
+    with pytest.raises(bot.TelegramApiError):
+        bot.TelegramApi('some_token', max_retries=0).send_message(chat_id=1, text='some text')
+    assert _get_value(bot.telegram_request_duration, '_count', method='sendMessage') == count + 1
+    assert _get_value(bot.telegram_responses, method='sendMessage', status='500') == errors + 1
+
+
+def test_admission_control_records_metrics(enabled_registry):
+    admission_control = bot.AdmissionControl(chat_burst=1, max_concurrent=1, max_waiting=0)
+    rate_limited = _get_value(bot.commands_rejected, reason='chat_rate')
+    overloaded = _get_value(bot.commands_rejected, reason='overloaded')
+    admission_control.admit_chat(1)
+    with pytest.raises(bot.CommandRejected):
+        admission_control.admit_chat(1)
+    with admission_control.turn():
+        assert _get_value(bot.expensive_commands_running) == 1
+        with pytest.raises(bot.CommandRejected):
+            admission_control.acquire()
+    assert _get_value(bot.expensive_commands_running) == 0
+    assert _get_value(bot.commands_rejected, reason='chat_rate') == rate_limited + 1
+    assert _get_value(bot.commands_rejected, reason='overloaded') == overloaded + 1
+
+
+def test_commands_executor_records_no_metrics_of_rejected_commands(enabled_registry):
+    def expensive(args):
+        return 'some text'
+
+    expensive.expensive = True
+    admission_control = bot.AdmissionControl(max_concurrent=1, max_waiting=0)
+    commands_executor = bot.CommandsExecutor({'/expensive': expensive}, admission_control)
+    count = _get_value(bot.command_duration, '_count', command='/expensive')
+    errors = _get_value(bot.command_errors, command='/expensive', error='CommandRejected')
+    with admission_control.turn():
+        with pytest.raises(bot.CommandRejected):
+            commands_executor.execute(bot.ParsedMessage('/expensive', ()))
+        with pytest.raises(bot.CommandRejected):
+            bot._run_until_complete(commands_executor.execute_async(bot.ParsedMessage('/expensive', ())))
+    assert _get_value(bot.command_duration, '_count', command='/expensive') == count
+    assert _get_value(bot.command_errors, command='/expensive', error='CommandRejected') == errors
+
+
+def test_start_metrics_server_without_telegram(monkeypatch):
+    # workers and the webhook mode have no telegram api, send queue or getUpdates batches
+    registry = metrics.Registry()
+    monkeypatch.setattr(metrics, 'registry', registry)
+    config = bot.Config(('some_github_token',), 'some_telegram_token', metrics_port=0)
+    server = bot._start_metrics_server(config)
+    try:
+        assert registry.enabled
+        lines = registry.expose().splitlines()
+        assert '# TYPE github_trending_bot_trending_cache_hits counter' in lines
+        assert '# TYPE github_trending_bot_github_token_remaining gauge' in lines
+        assert not any('telegram_connection' in line or 'send_queue' in line for line in lines)
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,180 @@
+import multiprocessing
+import os
+import threading
+from multiprocessing.connection import Listener
+
+import pytest
+
+from github_trending_bot import bot
+from github_trending_bot import sharding
+
+
+def _make_update(update_id, chat_id, text):
+    return bot.Update(
+        update_id=update_id,
+        message=bot.Message(chat_id=chat_id, message_id=update_id, text=text),
+    )
+
+
+def _make_echo_worker():
+    return sharding.ShardWorker(bot.CommandsExecutor({'/echo': lambda args: ' '.join(args)}), workers=2)
+
+
+def _start_worker(worker):
+    listener = Listener(('127.0.0.1', 0), authkey=b'some_authkey')
+    threading.Thread(target=worker.serve, args=(listener,), daemon=True).start()
+    return listener.address
+
+
+class _PipeWorker:
+    """Worker on the other end of a pipe, `connect` returns a new pipe every time it's called."""
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.connections = []
+
+    def connect(self, address, authkey):
+        connection, worker_connection = multiprocessing.Pipe()
+        self.connections.append(connection)
+        threading.Thread(target=self.worker._serve_connection, args=(worker_connection,), daemon=True).start()
+        return connection
+
+
+def test_get_shard():
+    assert [sharding.get_shard(chat_id, 3) for chat_id in [0, 1, 2, 3, -1]] == [0, 1, 2, 0, 2]
+
+
+def test_shard_worker_handle_batch():
+    replies = _make_echo_worker().handle_batch([
+        _make_update(1, chat_id=1, text='/echo first'),
+        bot.Update(2, None),
+        _make_update(3, chat_id=2, text='/unknown'),
+        _make_update(4, chat_id=1, text='/echo second'),
+    ])
+    assert replies == [(1, 'first'), (2, 'unknown command /unknown, type `/help`'), (1, 'second')]
+
+
+def test_sharded_dispatcher_partitions_by_chat_id():
+    workers = [_make_echo_worker(), _make_echo_worker()]
+    addresses = [_start_worker(worker) for worker in workers]
+    dispatcher = sharding.ShardedDispatcher([
+        sharding.ShardClient(address, b'some_authkey', timeout=5)
+        for address in addresses
+    ])
+    handled_chat_ids = [[], []]
+    for shard, worker in enumerate(workers):
+        worker.commands_executor.commands_by_name['/where'] = (
+            lambda args, shard=shard: handled_chat_ids[shard].append(int(args[0])) or f'shard {shard}'
+        )
+    updates = [_make_update(update_id, chat_id=update_id % 5, text=f'/where {update_id % 5}')
+               for update_id in range(20)]
+    replies = dispatcher.dispatch(updates)
+    assert sorted(replies) == sorted((update.message.chat_id, f'shard {update.message.chat_id % 2}')
+                                     for update in updates)
+    assert set(handled_chat_ids[0]) == {0, 2, 4}
+    assert set(handled_chat_ids[1]) == {1, 3}
+    # per-chat order is kept
+    assert [text for chat_id, text in dispatcher.dispatch(updates[:1] + [
+        _make_update(100, chat_id=0, text='/echo second'),
+        _make_update(101, chat_id=0, text='/echo third'),
+    ]) if chat_id == 0] == ['shard 0', 'second', 'third']
+    dispatcher.close()
+
+
+def test_sharded_dispatcher_fails_when_any_worker_fails():
+    pipe_worker = _PipeWorker(_make_echo_worker())
+    dispatcher = sharding.ShardedDispatcher([
+        sharding.ShardClient(('first', 1), b'some_authkey', timeout=5, connect=pipe_worker.connect),
+        sharding.ShardClient(('second', 2), b'some_authkey', timeout=5, connect=_refuse_connection),
+    ])
+    updates = [_make_update(1, chat_id=0, text='/echo first'), _make_update(2, chat_id=1, text='/echo second')]
+    with pytest.raises(sharding.ShardError):
+        dispatcher.dispatch(updates)
+    dispatcher.shard_clients[1].connect = pipe_worker.connect
+    # the batch is handled again from the start, the healthy worker is still connected
+    assert dispatcher.dispatch(updates) == [(0, 'first'), (1, 'second')]
+    assert len(pipe_worker.connections) == 2
+
+
+def test_shard_client_times_out():
+    connection, _ = multiprocessing.Pipe()
+    shard_client = sharding.ShardClient(('some_host', 1), b'some_authkey', timeout=0.01,
+                                        connect=lambda address, authkey: connection)
+    shard_client.send(1, [])
+    with pytest.raises(sharding.ShardError):
+        shard_client.receive(1)
+    assert connection.closed
+
+
+def test_ingress_main_commits_offset_after_all_workers_acknowledge(monkeypatch):
+    first_batch = [_make_update(1, chat_id=0, text='/echo first'), _make_update(2, chat_id=1, text='/echo second')]
+    batches = [first_batch, first_batch, [_make_update(3, chat_id=1, text='/echo third')]]
+    sent_messages = []
+    offsets = []
+    monkeypatch.setattr(os, 'environ', {
+        'GITHUB_TOKEN': 'some_github_token',
+        'TELEGRAM_TOKEN': 'some_telegram_token',
+        'SHARD_ADDRESSES': 'first:1,second:2',
+        'SHARD_AUTHKEY': 'some_authkey',
+    })
+    monkeypatch.setattr(sharding, 'SHARD_RETRY_INTERVAL', 0)
+
+    def get_updates(self, offset, limit, timeout):
+        offsets.append(offset)
+        if not batches:
+            raise _BreakFromInfiniteLoop
+        return batches.pop(0)
+
+    monkeypatch.setattr(bot.TelegramApi, 'get_updates', get_updates)
+    monkeypatch.setattr(bot.TelegramApi, 'send_message', lambda self, **kwargs: sent_messages.append(kwargs))
+    pipe_worker = _PipeWorker(_make_echo_worker())
+    failures = [_refuse_connection]
+
+    def connect(address, authkey):
+        assert authkey == b'some_authkey'
+        if address == ('second', 2) and failures:
+            return failures.pop()(address, authkey)
+        return pipe_worker.connect(address, authkey)
+
+    monkeypatch.setattr(sharding, 'Client', connect)
+    with pytest.raises(_BreakFromInfiniteLoop):
+        sharding.ingress_main(offset_state=_OffsetState())
+    # the first batch failed on the second worker, so it came again with the same offset
+    assert offsets == [0, 0, 3, 4]
+    assert [message['text'] for message in sent_messages] == ['first', 'second', 'third']
+
+
+@pytest.mark.parametrize('environment', [
+    {'SHARD_AUTHKEY': 'some_authkey'},
+    {'SHARD_ADDRESSES': 'localhost:7001'},
+    {'SHARD_ADDRESSES': 'localhost', 'SHARD_AUTHKEY': 'some_authkey'},
+    {'SHARD_ADDRESSES': ',', 'SHARD_AUTHKEY': 'some_authkey'},
+    {'SHARD_ADDRESSES': 'localhost:7001', 'SHARD_AUTHKEY': ''},
+])
+def test_get_ingress_config_failure(environment):
+    with pytest.raises(bot.InvalidConfig):
+        sharding.get_ingress_config(environment)
+
+
+def test_get_ingress_and_worker_config():
+    assert sharding.get_ingress_config({
+        'SHARD_ADDRESSES': 'localhost:7001, 10.0.0.2:7002',
+        'SHARD_AUTHKEY': 'some_authkey',
+    }) == ([('localhost', 7001), ('10.0.0.2', 7002)], b'some_authkey')
+    assert sharding.get_worker_config({
+        'SHARD_LISTEN_ADDRESS': '0.0.0.0:7001',
+        'SHARD_AUTHKEY': 'some_authkey',
+    }) == (('0.0.0.0', 7001), b'some_authkey')
+
+
+class _BreakFromInfiniteLoop(Exception):
+    pass
+
+
+class _OffsetState:
+    def __init__(self):
+        self.offset = 0
+
+
+def _refuse_connection(address, authkey):
+    raise ConnectionRefusedError
@@ -0,0 +1,161 @@
+import io
+import socketserver
+import threading
+
+import pytest
+
+from github_trending_bot import state
+
+
+class _FakeTimer:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class _FakeRedisHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                command = state.read_reply(self.rfile)
+            except ValueError:
+                return
+            self.wfile.write(self.server.execute(command))
+
+
+class _FakeRedisServer(socketserver.ThreadingTCPServer):
+    """Speaks just enough of the redis protocol: GET, SET with an optional PX and SELECT."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _FakeRedisHandler)
+        self.values = {}
+        self.commands = []
+
+    def execute(self, command):
+        self.commands.append(command)
+        name = command[0].upper()
+        if name == b'GET':
+            value = self.values.get(command[1])
+            return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+        if name == b'SET':
+            self.values[command[1]] = command[2]
+            return b'+OK\r\n'
+        if name == b'SELECT':
+            return b'+OK\r\n'
+        return b'-ERR unknown command\r\n'
+
+
+@pytest.fixture
+def redis_server():
+    server = _FakeRedisServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_sqlite_state_backend(tmpdir):
+    timer = _FakeTimer()
+    path = str(tmpdir.join('state.db'))
+    backend = state.SqliteStateBackend(path, timer=timer)
+    assert backend.get('key') is None
+    backend.set('key', b'value')
+    backend.set('expiring_key', b'expiring_value', ttl=10)
+    assert backend.get('key') == b'value'
+    assert backend.get('expiring_key') == b'expiring_value'
+    timer.now = 10
+    assert backend.get('expiring_key') is None
+    backend.close()
+    # values outlive the backend
+    other_backend = state.SqliteStateBackend(path, timer=timer)
+    assert other_backend.get('key') == b'value'
+    assert other_backend._connection.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+    other_backend.close()
+
+
+def test_sqlite_state_backend_purges_expired_values(tmpdir):
+    timer = _FakeTimer()
+    backend = state.SqliteStateBackend(str(tmpdir.join('state.db')), timer=timer, purge_interval=100)
+    backend.set('expiring_key', b'expiring_value', ttl=10)
+    backend.set('key', b'value')
+    timer.now = 50
+    backend.set('other_key', b'other_value')
+    timer.now = 100
+    backend.set('other_key', b'other_value')
+    keys = [key for key, in backend._connection.execute('SELECT key FROM state ORDER BY key')]
+    assert keys == ['key', 'other_key']
+    backend.close()
+
+
+def test_sqlite_state_backend_error_handling(tmpdir):
+    with pytest.raises(state.StateBackendError):
+        state.SqliteStateBackend(str(tmpdir.join('missing_dir', 'state.db')))
+
+
+def test_redis_state_backend(redis_server):
+    host, port = redis_server.server_address
+    backend = state.RedisStateBackend(host, port, db=2)
+    assert backend.get('key') is None
+    backend.set('key', b'value')
+    backend.set('expiring_key', b'\r\nexpiring value', ttl=1.5)
+    assert backend.get('key') == b'value'
+    assert backend.get('expiring_key') == b'\r\nexpiring value'
+    backend.close()
+    assert redis_server.commands == [
+        [b'SELECT', b'2'],
+        [b'GET', b'key'],
+        [b'SET', b'key', b'value'],
+        [b'SET', b'expiring_key', b'\r\nexpiring value', b'PX', b'1500'],
+        [b'GET', b'key'],
+        [b'GET', b'expiring_key'],
+    ]
+
+
+def test_redis_state_backend_error_handling(redis_server):
+    host, port = redis_server.server_address
+    backend = state.RedisStateBackend(host, port)
+    with pytest.raises(state.StateBackendError):
+        backend._execute('UNKNOWN')
+    redis_server.shutdown()
+    redis_server.server_close()
+    backend.close()
+    with pytest.raises(state.StateBackendError):
+        backend.get('key')
+
+
+@pytest.mark.parametrize('reply, expected', [
+    (b'+OK\r\n', 'OK'),
+    (b':3\r\n', 3),
+    (b'$-1\r\n', None),
+    (b'$5\r\nvalue\r\n', b'value'),
+    (b'*2\r\n$1\r\na\r\n:1\r\n', [b'a', 1]),
+])
+def test_read_reply(reply, expected):
+    assert state.read_reply(io.BytesIO(reply)) == expected
+
+
+@pytest.mark.parametrize('reply', [
+    b'',
+    b'$5\r\nval',
+    b'?\r\n',
+])
+def test_read_reply_failure(reply):
+    with pytest.raises(ValueError):
+        state.read_reply(io.BytesIO(reply))
+
+
+def test_open_state_backend(tmpdir):
+    backend = state.open_state_backend('sqlite://' + str(tmpdir.join('state.db')))
+    assert isinstance(backend, state.SqliteStateBackend)
+    backend.close()
+    backend = state.open_state_backend('redis://example.com:6380/1')
+    assert (backend.host, backend.port, backend.db) == ('example.com', 6380, 1)
+    with pytest.raises(state.StateBackendError):
+        state.open_state_backend('memcached://localhost')
+    with pytest.raises(state.StateBackendError, match='no path'):
+        state.open_state_backend('sqlite://state.db')